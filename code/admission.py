@@ -0,0 +1,191 @@
+"""Admission control: per-route-class concurrency limits with load shedding.
+
+Every request is put in a class by its route: `critical` (booking and
+single-record reads), `standard` (anything not listed) and `bulk` (lists,
+search, exports and bulk ingest). At most `ADMISSION_MAX_CONCURRENCY`
+requests run at once per worker, sized like the DB pool so requests queue
+here rather than for a connection, and a class may hold at most its own
+`limit` of those slots. A request that cannot start waits in its class's
+queue. When a slot frees, the highest-priority class that may run gets it.
+Requests are shed with 503 + Retry-After when their queue is full, or when
+they have waited `deadline` seconds without a slot.
+"""
+import asyncio
+import os
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+import database
+import fastjson
+import metrics
+
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'true').lower() in ('1', 'true', 'yes')
+ADMISSION_MAX_CONCURRENCY = int(os.getenv('ADMISSION_MAX_CONCURRENCY', database.DB_POOL_SIZE + database.DB_MAX_OVERFLOW))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', 1))
+
+CRITICAL, STANDARD, BULK = 'critical', 'standard', 'bulk'
+# a rule mapping a route to EXEMPT is never queued or shed (e.g. /metrics)
+EXEMPT = None
+
+
+@dataclass(frozen=True)
+class RouteClass:
+    name: str
+    priority: int  # lower is served first
+    limit: int  # slots this class may hold at once
+    queue: int  # waiting requests beyond which new ones are shed straight away
+    deadline: float  # seconds a request may wait for a slot
+
+
+def _route_class(name: str, priority: int, limit: int, queue: int, deadline: float) -> RouteClass:
+    prefix = f'ADMISSION_{name.upper()}_'
+    return RouteClass(name, priority, int(os.getenv(prefix + 'LIMIT', limit)), int(os.getenv(prefix + 'QUEUE', queue)),
+                      float(os.getenv(prefix + 'DEADLINE', deadline)))
+
+
+def default_classes(capacity: int = ADMISSION_MAX_CONCURRENCY) -> List[RouteClass]:
+    return [
+        _route_class(CRITICAL, 0, capacity, capacity * 8, 5.0),
+        _route_class(STANDARD, 1, capacity, capacity * 4, 2.0),
+        # bulk never takes more than a third of the slots, so booking always finds some free
+        _route_class(BULK, 2, max(1, capacity // 3), capacity, 1.0),
+    ]
+
+
+class Shed(Exception):
+    def __init__(self, route_class: RouteClass, reason: str):
+        super().__init__(f'{route_class.name} request shed: {reason}')
+        self.route_class = route_class
+        self.reason = reason
+
+
+QUEUE_WAIT = metrics.histogram_family('admission_queue_wait_seconds', 'Time admitted requests waited for a slot',
+                                      ('class',))
+SHED = metrics.counter('admission_shed_total', 'Requests refused with 503 by admission control', ('class', 'reason'))
+
+
+class Limiter:
+    """Slots and wait queues for one event loop (one per worker process)."""
+
+    def __init__(self, capacity: int, classes: Sequence[RouteClass]):
+        self.capacity = capacity
+        self.classes = {c.name: c for c in classes}
+        self.order = sorted(classes, key=lambda c: c.priority)
+        self.in_use = 0
+        self.active: Dict[str, int] = {c.name: 0 for c in classes}
+        self.waiting: Dict[str, Deque[asyncio.Future]] = {c.name: deque() for c in classes}
+        metrics.gauge('admission_in_flight', 'Admitted requests running, by class',
+                      lambda: {(name,): n for name, n in self.active.items()}, ('class',))
+        metrics.gauge('admission_queue_depth', 'Requests waiting for a slot, by class',
+                      lambda: {(name,): len(q) for name, q in self.waiting.items()}, ('class',))
+
+    def _can_run(self, route_class: RouteClass) -> bool:
+        return self.in_use < self.capacity and self.active[route_class.name] < route_class.limit
+
+    def _take(self, route_class: RouteClass) -> None:
+        self.in_use += 1
+        self.active[route_class.name] += 1
+
+    def _dispatch(self) -> None:
+        for route_class in self.order:
+            queue = self.waiting[route_class.name]
+            while queue and self._can_run(route_class):
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # the slot is taken on the waiter's behalf, so nothing can overtake it before it resumes
+                    self._take(route_class)
+                    waiter.set_result(None)
+
+    async def acquire(self, name: str) -> float:
+        """Wait for a slot of class `name`; returns the seconds waited or raises Shed."""
+        route_class = self.classes[name]
+        if self._can_run(route_class) and not self.waiting[name]:
+            self._take(route_class)
+            return 0.0
+        queue = self.waiting[name]
+        if len(queue) >= route_class.queue:
+            raise Shed(route_class, 'queue_full')
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, route_class.deadline)
+        except asyncio.TimeoutError:
+            raise Shed(route_class, 'deadline') from None
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release(name)  # granted just as the client went away
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    queue.remove(waiter)
+                except ValueError:
+                    pass
+        return time.perf_counter() - started
+
+    def release(self, name: str) -> None:
+        self.in_use -= 1
+        self.active[name] -= 1
+        self._dispatch()
+
+
+slots = Limiter(ADMISSION_MAX_CONCURRENCY, default_classes())
+
+
+def _route_pattern(template: str):
+    return re.compile('^' + re.sub(r'\{[^/]+\}', '[^/]+', template) + '$')
+
+
+_BUSY_BODY = fastjson.dumps({'detail': 'Server busy, retry shortly'})
+
+
+class AdmissionMiddleware:
+    """ASGI middleware running each request under its class's slot (see module docstring).
+
+    `rules` maps "METHOD /route/{template}" to a class name, or to EXEMPT; other requests
+    are `default`. Rules are tried in order, so list literal paths before templated ones.
+    """
+
+    def __init__(self, app, rules: Dict[str, Optional[str]], default: str = STANDARD,
+                 limiter: Optional[Limiter] = None):
+        self.app = app
+        self.rules: List[Tuple[str, re.Pattern, str, Optional[str]]] = []
+        for key, name in rules.items():
+            method, template = key.split(' ', 1)
+            self.rules.append((method, _route_pattern(template), template, name))
+        self.default = default
+        self.limiter = limiter or slots
+
+    def _classify(self, method: str, path: str) -> Tuple[Optional[str], Optional[str]]:
+        for rule_method, pattern, template, name in self.rules:
+            if rule_method == method and pattern.match(path):
+                return template, name
+        return None, self.default
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not ADMISSION_CONTROL:
+            return await self.app(scope, receive, send)
+        template, name = self._classify(scope['method'], scope['path'])
+        if name is EXEMPT:
+            return await self.app(scope, receive, send)
+        try:
+            waited = await self.limiter.acquire(name)
+        except Shed as shed:
+            SHED.inc(labels=(name, shed.reason))
+            if template is not None:
+                scope['route_template'] = template  # for request metrics; the request never reaches routing
+            await send({'type': 'http.response.start', 'status': 503, 'headers': [
+                (b'content-type', b'application/json'), (b'content-length', str(len(_BUSY_BODY)).encode()),
+                (b'retry-after', str(ADMISSION_RETRY_AFTER_SECONDS).encode())]})
+            await send({'type': 'http.response.body', 'body': _BUSY_BODY})
+            return
+        QUEUE_WAIT.labels(name).observe(waited)
+        try:
+            # streamed bodies (NDJSON, exports) keep their slot until the last chunk is sent
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release(name)
@@ -1,26 +1,97 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+import functools
+from fastapi import FastAPI, HTTPException, Depends, Query, Response, Request, WebSocket
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Optional, List
-from database import get_session
-import models, crud
+from starlette.concurrency import run_in_threadpool
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field
+from typing import Annotated, Optional, List, Literal, Union
+from database import get_session, get_db, run_db
+import database
+import models, crud, crud_async
 import auth
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import Dict
-import seed
+import loaders
+import sqlstats
+import metrics
+import requestmetrics
+import replicas
+import admission
+import dbdiag
+import search
+import hashing
+import bulk
+import changefeed
+import prestart
+import exports
+import availability
+import archive
+import rollups
+import httpcache
+import fastjson
+import projections
 from database import Base, engine
-from datetime import datetime, date
-
-app = FastAPI(title='ADSWeb API', openapi_prefix='/adsweb/api/v1')
+from datetime import datetime, date, time, timedelta
+from pagination import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER,
+    InvalidCursor, encode_cursor, decode_cursor,
+)
 
+app = FastAPI(title='ADSWeb API', openapi_prefix='/adsweb/api/v1', default_response_class=fastjson.FastJSONResponse)
+
+# innermost, so cached responses skip the queue and 503s still get CORS headers (see admission)
+app.add_middleware(admission.AdmissionMiddleware, rules={
+    'GET /metrics': admission.EXEMPT,
+    'POST /appointments': admission.CRITICAL,
+    'GET /dentists/{id}/availability': admission.CRITICAL,
+    'GET /patients': admission.BULK,
+    'GET /patients/{id}': admission.CRITICAL,
+    'GET /addresses': admission.BULK,
+    'GET /dentists': admission.BULK,
+    'GET /surgeries': admission.BULK,
+    'GET /appointments': admission.BULK,
+    'GET /patients/{id}/appointments': admission.BULK,
+    'GET /appointments/history': admission.BULK,
+    'GET /patient/search/{q}': admission.BULK,
+    'GET /export/{dataset}': admission.BULK,
+    'POST /addresses/bulk': admission.BULK,
+    'POST /patients/bulk': admission.BULK,
+    'POST /dentists/bulk': admission.BULK,
+    'POST /appointments/bulk': admission.BULK,
+})
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, sqlstats.STATEMENT_COUNT_HEADER, 'ETag', replicas.LAST_WRITE_HEADER, 'Retry-After',
+                    changefeed.HEAD_HEADER],
 )
+# polled read endpoints -> tables their bodies are built from (see httpcache)
+_CACHED = {
+    '/patients': ('patients', 'addresses'),
+    '/patients/{id}': ('patients', 'addresses'),
+    '/addresses': ('addresses',),
+    '/dentists': ('dentists', 'addresses'),
+    '/surgeries': ('surgeries',),
+}
+if httpcache.SHARED:
+    # rollups are also rewritten by scripts (rebuild_rollups.py), which only a shared version store sees
+    _CACHED['/stats/{dimension}'] = ('appointment_daily_stats',)
+app.add_middleware(httpcache.ResponseCacheMiddleware, rules=_CACHED)
+if database.replica_set is not None:
+    # lets clients that just wrote read it back from the primary (see replicas)
+    app.add_middleware(replicas.ReadYourWritesMiddleware)
+
+
+# outermost: times the whole request and sets X-SQL-Statements (see requestmetrics)
+app.add_middleware(requestmetrics.RequestMetricsMiddleware)
+
+
+if dbdiag.SESSION_DEBUG:
+    app.add_middleware(dbdiag.UnclosedSessionMiddleware)
 
 
 class AddressOut(BaseModel):
@@ -31,8 +102,7 @@ class AddressOut(BaseModel):
     postal_code: Optional[str]
     country: Optional[str]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class AddressIn(BaseModel):
@@ -53,6 +123,15 @@ class PatientIn(BaseModel):
     address_id: Optional[int] = None
 
 
+class PatientPatch(BaseModel):
+    # only the fields sent are updated; names cannot be cleared
+    first_name: str = None
+    last_name: str = None
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    address_id: Optional[int] = None
+
+
 class PatientOut(BaseModel):
     id: int
     first_name: str
@@ -61,14 +140,18 @@ class PatientOut(BaseModel):
     phone: Optional[str]
     address: Optional[AddressOut]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+# stored naive UTC; an offset is converted so comparisons never mix naive and aware (query ranges: see _range)
+UtcDatetime = Annotated[datetime, AfterValidator(availability.naive_utc)]
+
 
 class AppointmentIn(BaseModel):
     patient_id: int = Field(..., description="ID of the patient")
     dentist_id: int
     surgery_id: Optional[int] = None
-    scheduled_at: datetime
+    scheduled_at: UtcDatetime
+    duration_minutes: Optional[int] = Field(None, ge=1, le=availability.MAX_DURATION_MINUTES)
     notes: Optional[str] = None
 
 class AppointmentOut(BaseModel):
@@ -77,87 +160,166 @@ class AppointmentOut(BaseModel):
     dentist_id: int
     surgery_id: Optional[int] = None
     scheduled_at: datetime
+    duration_minutes: Optional[int] = None
     notes: Optional[str] = None
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 # --- Dentist ---
 class DentistIn(BaseModel):
     first_name: str
     last_name: str
-    specialty: Optional[str]
-    email: Optional[str]
-    phone: Optional[str]
-    address_id: Optional[int]
+    specialty: Optional[str] = None
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    address_id: Optional[int] = None
 
 class DentistOut(BaseModel):
     id: int
-    class Config:
-        orm_mode = True
+    first_name: str
+    last_name: str
+    specialty: Optional[str] = None
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
+
+class WorkingHoursIn(BaseModel):
+    weekday: int = Field(..., ge=0, le=6, description="0 = Monday")
+    starts_at: time
+    ends_at: time
+
+class Slot(BaseModel):
+    start: datetime
+    end: datetime
+
+class AvailabilityOut(BaseModel):
+    dentist_id: int
+    slots: List[Slot]
       
 # --- Surgery ---
 class SurgeryIn(BaseModel):
     title: str
-    description: Optional[str]
+    description: Optional[str] = None
 
 class SurgeryOut(BaseModel):
     id: int
-    class Config:
-        orm_mode = str
+    title: str
+    description: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
     
-def get_db():
-    db = get_session()
+def _after(cursor: Optional[str], types):
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor, types)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def _fields(name: str, fields: Optional[str], required=()):
+    try:
+        return projections.parse_fields(name, fields, required)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def _include(include: Optional[str], allowed):
     try:
-        yield db
-    finally:
-        db.close()
+        return projections.parse_include(include, allowed)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def _ids(ids: Optional[str], cursor: Optional[str], stream: bool):
+    # `ids=1,2,3` looks rows up directly: in the order given, without pagination
+    try:
+        parsed = projections.parse_ids(ids, MAX_PAGE_SIZE)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if parsed is not None and (cursor is not None or stream):
+        raise HTTPException(status_code=422, detail="'ids' cannot be combined with 'cursor' or 'stream'")
+    return parsed
+
+
+def _page(rows, limit: int, key, document=None):
+    # rows are projection dicts straight from the database (see projections), so they are encoded
+    # without response_model validation; they were fetched with limit + 1 so the presence of a
+    # next page is known without a count
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(*key(rows[-1]))
+    return fastjson.FastJSONResponse(document(rows) if document else rows, headers=headers)
+
+
+def _stream_ndjson(iter_chunks, after, replica=None):
+    def body():
+        # the request-scoped session is gone once the response starts, so the stream owns its own
+        db = get_session(replica)
+        try:
+            for rows in iter_chunks(db, after=after):
+                yield b''.join(fastjson.dumps(row) + b'\n' for row in rows)
+        finally:
+            db.close()
+    return StreamingResponse(body(), media_type='application/x-ndjson')
 
 
 @app.get('/patients', response_model=List[PatientOut])
-def list_patients(db: Session = Depends(get_db)):
-    patients = db.query(models.Patient).join(models.Address, isouter=True).order_by(models.Patient.last_name.asc()).all()
-    return patients
+async def list_patients(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False,
+                        fields: Optional[str] = None, include: Optional[str] = None, ids: Optional[str] = None,
+                        db=Depends(get_db)):
+    # `fields` narrows the patient columns; the address then comes only with include=address
+    after = _after(cursor, (str, int))
+    included = _include(include, ('address',))
+    projection = dict(fields=_fields('patients', fields), address=fields is None or 'address' in included)
+    wanted = _ids(ids, cursor, stream)
+    if wanted is not None:
+        return fastjson.FastJSONResponse(await run_db(db, projections.get_patients, wanted, **projection))
+    if stream:
+        return _stream_ndjson(functools.partial(projections.iter_patients, **projection), after, db.info.get('replica'))
+    patients = await run_db(db, projections.list_patients, limit + 1, after, **projection)
+    return _page(patients, limit, lambda p: (p['last_name'], p['id']))
 
 
 @app.get('/patients/{patient_id}', response_model=PatientOut)
-def get_patient(patient_id: int, db: Session = Depends(get_db)):
-    p = crud.get_patient(db, patient_id)
+async def get_patient(patient_id: int, db=Depends(get_db)):
+    p = await crud_async.get_patient(db, patient_id, options=loaders.PATIENT_OUT, out=PatientOut)
     if not p:
         raise HTTPException(status_code=404, detail='Patient not found')
     return p
 
 
 @app.post('/patients', response_model=PatientOut, status_code=201)
-def create_patient(patient: PatientIn, db: Session = Depends(get_db)):
-    p = crud.create_patient(db, **patient.dict())
+async def create_patient(patient: PatientIn, db=Depends(get_db)):
+    p = await crud_async.create_patient(db, **patient.dict(), out=PatientOut)
     return p
 
 
 @app.put('/patient/{patient_id}', response_model=PatientOut)
-def update_patient(patient_id: int, patient: PatientIn, db: Session = Depends(get_db), user: models.User = Depends(auth.require_roles(['admin','staff']))):
-    existing = crud.get_patient(db, patient_id)
-    if not existing:
+async def update_patient(patient_id: int, patient: PatientIn, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    updated = await crud_async.update_patient(db, patient_id, **patient.dict(), out=PatientOut)
+    if not updated:
+        raise HTTPException(status_code=404, detail='Patient not found')
+    return updated
+
+
+@app.patch('/patient/{patient_id}', response_model=PatientOut)
+async def patch_patient(patient_id: int, patient: PatientPatch, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    updated = await crud_async.update_patient(db, patient_id, **patient.dict(exclude_unset=True), out=PatientOut)
+    if not updated:
         raise HTTPException(status_code=404, detail='Patient not found')
-    updated = crud.update_patient(db, patient_id, **patient.dict())
     return updated
 
 
 @app.delete('/patient/{patient_id}', status_code=204)
-def delete_patient(patient_id: int, db: Session = Depends(get_db)):
-    ok = crud.delete_patient(db, patient_id)
+async def delete_patient(patient_id: int, db=Depends(get_db)):
+    ok = await crud_async.delete_patient(db, patient_id)
     if not ok:
         raise HTTPException(status_code=404, detail='Patient not found')
     return None
 
 
-@app.post('/auth/register', status_code=201)
-def register(username: str, email: str, password: str, db: Session = Depends(get_db)):
-    # create a role 'user' if not exists
-    # store hashed password
-    hashed = auth.get_password_hash(password)
-    # ensure 'user' role exists and assign to the new user
-    import models
+def _register_user(db: Session, username: str, email: str, hashed: str):
     # create user
     user = crud.create_user(db, username=username, email=email, full_name=username, hashed_password=hashed)
     # find or create 'user' role and attach
@@ -169,77 +331,408 @@ def register(username: str, email: str, password: str, db: Session = Depends(get
     return {"id": user.id, "username": user.username}
 
 
+@app.post('/auth/register', status_code=201)
+async def register(username: str, email: str, password: str, db=Depends(get_db)):
+    # hash in the hashing process pool, then store the user without blocking the event loop
+    hashed = await hashing.hash_password(password)
+    return await run_db(db, _register_user, username, email, hashed)
+
+
+@app.exception_handler(hashing.HashingOverloaded)
+def hashing_overloaded(request, exc):
+    return JSONResponse(status_code=503, content={'detail': 'Too many concurrent logins, retry shortly'},
+                        headers={'Retry-After': str(hashing.HASH_RETRY_AFTER_SECONDS)})
+
+
+@app.exception_handler(crud.ReferenceNotFound)
+def reference_not_found(request, exc):
+    return JSONResponse(status_code=404, content={'detail': str(exc)})
+
+
+@app.exception_handler(crud.Conflict)
+def write_conflict(request, exc):
+    return JSONResponse(status_code=409, content={'detail': str(exc)})
+
+
 @app.on_event('startup')
 def startup_event():
-    # create tables and seed roles/admin if configured
+    if database.replica_set is not None:
+        database.replica_set.start()
+    # create tables and seed roles/admin unless main.py already did it before starting the workers
+    if prestart.done():
+        return
     try:
-        Base.metadata.create_all(bind=engine)
-        seed.seed_initial_data()
+        prestart.run(engine)
     except Exception as e:
         # don't fail startup; just log
         import logging
         logging.exception('Seeding initial data failed: %s', e)
 
 
+@app.on_event('shutdown')
+def shutdown_event():
+    hashing.shutdown()
+    if database.replica_set is not None:
+        database.replica_set.stop()
+
+
+@app.get('/metrics', include_in_schema=False)
+def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
 @app.post('/auth/token')
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db=Depends(get_db)):
+    user = await auth.authenticate_user_async(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=401, detail='Incorrect username or password')
-    access_token = auth.create_access_token(data={"sub": user.username})
+    access_token = auth.create_access_token(data={"sub": user.username, "uid": user.id}, roles=list(user.roles))
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+def _search_patients(db: Session, search_string: str, limit: int, prefix: bool):
+    results = search.search_patients(db, search_string, limit=limit, prefix=prefix, options=loaders.PATIENT_OUT)
+    return [PatientOut.model_validate(p, from_attributes=True) for p in results]
+
+
 @app.get('/patient/search/{search_string}', response_model=List[PatientOut])
-def search_patients(search_string: str, db: Session = Depends(get_db)):
-    s = f"%{search_string}%"
-    results = db.query(models.Patient).filter(
-        (models.Patient.first_name.ilike(s)) |
-        (models.Patient.last_name.ilike(s)) |
-        (models.Patient.email.ilike(s)) |
-        (models.Patient.phone.ilike(s))
-    ).order_by(models.Patient.last_name.asc()).all()
-    return results
+async def search_patients(search_string: str, limit: int = Query(search.DEFAULT_LIMIT, ge=1, le=search.MAX_LIMIT), prefix: bool = False, db=Depends(get_db)):
+    return await run_db(db, _search_patients, search_string, limit, prefix)
 
 
 @app.get('/addresses', response_model=List[AddressOut])
-def list_addresses(db: Session = Depends(get_db)):
-    addrs = db.query(models.Address).order_by(models.Address.city.asc()).all()
-    return addrs
+async def list_addresses(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False,
+                         fields: Optional[str] = None, ids: Optional[str] = None, db=Depends(get_db)):
+    after = _after(cursor, (str, int))
+    selected = _fields('addresses', fields)
+    wanted = _ids(ids, cursor, stream)
+    if wanted is not None:
+        return fastjson.FastJSONResponse(await run_db(db, projections.get_addresses, wanted, fields=selected))
+    if stream:
+        return _stream_ndjson(functools.partial(projections.iter_addresses, fields=selected), after, db.info.get('replica'))
+    addrs = await run_db(db, projections.list_addresses, limit + 1, after, fields=selected)
+    return _page(addrs, limit, lambda a: (a['city'], a['id']))
 
 
 @app.post('/addresses', response_model=AddressOut, status_code=201)
-def create_address(address: AddressIn, db: Session = Depends(get_db)):
-    a = crud.create_address(db, **address.dict())
+async def create_address(address: AddressIn, db=Depends(get_db)):
+    a = await crud_async.create_address(db, **address.dict(), out=AddressOut)
     return a
 
+def _add_appointment(db: Session, appointment: AppointmentIn):
+    # a missing patient/dentist/surgery fails the insert's foreign key and becomes a 404
+    try:
+        new_appointment = availability.book(db, appointment.dict())
+    except availability.BookingConflict as e:
+        raise HTTPException(status_code=409, detail=f"Dentist or surgery already booked: {e}")
+    return AppointmentOut.model_validate(new_appointment, from_attributes=True)
+
+def _range(start: Optional[datetime], end: Optional[datetime]):
+    # as naive UTC, like the stored times and AppointmentIn
+    start, end = (availability.naive_utc(d) if d is not None else None for d in (start, end))
+    if start is not None and end is not None and end <= start:
+        raise HTTPException(status_code=422, detail="'to' must be after 'from'")
+    return start, end
+
+
+class AppointmentIncluded(BaseModel):
+    patients: Optional[List[PatientOut]] = None
+    dentists: Optional[List[DentistOut]] = None
+    surgeries: Optional[List[SurgeryOut]] = None
+
+
+class AppointmentDocument(BaseModel):
+    # GET /appointments with include=: each related row once, however many appointments refer to it
+    data: List[AppointmentOut]
+    included: AppointmentIncluded
+
+
+def _with_related(db: Session, fetch, expand: int, include, *args, **kwargs):
+    # the page and its related rows in one go; rows past `expand` only signal a next page and are not expanded
+    rows = fetch(db, *args, **kwargs)
+    return rows, projections.related(db, rows[:expand], include)
+
+
+@app.get('/appointments', response_model=Union[List[AppointmentOut], AppointmentDocument])
+async def list_appointments(dentist_id: Optional[int] = None, patient_id: Optional[int] = None, surgery_id: Optional[int] = None,
+                            start: Optional[datetime] = Query(None, alias='from'), end: Optional[datetime] = Query(None, alias='to'),
+                            limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False,
+                            fields: Optional[str] = None, include: Optional[str] = None, ids: Optional[str] = None,
+                            db=Depends(get_db)):
+    start, end = _range(start, end)
+    after = _after(cursor, (datetime.fromisoformat, int))
+    included = _include(include, tuple(projections.RELATED))
+    selected = _fields('appointments', fields, [f'{name}_id' for name in included])
+    filters = dict(dentist_id=dentist_id, patient_id=patient_id, surgery_id=surgery_id, start=start, end=end)
+    wanted = _ids(ids, cursor, stream)
+    if wanted is not None and any(v is not None for v in filters.values()):
+        raise HTTPException(status_code=422, detail="'ids' cannot be combined with filters")
+    if stream and included:
+        raise HTTPException(status_code=422, detail="'include' cannot be combined with 'stream'")
+    if stream:
+        return _stream_ndjson(functools.partial(projections.iter_appointments, fields=selected, **filters), after,
+                              db.info.get('replica'))
+    if wanted is not None:
+        if not included:
+            return fastjson.FastJSONResponse(await run_db(db, projections.get_appointments, wanted, fields=selected))
+        rows, related = await run_db(db, _with_related, projections.get_appointments, len(wanted), included, wanted, fields=selected)
+        return fastjson.FastJSONResponse({'data': rows, 'included': related})
+    if not included:
+        rows = await run_db(db, projections.list_appointments, limit + 1, after, fields=selected, **filters)
+        return _page(rows, limit, lambda a: (a['scheduled_at'], a['id']))
+    rows, related = await run_db(db, _with_related, projections.list_appointments, limit, included, limit + 1, after,
+                                 fields=selected, **filters)
+    return _page(rows, limit, lambda a: (a['scheduled_at'], a['id']), lambda page: {'data': page, 'included': related})
+
+
+class AppointmentHistoryOut(AppointmentOut):
+    archived: bool
+
+
+@app.get('/appointments/history', response_model=List[AppointmentHistoryOut])
+async def appointment_history(dentist_id: Optional[int] = None, patient_id: Optional[int] = None, surgery_id: Optional[int] = None,
+                              start: Optional[datetime] = Query(None, alias='from'), end: Optional[datetime] = Query(None, alias='to'),
+                              limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                              db=Depends(get_db)):
+    # like /appointments, but also reads the archived months (see archive); slower
+    start, end = _range(start, end)
+    after = _after(cursor, (datetime.fromisoformat, int))
+    filters = dict(dentist_id=dentist_id, patient_id=patient_id, surgery_id=surgery_id, start=start, end=end)
+    live = await run_db(db, projections.list_appointments, limit + 1, after, **filters)
+    archived = await run_in_threadpool(archive.archived_rows, limit + 1, after, **filters)
+    return _page(archive.merge_history(live, archived, limit + 1), limit, lambda a: (a['scheduled_at'], a['id']))
+
+
+@app.get('/patients/{patient_id}/appointments', response_model=List[AppointmentOut])
+async def list_patient_appointments(patient_id: int,
+                                    start: Optional[datetime] = Query(None, alias='from'), end: Optional[datetime] = Query(None, alias='to'),
+                                    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                                    fields: Optional[str] = None, db=Depends(get_db)):
+    start, end = _range(start, end)
+    after = _after(cursor, (datetime.fromisoformat, int))
+    rows = await run_db(db, projections.list_appointments, limit + 1, after, patient_id=patient_id, start=start, end=end,
+                        fields=_fields('appointments', fields))
+    # the existence check is only needed to tell "no appointments" from "no such patient"
+    if not rows and not await crud_async.get_patient(db, patient_id):
+        raise HTTPException(status_code=404, detail='Patient not found')
+    return _page(rows, limit, lambda a: (a['scheduled_at'], a['id']))
+
+
 @app.post("/appointments", response_model=AppointmentOut, status_code=201)
-def add_appointment(appointment: AppointmentIn, db: Session = Depends(get_db)):
-    if not db.query(models.Patient).filter(models.Patient.id == appointment.patient_id).first():
-        raise HTTPException(status_code=404, detail="Patient not found")
-    if not db.query(models.Dentist).filter(models.Dentist.id == appointment.dentist_id).first():
-        raise HTTPException(status_code=404, detail="Dentist not found")
-    if appointment.surgery_id and not db.query(models.Surgery).filter(models.Surgery.id == appointment.surgery_id).first():
-        raise HTTPException(status_code=404, detail="Surgery not found")
-
-    new_appointment = models.Appointment(**appointment.dict())
-    db.add(new_appointment)
-    db.commit()
-    db.refresh(new_appointment)
-    return new_appointment
+async def add_appointment(appointment: AppointmentIn, db=Depends(get_db)):
+    return await run_db(db, _add_appointment, appointment)
+
+@app.get('/surgeries', response_model=List[SurgeryOut])
+async def list_surgeries(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False,
+                         fields: Optional[str] = None, ids: Optional[str] = None, db=Depends(get_db)):
+    after = _after(cursor, (str, int))
+    selected = _fields('surgeries', fields)
+    wanted = _ids(ids, cursor, stream)
+    if wanted is not None:
+        return fastjson.FastJSONResponse(await run_db(db, projections.get_surgeries, wanted, fields=selected))
+    if stream:
+        return _stream_ndjson(functools.partial(projections.iter_surgeries, fields=selected), after, db.info.get('replica'))
+    surgeries = await run_db(db, projections.list_surgeries, limit + 1, after, fields=selected)
+    return _page(surgeries, limit, lambda s: (s['title'], s['id']))
+
 
 @app.post('/surgeries', response_model=SurgeryOut, status_code=201)
-def create_surgery(surgery: SurgeryIn, db: Session = Depends(get_db)):
-    new_surgery = models.Surgery(**surgery.dict())
-    db.add(new_surgery)
-    db.commit()
-    db.refresh(new_surgery)
+async def create_surgery(surgery: SurgeryIn, db=Depends(get_db)):
+    new_surgery = await crud_async.create_surgery(db, **surgery.dict(), out=SurgeryOut)
     return new_surgery
 
+@app.get('/dentists', response_model=List[DentistOut])
+async def list_dentists(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False,
+                        fields: Optional[str] = None, include: Optional[str] = None, ids: Optional[str] = None,
+                        db=Depends(get_db)):
+    # include=address nests each dentist's address, as /patients does
+    after = _after(cursor, (str, int))
+    projection = dict(fields=_fields('dentists', fields), address='address' in _include(include, ('address',)))
+    wanted = _ids(ids, cursor, stream)
+    if wanted is not None:
+        return fastjson.FastJSONResponse(await run_db(db, projections.get_dentists, wanted, **projection))
+    if stream:
+        return _stream_ndjson(functools.partial(projections.iter_dentists, **projection), after, db.info.get('replica'))
+    dentists = await run_db(db, projections.list_dentists, limit + 1, after, **projection)
+    return _page(dentists, limit, lambda d: (d['last_name'], d['id']))
+
+
 @app.post('/dentists', response_model=DentistOut, status_code=201)
-def create_dentist(dentist: DentistIn, db: Session = Depends(get_db)):
-    new_dentist = models.Dentist(**dentist.dict())
-    db.add(new_dentist)
+async def create_dentist(dentist: DentistIn, db=Depends(get_db)):
+    new_dentist = await crud_async.create_dentist(db, **dentist.dict(), out=DentistOut)
+    return new_dentist
+
+
+def _set_working_hours(db: Session, dentist_id: int, hours: List[WorkingHoursIn]):
+    dentist = crud.get_dentist(db, dentist_id)
+    if not dentist:
+        raise HTTPException(status_code=404, detail='Dentist not found')
+    dentist.working_hours = [models.WorkingHours(**h.dict()) for h in hours]
     db.commit()
-    db.refresh(new_dentist)
-    return new_dentist
\ No newline at end of file
+    return [h.dict() for h in hours]
+
+
+@app.put('/dentists/{dentist_id}/working-hours', response_model=List[WorkingHoursIn])
+async def set_working_hours(dentist_id: int, hours: List[WorkingHoursIn], db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    for h in hours:
+        if h.starts_at >= h.ends_at:
+            raise HTTPException(status_code=422, detail='starts_at must be before ends_at')
+    return await run_db(db, _set_working_hours, dentist_id, hours)
+
+
+def _dentist_availability(db: Session, dentist_id: int, start: datetime, end: datetime, slot_minutes: int):
+    if not crud.get_dentist(db, dentist_id):
+        raise HTTPException(status_code=404, detail='Dentist not found')
+    slots = availability.free_slots(db, dentist_id, start, end, slot_minutes)
+    return {'dentist_id': dentist_id, 'slots': [{'start': s, 'end': e} for s, e in slots]}
+
+
+@app.get('/dentists/{dentist_id}/availability', response_model=AvailabilityOut)
+async def dentist_availability(dentist_id: int, start: datetime = Query(..., alias='from'), end: datetime = Query(..., alias='to'),
+                               slot_minutes: int = Query(availability.DEFAULT_DURATION_MINUTES, ge=5, le=availability.MAX_DURATION_MINUTES),
+                               db=Depends(get_db)):
+    start, end = _range(start, end)
+    if end - start > timedelta(days=availability.MAX_AVAILABILITY_DAYS):
+        raise HTTPException(status_code=422, detail=f'Range is limited to {availability.MAX_AVAILABILITY_DAYS} days')
+    return await run_db(db, _dentist_availability, dentist_id, start, end, slot_minutes)
+
+
+class StatOut(BaseModel):
+    key: Optional[str]  # dentist or surgery id, or city (null for patients without an address)
+    period: date
+    appointments: int
+    minutes: int
+
+
+_STAT_DIMENSIONS = {'dentists': 'dentist', 'surgeries': 'surgery', 'cities': 'city'}
+
+
+@app.get('/stats/{dimension}', response_model=List[StatOut])
+async def appointment_stats(dimension: Literal['dentists', 'surgeries', 'cities'], period: Literal['day', 'week'] = 'day',
+                            start: Optional[date] = Query(None, alias='from'), end: Optional[date] = Query(None, alias='to'),
+                            key: Optional[str] = None, db=Depends(get_db)):
+    # served from the daily rollups (see rollups), so the cost depends on the range, not the history
+    if start is None:
+        today = date.today()
+        start = today - timedelta(days=today.weekday())
+    if period == 'week':
+        start -= timedelta(days=start.weekday())
+    end = end or start + timedelta(days=7)
+    if end <= start:
+        raise HTTPException(status_code=422, detail="'to' must be after 'from'")
+    if end - start > timedelta(days=rollups.STATS_MAX_DAYS):
+        raise HTTPException(status_code=422, detail=f'Range is limited to {rollups.STATS_MAX_DAYS} days')
+    rows = await run_db(db, rollups.stats, _STAT_DIMENSIONS[dimension], start, end, period, key)
+    return [dict(row, key=row['key'] or None) for row in rows]
+
+
+# --- Change feed ---
+class ChangeOut(BaseModel):
+    seq: int
+    entity: str  # addresses, patients, dentists or surgeries
+    id: int
+    op: Literal['insert', 'update', 'delete']
+    data: Optional[dict]  # the inserted row or the updated columns; null for deletes
+    at: datetime
+
+
+def _entities(value: Optional[str]):
+    try:
+        return changefeed.parse_entities(value)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.get('/changes', response_model=List[ChangeOut])
+async def list_changes(since: int = Query(0, ge=0), limit: int = Query(changefeed.CHANGE_FEED_PAGE_SIZE, ge=1, le=changefeed.CHANGE_FEED_MAX_PAGE_SIZE),
+                       entities: Optional[str] = None, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    # a full page means more may follow: ask again with the last seq
+    kinds = _entities(entities)
+    try:
+        rows, head = await run_db(db, changefeed.read, since, limit, kinds)
+    except changefeed.Expired as e:
+        raise HTTPException(status_code=410, detail=str(e), headers={changefeed.HEAD_HEADER: str(e.head)})
+    return fastjson.FastJSONResponse(rows, headers={changefeed.HEAD_HEADER: str(head)})
+
+
+@app.websocket('/changes/ws')
+async def changes_socket(websocket: WebSocket, since: int = Query(0, ge=0), entities: Optional[str] = None,
+                         user: auth.Principal = Depends(auth.require_roles_ws(['admin','staff']))):
+    try:
+        kinds = changefeed.parse_entities(entities)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    await websocket.accept()
+    await changefeed.stream(websocket, since, kinds)
+
+
+# --- Bulk ingest ---
+_BULK_ADDRESSES = bulk.BulkSpec(models.Address, AddressIn)
+_BULK_PATIENTS = bulk.BulkSpec(models.Patient, PatientIn, refs={'address_id': models.Address}, unique=('email',),
+                               address_schema=AddressIn, address_model=models.Address)
+_BULK_DENTISTS = bulk.BulkSpec(models.Dentist, DentistIn, refs={'address_id': models.Address}, unique=('email',),
+                               address_schema=AddressIn, address_model=models.Address)
+_BULK_APPOINTMENTS = bulk.BulkSpec(models.Appointment, AppointmentIn,
+                                   refs={'patient_id': models.Patient, 'dentist_id': models.Dentist, 'surgery_id': models.Surgery},
+                                   on_insert=rollups.track_inserted, check=availability.batch_conflicts)
+
+
+async def _bulk_ingest(request: Request, db, spec: bulk.BulkSpec):
+    # body may be a JSON array, NDJSON or CSV (by Content-Type); rows are committed batch by batch
+    try:
+        rows = bulk.parse(request.headers.get('content-type'), request.stream())
+    except bulk.BulkFormatError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    try:
+        return await bulk.ingest(rows, lambda batch: run_db(db, bulk.insert_batch, spec, batch))
+    except bulk.BulkFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post('/addresses/bulk')
+async def bulk_create_addresses(request: Request, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    return await _bulk_ingest(request, db, _BULK_ADDRESSES)
+
+
+@app.post('/patients/bulk')
+async def bulk_create_patients(request: Request, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    result = await _bulk_ingest(request, db, _BULK_PATIENTS)
+    # rows went in through Core inserts, which the in-process search index does not observe
+    search.invalidate()
+    return result
+
+
+@app.post('/dentists/bulk')
+async def bulk_create_dentists(request: Request, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    return await _bulk_ingest(request, db, _BULK_DENTISTS)
+
+
+@app.post('/appointments/bulk')
+async def bulk_create_appointments(request: Request, db=Depends(get_db), user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    return await _bulk_ingest(request, db, _BULK_APPOINTMENTS)
+
+
+# --- Export ---
+@app.get('/export/{dataset}')
+def export_dataset(request: Request, dataset: str, format: Literal['csv', 'ndjson'] = 'csv', gzip: bool = False,
+                   updated_since: Optional[datetime] = None, user: auth.Principal = Depends(auth.require_roles(['admin','staff']))):
+    if dataset not in exports.DATASETS:
+        raise HTTPException(status_code=404, detail='Unknown dataset')
+    if updated_since is not None:
+        updated_since = availability.naive_utc(updated_since)  # updated_at is naive UTC
+
+    replica = database.replica_for(request)
+
+    def body():
+        # owns its session for the life of the stream, like _stream_ndjson
+        db = get_session(replica)
+        try:
+            chunks = exports.iter_export(db, dataset, format, updated_since)
+            yield from (exports.gzip_chunks(chunks) if gzip else chunks)
+        finally:
+            db.close()
+    headers = {'Content-Disposition': f'attachment; filename="{dataset}.{format}"'}
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(body(), media_type=exports.FORMATS[format], headers=headers)
@@ -0,0 +1,184 @@
+"""Archival of old appointments to compressed monthly files.
+
+`archive` moves each month of appointments older than `ARCHIVE_AFTER_MONTHS`
+out of the database into `APPOINTMENT_ARCHIVE_DIR/YYYY-MM.ndjson.gz`: gzip'd
+NDJSON, one file per month, sorted by (scheduled_at, id). On PostgreSQL a month
+with its own partition is detached and dropped whole; otherwise its rows are
+deleted by id. The file is renamed into place before anything is removed, and
+rows found for a month that already has a file are merged into it, so an
+interrupted run can simply be repeated.
+
+`archived_rows` reads archived months back for the history endpoint. Whole
+months are decompressed per request, which makes it slower than the live lists.
+"""
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import date, datetime, time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import delete, select, text
+import fastjson
+import models
+import partitions
+import projections
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv('APPOINTMENT_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive', 'appointments'))
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', 24))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 5000))
+
+ARCHIVE_FIELDS = projections.APPOINTMENT_FIELDS + ('updated_at',)
+_DATETIME_FIELDS = ('scheduled_at', 'updated_at')
+_FILE_NAME = re.compile(r'^(\d{4})-(\d{2})\.ndjson\.gz$')
+
+Row = Dict[str, Any]
+
+
+def month_path(month: date, directory: Optional[str] = None) -> str:
+    return os.path.join(directory or ARCHIVE_DIR, f'{month:%Y-%m}.ndjson.gz')
+
+
+def archived_months(directory: Optional[str] = None) -> List[date]:
+    directory = directory or ARCHIVE_DIR
+    if not os.path.isdir(directory):
+        return []
+    months = []
+    for name in os.listdir(directory):
+        match = _FILE_NAME.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def read_month(month: date, directory: Optional[str] = None) -> Iterator[Row]:
+    with gzip.open(month_path(month, directory), 'rb') as f:
+        for line in f:
+            row = json.loads(line)
+            for field in _DATETIME_FIELDS:
+                if row.get(field) is not None:
+                    row[field] = datetime.fromisoformat(row[field])
+            yield row
+
+
+def _write_month(month: date, rows: Iterable[Row], directory: Optional[str] = None) -> int:
+    path = month_path(month, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    count = 0
+    with open(tmp, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0) as f:
+            for row in rows:
+                f.write(fastjson.dumps(row) + b'\n')
+                count += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+    return count
+
+
+def _month_rows(conn, month: date) -> Iterator[Row]:
+    A, P, Ad = models.Appointment, models.Patient, models.Address
+    # `city` is the patient's city the rollups count the row under; rebuilding keeps it there (see rollups)
+    stmt = (select(*(getattr(A, f) for f in ARCHIVE_FIELDS), Ad.city)
+            .outerjoin(P, P.id == A.patient_id).outerjoin(Ad, Ad.id == P.address_id)
+            .where(A.scheduled_at >= month, A.scheduled_at < partitions.add_months(month, 1))
+            .order_by(A.scheduled_at, A.id))
+    result = conn.execution_options(stream_results=True, yield_per=ARCHIVE_CHUNK_SIZE).execute(stmt)
+    for rows in result.partitions():
+        for row in rows:
+            yield dict(zip(ARCHIVE_FIELDS + ('city',), row))
+
+
+def _archive_month(engine, month: date, directory: Optional[str]) -> int:
+    name = partitions.partition_name(month)
+    with engine.begin() as conn:
+        whole_partition = partitions.is_partitioned(conn) and name in partitions.partitions(conn)
+        if whole_partition:
+            # no writes to the month while it is copied out, so dropping it loses nothing
+            conn.execute(text(f'LOCK TABLE {name} IN SHARE MODE'))
+        ids = []
+
+        def rows():
+            for row in _month_rows(conn, month):
+                ids.append(row['id'])
+                yield row
+
+        if os.path.exists(month_path(month, directory)):
+            # a previous run was interrupted, or rows were backdated into an archived month
+            merged = {row['id']: row for row in read_month(month, directory)}
+            merged.update((row['id'], row) for row in rows())
+            written = _write_month(month, sorted(merged.values(), key=lambda r: (r['scheduled_at'], r['id'])), directory)
+        else:
+            written = _write_month(month, rows(), directory)
+
+        if whole_partition:
+            conn.execute(text(f'ALTER TABLE {partitions.PARENT} DETACH PARTITION {name}'))
+            conn.execute(text(f'DROP TABLE {name}'))
+        else:
+            A = models.Appointment
+            for i in range(0, len(ids), 500):
+                conn.execute(delete(A).where(A.id.in_(ids[i:i + 500])))
+    logger.info('archived %s: %d rows moved, %d in the file', f'{month:%Y-%m}', len(ids), written)
+    return len(ids)
+
+
+def archive(engine, older_than_months: int = ARCHIVE_AFTER_MONTHS, today: Optional[date] = None,
+            directory: Optional[str] = None, dry_run: bool = False) -> Dict[str, int]:
+    """Move every month older than the horizon to the archive; returns rows moved per month."""
+    cutoff = partitions.add_months(partitions.month_start(today or datetime.utcnow()), -older_than_months)
+    A = models.Appointment
+    with engine.connect() as conn:
+        oldest = conn.execute(select(A.scheduled_at).where(A.scheduled_at < cutoff).order_by(A.scheduled_at).limit(1)).scalar()
+    moved: Dict[str, int] = {}
+    month = partitions.month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        if dry_run:
+            with engine.connect() as conn:
+                moved[f'{month:%Y-%m}'] = sum(1 for _ in _month_rows(conn, month))
+        else:
+            moved[f'{month:%Y-%m}'] = _archive_month(engine, month, directory)
+        month = partitions.add_months(month, 1)
+    return moved
+
+
+# --- reading the archive back ---
+
+def _matches(row: Row, dentist_id, patient_id, surgery_id, start, end, after) -> bool:
+    return ((dentist_id is None or row['dentist_id'] == dentist_id)
+            and (patient_id is None or row['patient_id'] == patient_id)
+            and (surgery_id is None or row['surgery_id'] == surgery_id)
+            and (start is None or row['scheduled_at'] >= start)
+            and (end is None or row['scheduled_at'] < end)
+            and (after is None or (row['scheduled_at'], row['id']) > tuple(after)))
+
+
+def archived_rows(limit: int, after: Optional[Sequence[Any]] = None, dentist_id: Optional[int] = None,
+                  patient_id: Optional[int] = None, surgery_id: Optional[int] = None, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None, directory: Optional[str] = None) -> List[Row]:
+    """Up to `limit` archived appointments matching the filters, in (scheduled_at, id) order."""
+    lower = max((d for d in (start, after[0] if after else None) if d is not None), default=None)
+    out: List[Row] = []
+    for month in archived_months(directory):
+        if end is not None and datetime.combine(month, time()) >= end:
+            break
+        if lower is not None and datetime.combine(partitions.add_months(month, 1), time()) <= lower:
+            continue
+        for row in read_month(month, directory):
+            if _matches(row, dentist_id, patient_id, surgery_id, start, end, after):
+                out.append({f: row.get(f) for f in projections.APPOINTMENT_FIELDS})
+                if len(out) >= limit:
+                    return out
+    return out
+
+
+def merge_history(live: List[Row], archived: List[Row], limit: int) -> List[Row]:
+    """Live and archived rows in key order, each flagged; a row in both (a half-finished run) counts as live."""
+    live_ids = {row['id'] for row in live}
+    rows = [dict(row, archived=False) for row in live] + [dict(row, archived=True) for row in archived
+                                                          if row['id'] not in live_ids]
+    rows.sort(key=lambda r: (r['scheduled_at'], r['id']))
+    return rows[:limit]
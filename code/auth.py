@@ -1,12 +1,14 @@
 from datetime import datetime, timedelta
 from typing import Optional, List
-from passlib.context import CryptContext
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, WebSocket, WebSocketException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 import crud, models
-from database import get_session
+import principals
+import hashing
+from principals import Principal
+from database import get_db, open_db, run_db
 import os
 from dotenv import load_dotenv
 
@@ -16,9 +18,11 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "secret")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60 * 24))
+# When enabled, the signed `roles` claim is trusted and authorization needs no DB lookup;
+# role changes then only take effect once the user's existing tokens expire.
+TRUST_TOKEN_ROLES = os.getenv("TRUST_TOKEN_ROLES", "false").lower() in ("1", "true", "yes")
 
-# Use pbkdf2_sha256 to avoid bcrypt backend installation/version issues and 72-byte limit
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+pwd_context = hashing.pwd_context
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/adsweb/api/v1/auth/token")
 
 
@@ -30,8 +34,10 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None, roles: Optional[List[str]] = None):
     to_encode = data.copy()
+    if roles is not None:
+        to_encode["roles"] = sorted(roles)
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
@@ -41,9 +47,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
-    q = db.query(models.User).filter(models.User.username == username).first()
-    return q
+def get_user_by_username(db: Session, username: str, with_roles: bool = False) -> Optional[models.User]:
+    q = db.query(models.User)
+    if with_roles:
+        q = q.options(selectinload(models.User.roles))
+    return q.filter(models.User.username == username).first()
 
 
 def authenticate_user(db: Session, username: str, password: str) -> Optional[models.User]:
@@ -55,29 +63,84 @@ def authenticate_user(db: Session, username: str, password: str) -> Optional[mod
     return user
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_session)) -> models.User:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def _store_rehash(db: Session, user: models.User, new_hash: str) -> None:
+    user.hashed_password = new_hash
+    db.commit()
+
+
+async def authenticate_user_async(db: Session, username: str, password: str) -> Optional[Principal]:
+    # only the hash runs in the hashing process pool; DB work goes through run_db
+    user = await run_db(db, get_user_by_username, username, True)
+    if not user:
+        return None
+    ok, new_hash = await hashing.verify_and_update(password, user.hashed_password)
+    if not ok:
+        return None
+    principal = Principal.from_user(user)
+    if new_hash:
+        await run_db(db, _store_rehash, user, new_hash)
+    principals.cache.put(principal)
+    return principal
+
+
+async def principal_for_token(token: str, db) -> Optional[Principal]:
+    """The principal a bearer token stands for; None if the token is invalid or its user is gone."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    user = get_user_by_username(db, username)
-    if user is None:
-        raise credentials_exception
-    return user
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+    roles = payload.get("roles")
+    if TRUST_TOKEN_ROLES and isinstance(roles, list):
+        return Principal(id=payload.get("uid"), username=username, roles=frozenset(roles))
+    principal = principals.cache.get(username)
+    if principal is None:
+        user = await run_db(db, get_user_by_username, username, True)
+        if user is None:
+            return None
+        principal = Principal.from_user(user)
+        principals.cache.put(principal)
+    return principal
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db=Depends(get_db)) -> Principal:
+    principal = await principal_for_token(token, db)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
 
 
 def require_roles(required: List[str]):
-    def inner(user: models.User = Depends(get_current_user)):
-        user_roles = {r.name for r in user.roles}
-        if not any(r in user_roles for r in required):
+    async def inner(user: Principal = Depends(get_current_user)):
+        if not any(r in user.roles for r in required):
             raise HTTPException(status_code=403, detail="Insufficient privileges")
         return user
     return inner
+
+
+def require_roles_ws(required: List[str]):
+    """require_roles for WebSocket routes; refuses the handshake with 1008 (policy violation).
+
+    The token comes from the `token` query parameter, since browsers cannot set headers on a
+    WebSocket, or from an `Authorization: Bearer` header.
+    """
+    async def inner(websocket: WebSocket, token: Optional[str] = Query(None)):
+        if token is None:
+            scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+            token = credentials if scheme.lower() == "bearer" else None
+        principal = None
+        if token:
+            async with open_db() as db:
+                principal = await principal_for_token(token, db)
+        if principal is None:
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+        if not any(r in principal.roles for r in required):
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Insufficient privileges")
+        return principal
+    return inner
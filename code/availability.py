@@ -0,0 +1,203 @@
+"""Dentist availability and appointment conflict detection.
+
+An appointment occupies [scheduled_at, scheduled_at + duration). Durations are
+capped at `MAX_DURATION_MINUTES`, so every appointment that can overlap a
+window starts inside [window start - max duration, window end) and one range
+scan on (dentist_id, scheduled_at) / (surgery_id, scheduled_at) finds them all.
+
+Times are naive UTC throughout, as stored; `naive_utc` converts aware input.
+
+On PostgreSQL a booking takes a transaction-scoped advisory lock per dentist and
+surgery before checking for conflicts; on SQLite it inserts first (taking the
+database write lock) and checks afterwards. Bulk ingest checks a whole batch
+with `batch_conflicts`, under the same locks.
+"""
+import os
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import or_, select, text
+from sqlalchemy.orm import Session
+import crud
+import models
+import rollups
+
+DEFAULT_DURATION_MINUTES = int(os.getenv("APPOINTMENT_DEFAULT_MINUTES", 30))
+MAX_DURATION_MINUTES = int(os.getenv("APPOINTMENT_MAX_MINUTES", 480))
+MAX_AVAILABILITY_DAYS = int(os.getenv("AVAILABILITY_MAX_DAYS", 62))
+
+# Used for dentists without configured working hours: Monday-Friday, CLINIC_OPENS-CLINIC_CLOSES
+DEFAULT_OPENS = time.fromisoformat(os.getenv("CLINIC_OPENS", "09:00"))
+DEFAULT_CLOSES = time.fromisoformat(os.getenv("CLINIC_CLOSES", "17:00"))
+DEFAULT_WORKDAYS = tuple(range(5))
+
+# advisory lock namespaces (first key of pg_advisory_xact_lock(int, int))
+_DENTIST_LOCK = 1
+_SURGERY_LOCK = 2
+
+Interval = Tuple[datetime, datetime]
+
+
+class BookingConflict(Exception):
+    def __init__(self, appointment: models.Appointment):
+        # copied out: the appointment is expired by the rollback that follows
+        self.appointment_id = appointment.id
+        self.scheduled_at = appointment.scheduled_at
+        super().__init__(f"conflicts with appointment {self.appointment_id} at {self.scheduled_at.isoformat()}")
+
+
+def naive_utc(value: datetime) -> datetime:
+    """`value` as naive UTC; naive values are taken to be UTC already."""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def duration_of(appointment) -> timedelta:
+    return timedelta(minutes=appointment.duration_minutes or DEFAULT_DURATION_MINUTES)
+
+
+def overlapping(db: Session, start: datetime, end: datetime, dentist_id: Optional[int] = None,
+                surgery_id: Optional[int] = None, exclude_id: Optional[int] = None) -> List[models.Appointment]:
+    """Appointments of the dentist or in the surgery that overlap [start, end), in one indexed query."""
+    A = models.Appointment
+    owners = []
+    if dentist_id is not None:
+        owners.append(A.dentist_id == dentist_id)
+    if surgery_id is not None:
+        owners.append(A.surgery_id == surgery_id)
+    if not owners:
+        return []
+    stmt = select(A).where(
+        or_(*owners),
+        A.scheduled_at < end,
+        A.scheduled_at > start - timedelta(minutes=MAX_DURATION_MINUTES),
+    )
+    if exclude_id is not None:
+        stmt = stmt.where(A.id != exclude_id)
+    candidates = db.execute(stmt.order_by(A.scheduled_at)).scalars().all()
+    return [a for a in candidates if a.scheduled_at + duration_of(a) > start]
+
+
+def _lock_for_booking(db: Session, dentist_id: int, surgery_id: Optional[int]) -> None:
+    # transaction-scoped, so released by the commit/rollback; fixed key order avoids deadlocks
+    keys = [(_DENTIST_LOCK, dentist_id)] + ([(_SURGERY_LOCK, surgery_id)] if surgery_id is not None else [])
+    for namespace, key in keys:
+        db.execute(text("SELECT pg_advisory_xact_lock(:ns, :key)"), {"ns": namespace, "key": key})
+
+
+def _lock_for_batch(db: Session, keys: Sequence[Tuple[int, int]]) -> None:
+    if db.get_bind().dialect.name == "postgresql":
+        # ascending (namespace, key), the order book() takes its two locks in
+        for namespace, key in sorted(set(keys)):
+            db.execute(text("SELECT pg_advisory_xact_lock(:ns, :key)"), {"ns": namespace, "key": key})
+    else:
+        # a write that changes nothing takes SQLite's write lock, so no booking commits before the batch does
+        db.execute(text(f"UPDATE {models.Appointment.__tablename__} SET id = id WHERE 0"))
+
+
+def batch_conflicts(db: Session, rows: Sequence[Tuple[int, dict, Any]]) -> Dict[int, str]:
+    """Row number -> error for bulk rows overlapping a booked appointment or an earlier row of the batch.
+
+    Takes the booking locks first; the batch must be inserted in the same transaction.
+    """
+    if not rows:
+        return {}
+
+    def owners(row):
+        return [(_DENTIST_LOCK, row["dentist_id"])] + (
+            [(_SURGERY_LOCK, row["surgery_id"])] if row.get("surgery_id") is not None else [])
+
+    def interval(row):
+        return row["scheduled_at"], row["scheduled_at"] + timedelta(minutes=row.get("duration_minutes") or DEFAULT_DURATION_MINUTES)
+
+    _lock_for_batch(db, [key for _, row, _ in rows for key in owners(row)])
+    A = models.Appointment
+    dentists = {row["dentist_id"] for _, row, _ in rows}
+    surgeries = {row["surgery_id"] for _, row, _ in rows if row.get("surgery_id") is not None}
+    start = min(row["scheduled_at"] for _, row, _ in rows)
+    end = max(interval(row)[1] for _, row, _ in rows)
+    stmt = select(A.id, A.dentist_id, A.surgery_id, A.scheduled_at, A.duration_minutes).where(
+        or_(A.dentist_id.in_(dentists), *([A.surgery_id.in_(surgeries)] if surgeries else [])),
+        A.scheduled_at < end,
+        A.scheduled_at > start - timedelta(minutes=MAX_DURATION_MINUTES),
+    )
+    booked: Dict[Tuple[int, int], List[Tuple[datetime, datetime, str]]] = defaultdict(list)
+    for a in db.execute(stmt):
+        busy = (a.scheduled_at, a.scheduled_at + duration_of(a), f"appointment {a.id} at {a.scheduled_at.isoformat()}")
+        for key in owners(a._mapping):
+            booked[key].append(busy)
+    bad = {}
+    for n, row, _ in rows:
+        row_start, row_end = interval(row)
+        clash = next((what for key in owners(row) for busy_start, busy_end, what in booked[key]
+                      if busy_start < row_end and busy_end > row_start), None)
+        if clash is not None:
+            bad[n] = f"conflicts with {clash}"
+            continue
+        for key in owners(row):
+            booked[key].append((row_start, row_end, f"row {n}"))
+    return bad
+
+
+def book(db: Session, data: dict) -> models.Appointment:
+    """Insert an appointment unless it overlaps another for the same dentist or surgery.
+
+    Missing patient/dentist/surgery rows surface as `crud.ReferenceNotFound` from the insert.
+    """
+    start = data["scheduled_at"]
+    end = start + timedelta(minutes=data.get("duration_minutes") or DEFAULT_DURATION_MINUTES)
+    if db.get_bind().dialect.name == "postgresql":
+        _lock_for_booking(db, data["dentist_id"], data.get("surgery_id"))
+        clashes = overlapping(db, start, end, data["dentist_id"], data.get("surgery_id"))
+        appointment = None if clashes else crud.insert_returning(db, models.Appointment, data)
+    else:
+        # SQLite has a single writer: inserting first takes the write lock, so a
+        # concurrent booking cannot commit between our check and our commit
+        appointment = crud.insert_returning(db, models.Appointment, data)
+        clashes = overlapping(db, start, end, data["dentist_id"], data.get("surgery_id"), appointment.id)
+    if clashes:
+        conflict = BookingConflict(clashes[0])
+        db.rollback()
+        raise conflict
+    rollups.track(db, appointment)
+    return crud.commit_returning(db, appointment)
+
+
+# --- free slots ---
+
+def _working_intervals(hours: Sequence[models.WorkingHours], day: date) -> List[Interval]:
+    if hours:
+        spans = [(h.starts_at, h.ends_at) for h in hours if h.weekday == day.weekday()]
+    elif day.weekday() in DEFAULT_WORKDAYS:
+        spans = [(DEFAULT_OPENS, DEFAULT_CLOSES)]
+    else:
+        spans = []
+    return sorted((datetime.combine(day, s), datetime.combine(day, e)) for s, e in spans if s < e)
+
+
+def free_slots(db: Session, dentist_id: int, start: datetime, end: datetime,
+               slot_minutes: int = DEFAULT_DURATION_MINUTES) -> List[Interval]:
+    """Slots of `slot_minutes` within the dentist's working hours in [start, end) that are not booked."""
+    hours = db.execute(select(models.WorkingHours).where(models.WorkingHours.dentist_id == dentist_id)).scalars().all()
+    busy = sorted((a.scheduled_at, a.scheduled_at + duration_of(a)) for a in overlapping(db, start, end, dentist_id))
+    slot = timedelta(minutes=slot_minutes)
+    slots: List[Interval] = []
+    day = start.date()
+    while day <= end.date():
+        for open_at, close_at in _working_intervals(hours, day):
+            cursor = max(open_at, start)
+            close_at = min(close_at, end)
+            for busy_start, busy_end in busy:
+                if busy_end <= cursor or busy_start >= close_at:
+                    continue
+                while cursor + slot <= min(busy_start, close_at):
+                    slots.append((cursor, cursor + slot))
+                    cursor += slot
+                cursor = max(cursor, busy_end)
+            while cursor + slot <= close_at:
+                slots.append((cursor, cursor + slot))
+                cursor += slot
+        day += timedelta(days=1)
+    return slots
@@ -0,0 +1,334 @@
+"""Bulk ingest for the `POST /<entity>/bulk` endpoints.
+
+Request bodies are parsed incrementally (JSON array, NDJSON or CSV), validated
+and inserted in batches of `BULK_BATCH_SIZE` rows with one multi-row
+`INSERT ... RETURNING` per batch. Foreign keys and unique columns are checked
+with one query per batch, so bad rows are reported individually instead of
+failing the whole batch; each batch is committed on its own.
+"""
+import codecs
+import csv
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import changefeed
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 1000))
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", 1000))
+
+JSON_TYPES = ("application/json",)
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_TYPES = ("text/csv", "application/csv")
+
+
+class BulkFormatError(ValueError):
+    pass
+
+
+@dataclass
+class BulkSpec:
+    model: Any
+    schema: Type
+    # column -> model the value must reference
+    refs: Dict[str, Any] = field(default_factory=dict)
+    # columns with a unique constraint, checked against the table and within the batch
+    unique: Sequence[str] = ()
+    # schema for an inline `address` object, created once per distinct value in a batch
+    address_schema: Optional[Type] = None
+    address_model: Any = None
+    # called with the session and the inserted rows before each batch commits (e.g. rollups.track)
+    on_insert: Optional[Callable[[Session, List[dict]], None]] = None
+    # called with the rows that passed the checks, before they are inserted; returns row number -> error
+    # for the rows to reject (e.g. availability.batch_conflicts)
+    check: Optional[Callable[[Session, List[Tuple[int, dict, Any]]], Dict[int, str]]] = None
+
+
+# --- parsing ---
+
+async def _text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # incremental so a multi-byte character split across chunks decodes correctly
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buf = ""
+    async for text in _text(chunks):
+        buf += text
+        *complete, buf = buf.split("\n")
+        for line in complete:
+            yield line
+    if buf:
+        yield buf
+
+
+async def _ndjson(chunks):
+    n = 0
+    async for line in _lines(chunks):
+        if not line.strip():
+            continue
+        n += 1
+        try:
+            yield n, json.loads(line)
+        except ValueError as e:
+            yield n, BulkFormatError(f"invalid JSON: {e}")
+
+
+async def _csv_records(chunks):
+    # a quoted field may span lines; keep joining lines until the quotes balance
+    pending = []
+    async for line in _lines(chunks):
+        pending.append(line)
+        joined = "\n".join(pending)
+        if joined.count('"') % 2 == 0:
+            pending = []
+            yield joined
+    if pending:
+        yield "\n".join(pending)
+
+
+async def _csv(chunks):
+    header = None
+    n = 0
+    async for record in _csv_records(chunks):
+        if not record.strip():
+            continue
+        values = next(csv.reader([record]))
+        if header is None:
+            header = [h.strip() for h in values]
+            continue
+        n += 1
+        if len(values) != len(header):
+            yield n, BulkFormatError(f"expected {len(header)} columns, got {len(values)}")
+            continue
+        # empty CSV cells mean "not provided"
+        yield n, {k: v for k, v in zip(header, values) if v != ""}
+
+
+async def _json_array(chunks):
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    n = 0
+    async for text in _text(chunks):
+        buf += text
+        while True:
+            buf = buf.lstrip()
+            if not started:
+                if not buf:
+                    break
+                if buf[0] != "[":
+                    raise BulkFormatError("expected a JSON array")
+                started = True
+                buf = buf[1:]
+                continue
+            if buf.startswith(","):
+                buf = buf[1:]
+                continue
+            if buf.startswith("]") or not buf:
+                break
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except ValueError:
+                break  # incomplete object; wait for more data
+            n += 1
+            yield n, obj
+            buf = buf[end:]
+    if buf.strip() not in ("]", ""):
+        raise BulkFormatError("malformed JSON array")
+
+
+def parse(content_type: str, chunks: AsyncIterator[bytes]):
+    """Return an async iterator of (row number, dict or BulkFormatError) for the request body."""
+    media = (content_type or "application/json").split(";")[0].strip().lower()
+    if media in NDJSON_TYPES:
+        return _ndjson(chunks)
+    if media in CSV_TYPES:
+        return _csv(chunks)
+    if media in JSON_TYPES:
+        return _json_array(chunks)
+    raise BulkFormatError(f"unsupported content type {media}")
+
+
+# --- batch insert ---
+
+def _describe(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in err['loc']) or 'row'}: {err['msg']}" for err in e.errors())
+
+
+def _existing(db: Session, column, values) -> set:
+    if not values:
+        return set()
+    return set(db.execute(select(column).where(column.in_(values))).scalars())
+
+
+def _validate_addresses(spec: BulkSpec, rows: List[Tuple[int, dict, Any]], errors: List[dict]):
+    # inline addresses are validated up front but inserted only for rows that pass every check
+    valid = []
+    for n, row, raw in rows:
+        if raw is not None:
+            try:
+                raw = spec.address_schema(**raw).model_dump()
+            except (ValidationError, TypeError) as e:
+                errors.append({"row": n, "error": f"address: {_describe(e) if isinstance(e, ValidationError) else e}"})
+                continue
+            row["address_id"] = None  # set by _insert_addresses
+        valid.append((n, row, raw))
+    rows[:] = valid
+
+
+def _insert_addresses(db: Session, spec: BulkSpec, rows: List[Tuple[int, dict, Any]]) -> Tuple[List[int], List[dict]]:
+    # once per distinct inline address; returns (ids, rows) for the change feed, recorded once they are sure to stay
+    distinct: Dict[tuple, List[dict]] = {}
+    for _, row, address in rows:
+        if address is not None:
+            distinct.setdefault(tuple(address.items()), []).append(row)
+    if not distinct:
+        return [], []
+    addresses = [dict(k) for k in distinct]
+    ids = db.execute(insert(spec.address_model).returning(spec.address_model.id, sort_by_parameter_order=True),
+                     addresses).scalars().all()
+    for rows_at, address_id in zip(distinct.values(), ids):
+        for row in rows_at:
+            row["address_id"] = address_id
+    return ids, addresses
+
+
+def _check_constraints(db: Session, spec: BulkSpec, rows: List[Tuple[int, dict, Any]], errors: List[dict]):
+    bad = {}
+    for column, target in spec.refs.items():
+        wanted = {row[column] for _, row, _ in rows if row.get(column) is not None}
+        missing = wanted - _existing(db, target.id, wanted)
+        for n, row, _ in rows:
+            if row.get(column) in missing:
+                bad.setdefault(n, f"{column} {row[column]} not found")
+    for column in spec.unique:
+        seen = set()
+        values = {row[column] for _, row, _ in rows if row.get(column) is not None}
+        taken = _existing(db, getattr(spec.model, column), values)
+        for n, row, _ in rows:
+            v = row.get(column)
+            if v is None:
+                continue
+            if v in taken or v in seen:
+                bad.setdefault(n, f"{column} {v!r} already exists")
+            seen.add(v)
+    _reject(rows, errors, bad)
+
+
+def _reject(rows: List[Tuple[int, dict, Any]], errors: List[dict], bad: Dict[int, str]):
+    for n, message in sorted(bad.items()):
+        errors.append({"row": n, "error": message})
+    rows[:] = [r for r in rows if r[0] not in bad]
+
+
+def _insert_rows_individually(db: Session, spec: BulkSpec, rows, errors: List[dict]):
+    """Insert row by row, each with its inline address in the same savepoint; returns (address ids, addresses, ids, rows)."""
+    # only reached when a concurrent writer beats the batch checks; isolate the offending rows
+    address_ids, addresses, ids, inserted = [], [], [], []
+    shared: Dict[tuple, int] = {}  # inline address -> id, once a row using it is in
+    for n, row, address in rows:
+        key = tuple(address.items()) if address is not None else None
+        new_address = ([], [])
+        try:
+            with db.begin_nested():
+                if key in shared:
+                    row["address_id"] = shared[key]
+                elif key is not None:
+                    new_address = _insert_addresses(db, spec, [(n, row, address)])
+                ids.append(db.execute(insert(spec.model).returning(spec.model.id), row).scalar_one())
+        except IntegrityError as e:
+            errors.append({"row": n, "error": str(e.orig)})
+            continue
+        if new_address[0]:
+            shared[key] = new_address[0][0]
+            address_ids += new_address[0]
+            addresses += new_address[1]
+        inserted.append(row)
+    return address_ids, addresses, ids, inserted
+
+
+def insert_batch(db: Session, spec: BulkSpec, batch: List[Tuple[int, Any]]) -> Tuple[List[int], List[dict]]:
+    """Validate and insert one batch; returns (new ids, per-row errors). Commits on success."""
+    errors: List[dict] = []
+    rows: List[Tuple[int, dict, Any]] = []
+    for n, raw in batch:
+        if isinstance(raw, Exception):
+            errors.append({"row": n, "error": str(raw)})
+            continue
+        if not isinstance(raw, dict):
+            errors.append({"row": n, "error": "expected an object"})
+            continue
+        raw = dict(raw)
+        inline_address = raw.pop("address", None) if spec.address_schema else None
+        try:
+            rows.append((n, spec.schema(**raw).model_dump(), inline_address))
+        except ValidationError as e:
+            errors.append({"row": n, "error": _describe(e)})
+    try:
+        if spec.address_schema:
+            _validate_addresses(spec, rows, errors)
+        _check_constraints(db, spec, rows, errors)
+        if spec.check is not None:
+            _reject(rows, errors, spec.check(db, rows))
+        address_ids: List[int] = []
+        addresses: List[dict] = []
+        ids: List[int] = []
+        inserted = [row for _, row, _ in rows]
+        if rows:
+            try:
+                # the inline addresses share the batch's savepoint, so a failed batch leaves none behind
+                with db.begin_nested():
+                    if spec.address_schema:
+                        address_ids, addresses = _insert_addresses(db, spec, rows)
+                    ids = db.execute(insert(spec.model).returning(spec.model.id, sort_by_parameter_order=True),
+                                     inserted).scalars().all()
+            except IntegrityError:
+                address_ids, addresses, ids, inserted = _insert_rows_individually(db, spec, rows, errors)
+        if address_ids:
+            changefeed.record_inserted(db, spec.address_model, address_ids, addresses)
+        changefeed.record_inserted(db, spec.model, ids, inserted)
+        if spec.on_insert is not None and inserted:
+            spec.on_insert(db, inserted)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    errors.sort(key=lambda e: e["row"])
+    return ids, errors
+
+
+async def ingest(rows: AsyncIterator[Tuple[int, Any]], run_batch) -> Dict[str, Any]:
+    """Drive `run_batch(batch)` (an awaitable returning insert_batch's result) over the parsed rows."""
+    inserted = 0
+    failed = 0
+    errors: List[dict] = []
+
+    async def flush(batch):
+        nonlocal inserted, failed
+        ids, batch_errors = await run_batch(batch)
+        inserted += len(ids)
+        failed += len(batch_errors)
+        errors.extend(batch_errors[:max(0, BULK_MAX_ERRORS - len(errors))])
+
+    batch: List[Tuple[int, Any]] = []
+    async for item in rows:
+        batch.append(item)
+        if len(batch) >= BULK_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    return {"inserted": inserted, "failed": failed, "errors": errors, "errors_truncated": failed > len(errors)}
@@ -0,0 +1,324 @@
+"""Change feed for incremental client sync.
+
+Offline-capable clients keep local copies of the synced tables (`ENTITIES`)
+and catch up with `GET /changes?since=<seq>`, or have new changes pushed over
+the `/changes/ws` WebSocket, instead of downloading the whole lists again. The
+crud write functions and bulk ingest `record` every insert, update and delete
+of a synced row, and just before the session commits the records are written
+to `change_log` in the same transaction, so the log holds exactly the committed
+changes. An insert carries the new row and an update only the columns it wrote.
+A delete carries nothing.
+
+`seq` increases in commit order. On PostgreSQL, writers take a transaction-scoped
+advisory lock before inserting their records and hold it until they commit.
+SQLite has a single writer anyway. So a client that has seen seq N can never
+miss a lower-numbered change that commits later.
+
+`prune` drops records older than `CHANGE_FEED_RETENTION_DAYS` but always keeps
+the newest one. A `since` older than the oldest record left raises `Expired`
+(410 from the API), and the client must download the lists again.
+"""
+import asyncio
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import delete, event, func, insert, select, text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocket
+import database
+import fastjson
+import models
+
+logger = logging.getLogger(__name__)
+
+# synced tables, by the name clients see in `entity`
+ENTITIES = {m.__tablename__: m for m in (models.Address, models.Patient, models.Dentist, models.Surgery)}
+CHANGE_FEED_PAGE_SIZE = int(os.getenv('CHANGE_FEED_PAGE_SIZE', 500))
+CHANGE_FEED_MAX_PAGE_SIZE = int(os.getenv('CHANGE_FEED_MAX_PAGE_SIZE', 5000))
+CHANGE_FEED_RETENTION_DAYS = int(os.getenv('CHANGE_FEED_RETENTION_DAYS', 30))
+# how often each worker looks for changes committed by the other workers
+CHANGE_FEED_POLL_SECONDS = float(os.getenv('CHANGE_FEED_POLL_SECONDS', 1.0))
+# batches a WebSocket client may fall behind by before it is disconnected (it reconnects with `since`)
+CHANGE_FEED_BUFFER = int(os.getenv('CHANGE_FEED_BUFFER', 100))
+
+HEAD_HEADER = 'X-Change-Head'
+# WebSocket close codes: `since` expired (like 410), and fell too far behind
+CLOSE_EXPIRED = 4410
+CLOSE_TRY_AGAIN = 1013
+
+# pg_advisory_xact_lock key held from writing a transaction's records until it commits
+_FEED_LOCK = 0x66656564
+
+Change = models.Change
+_NAMES = {model: name for name, model in ENTITIES.items()}
+# columns carried in `data`: what the API returns, without id (in `id`) or bookkeeping
+_FIELDS = {model: tuple(c.name for c in model.__table__.columns if c.name not in ('id', 'updated_at'))
+           for model in ENTITIES.values()}
+
+
+class Expired(LookupError):
+    """`since` is older than the retained log; the client must download the lists again, then follow from `head`."""
+
+    def __init__(self, message: str, head: int):
+        super().__init__(message)
+        self.head = head
+
+
+def parse_entities(value: Optional[str]) -> Optional[List[str]]:
+    """Comma-separated entity names from a query string; None for all. Raises ValueError on an unknown one."""
+    if not value:
+        return None
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in ENTITIES]
+    if unknown:
+        raise ValueError(f"Unknown entities: {', '.join(unknown)}; expected some of {', '.join(ENTITIES)}")
+    return names
+
+
+# --- recording ---
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+
+def record(session: Session, model, op: str, entity_id: int, values: Optional[Dict[str, Any]] = None) -> None:
+    """Log an insert, update or delete of row `entity_id` by this session's transaction.
+
+    `values` holds the inserted row or the updated columns. Models that are not synced are ignored.
+    """
+    name = _NAMES.get(model)
+    if name is None:
+        return
+    data = None
+    if op != 'delete':
+        data = {f: _plain(values[f]) for f in _FIELDS[model] if f in values}
+    session.info.setdefault('change_rows', []).append({'entity': name, 'entity_id': entity_id, 'op': op, 'data': data})
+
+
+def record_row(session: Session, obj, op: str = 'insert', fields: Optional[Sequence[str]] = None) -> None:
+    """Log an ORM row as inserted, or as updated in `fields`."""
+    names = _FIELDS.get(type(obj), ()) if fields is None else fields
+    record(session, type(obj), op, obj.id, {f: getattr(obj, f) for f in names})
+
+
+def record_inserted(session: Session, model, ids: Sequence[int], rows: Sequence[Dict[str, Any]]) -> None:
+    for entity_id, row in zip(ids, rows):
+        record(session, model, 'insert', entity_id, row)
+
+
+@event.listens_for(Session, 'before_commit')
+def _write(session):
+    rows = session.info.pop('change_rows', None)
+    if not rows:
+        return
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _FEED_LOCK})
+    changed_at = datetime.utcnow()
+    session.execute(insert(Change), [dict(row, changed_at=changed_at) for row in rows])
+    session.info['change_written'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    if session.info.pop('change_written', False):
+        hub.notify()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    # a rolled back savepoint leaves the enclosing transaction's records to be written
+    if not session.in_transaction():
+        session.info.pop('change_rows', None)
+        session.info.pop('change_written', None)
+
+
+# --- reading ---
+
+def changes_since(db: Session, since: int, limit: int, entities: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """Up to `limit` changes numbered above `since`, oldest first."""
+    stmt = (select(Change.seq, Change.entity, Change.entity_id, Change.op, Change.data, Change.changed_at)
+            .where(Change.seq > since).order_by(Change.seq).limit(limit))
+    if entities:
+        stmt = stmt.where(Change.entity.in_(entities))
+    return [{'seq': seq, 'entity': entity, 'id': entity_id, 'op': op, 'data': data, 'at': at}
+            for seq, entity, entity_id, op, data, at in db.execute(stmt)]
+
+
+def read(db: Session, since: int, limit: int, entities: Optional[Sequence[str]] = None) -> Tuple[List[Dict[str, Any]], int]:
+    """The changes after `since` (see changes_since) and the newest seq in the log; raises Expired."""
+    oldest, head = db.execute(select(func.min(Change.seq), func.max(Change.seq))).one()
+    if oldest is not None and since < oldest - 1:
+        raise Expired(f'Changes before {oldest} have been pruned; download the lists again', head)
+    return changes_since(db, since, limit, entities), head or 0
+
+
+def prune(engine, older_than_days: int = CHANGE_FEED_RETENTION_DAYS) -> int:
+    """Delete records older than the horizon, keeping the newest; returns the number deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    # the commit moves the shared cache versions (see httpcache), so every worker drops its cached /changes
+    # responses; a server on CACHE_BACKEND=local keeps its own versions and does not see this
+    with Session(engine) as db:
+        newest = db.scalar(select(func.max(Change.seq)))
+        if newest is None:
+            return 0
+        deleted = db.execute(delete(Change).where(Change.changed_at < cutoff, Change.seq < newest)).rowcount
+        db.commit()
+    logger.info('pruned %d change log records older than %s', deleted, cutoff)
+    return deleted
+
+
+# --- pushing ---
+
+def _poll(since: int) -> List[Dict[str, Any]]:
+    rows: List[Dict[str, Any]] = []
+    with database.get_session() as db:
+        while True:
+            page = changes_since(db, rows[-1]['seq'] if rows else since, CHANGE_FEED_MAX_PAGE_SIZE)
+            rows += page
+            if len(page) < CHANGE_FEED_MAX_PAGE_SIZE:
+                return rows
+
+
+def _head() -> int:
+    with database.get_session() as db:
+        return db.scalar(select(func.max(Change.seq))) or 0
+
+
+class Subscriber:
+    def __init__(self, buffer: int):
+        # (seq the batch follows, changes); None once the subscriber has fallen too far behind
+        self.queue: asyncio.Queue = asyncio.Queue(buffer)
+
+
+class Hub:
+    """Hands committed changes to this worker's WebSocket subscribers.
+
+    One task reads everything committed since it last looked, woken straight away by
+    this worker's commits and every `poll_seconds` for the other workers', and queues
+    the batch for each subscriber, so a worker runs one query per batch however many
+    clients are connected. The task stops when the last subscriber leaves.
+    """
+
+    def __init__(self, poll_seconds: float = CHANGE_FEED_POLL_SECONDS, buffer: int = CHANGE_FEED_BUFFER):
+        self.poll_seconds = poll_seconds
+        self.buffer = buffer
+        self.subscribers: Set[Subscriber] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        """Wake the task; safe to call from any thread (commits run in the threadpool)."""
+        loop, wake = self._loop, self._wake
+        if loop is not None and wake is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wake.set)
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self.buffer)
+        self.subscribers.add(subscriber)
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and self._wake is not None:
+            self._wake.set()
+
+    def _publish(self, batch) -> None:
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(batch)
+            except asyncio.QueueFull:
+                # dropping its backlog is fine: it reconnects with `since` and reads it from the log
+                self.subscribers.discard(subscriber)
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+    async def _run(self) -> None:
+        head = await run_in_threadpool(_head)
+        while self.subscribers:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if not self.subscribers:
+                break
+            try:
+                rows = await run_in_threadpool(_poll, head)
+            except Exception:
+                logger.exception('change feed poll failed')
+                continue
+            if rows:
+                self._publish((head, rows))
+                head = rows[-1]['seq']
+
+
+hub = Hub()
+
+
+def _read_page(since: int, entities: Optional[Sequence[str]]) -> List[Dict[str, Any]]:
+    with database.get_session() as db:
+        return read(db, since, CHANGE_FEED_PAGE_SIZE, entities)[0]
+
+
+async def _catch_up(websocket: WebSocket, since: int, entities: Optional[Sequence[str]]) -> int:
+    # sends what the log holds after `since`; returns the last seq sent
+    while True:
+        rows = await run_in_threadpool(_read_page, since, entities)
+        if not rows:
+            return since
+        await websocket.send_text(fastjson.dumps(rows).decode())
+        since = rows[-1]['seq']
+
+
+async def _until_disconnect(websocket: WebSocket) -> None:
+    # messages from the client are ignored; only its going away matters
+    while (await websocket.receive())['type'] != 'websocket.disconnect':
+        pass
+
+
+async def stream(websocket: WebSocket, since: int, entities: Optional[Sequence[str]] = None) -> None:
+    """Send the changes after `since`, then every new change as it commits, until the client goes away.
+
+    Each message is a JSON array of changes shaped like `GET /changes` rows. The socket
+    is closed with CLOSE_EXPIRED when `since` has been pruned, and with CLOSE_TRY_AGAIN
+    when the client reads too slowly to keep up; either way it can reconnect with the
+    last seq it received.
+    """
+    subscriber = hub.subscribe()
+    gone = asyncio.create_task(_until_disconnect(websocket))
+    try:
+        try:
+            last = await _catch_up(websocket, since, entities)
+        except Expired as e:
+            await websocket.close(CLOSE_EXPIRED, str(e))
+            return
+        while True:
+            batch = asyncio.create_task(subscriber.queue.get())
+            await asyncio.wait((batch, gone), return_when=asyncio.FIRST_COMPLETED)
+            if not batch.done():
+                batch.cancel()
+                return
+            if batch.result() is None:
+                await websocket.close(CLOSE_TRY_AGAIN, 'Too far behind; reconnect with since')
+                return
+            after, rows = batch.result()
+            end = rows[-1]['seq']
+            if after > last:
+                # committed between the catch-up read and the subscription's first batch
+                last = await _catch_up(websocket, last, entities)
+            rows = [r for r in rows if r['seq'] > last and (not entities or r['entity'] in entities)]
+            if rows:
+                await websocket.send_text(fastjson.dumps(rows).decode())
+            last = max(last, end)
+    finally:
+        hub.unsubscribe(subscriber)
+        gone.cancel()
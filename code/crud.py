@@ -1,15 +1,130 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import select, update, delete
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+import changefeed
 import models
-from typing import Optional, List, Dict, Any
+import principals
+import rollups
+import search
+from datetime import datetime
+from typing import Optional, List, Dict, Any, Callable, Iterator, Sequence
+from pagination import keyset_page, STREAM_CHUNK_SIZE
+
+# Keyset ordering used by the list/iter helpers; `after` is a tuple of these column values
+ADDRESS_KEY = (models.Address.city, models.Address.id)
+PATIENT_KEY = (models.Patient.last_name, models.Patient.id)
+DENTIST_KEY = (models.Dentist.last_name, models.Dentist.id)
+SURGERY_KEY = (models.Surgery.title, models.Surgery.id)
+APPOINTMENT_KEY = (models.Appointment.scheduled_at, models.Appointment.id)
+
+
+class ReferenceNotFound(LookupError):
+    """A write referenced a row that does not exist (foreign key violation)."""
+
+
+class Conflict(Exception):
+    """A write violated a unique constraint, or a delete hit a row that is still referenced."""
+
+
+def _model_for_table(table):
+    for mapper in models.Base.registry.mappers:
+        if mapper.local_table is table:
+            return mapper.class_
+    return None
+
+
+def _integrity_error(db: Session, model, data: Dict[str, Any], error: IntegrityError) -> Exception:
+    # only reached on failure, so finding out which reference is missing can afford a query per foreign key
+    db.rollback()
+    for fk in model.__table__.foreign_keys:
+        value = data.get(fk.parent.name)
+        if value is None:
+            continue
+        if db.execute(select(fk.column).where(fk.column == value)).first() is None:
+            target = _model_for_table(fk.column.table)
+            return ReferenceNotFound(f"{target.__name__ if target else fk.column.table.name} not found")
+    return Conflict(str(error.orig).splitlines()[0])
+
+
+def insert_returning(db: Session, model, data: Dict[str, Any]):
+    """INSERT ... RETURNING the new row as a `model` instance, without committing."""
+    try:
+        return db.execute(insert(model).values(**data).returning(model)).scalar_one()
+    except IntegrityError as e:
+        raise _integrity_error(db, model, data, e) from e
+
+
+def commit_returning(db: Session, obj, *related):
+    # detached first, so the commit does not expire what RETURNING loaded and no refresh SELECT is needed
+    for o in (obj, *related):
+        if o is not None:
+            db.expunge(o)
+    db.commit()
+    return obj
+
+
+def _create(db: Session, model, data: Dict[str, Any]):
+    obj = insert_returning(db, model, data)
+    changefeed.record_row(db, obj)
+    return commit_returning(db, obj)
+
+
+def update_returning(db: Session, model, obj_id: int, changes: Dict[str, Any]):
+    """UPDATE ... RETURNING the changed row (None if there is no such row), without committing.
+
+    Partial: only the given columns are set and the row is never loaded first.
+    """
+    if not changes:
+        return db.get(model, obj_id)
+    stmt = update(model).where(model.id == obj_id).values(**changes).returning(model)
+    try:
+        return db.execute(stmt).scalar_one_or_none()
+    except IntegrityError as e:
+        raise _integrity_error(db, model, changes, e) from e
+
+
+def _update(db: Session, model, obj_id: int, changes: Dict[str, Any]):
+    obj = update_returning(db, model, obj_id, changes)
+    if obj is not None and changes:
+        changefeed.record_row(db, obj, 'update', changes)
+    return commit_returning(db, obj)
+
+
+def _delete(db: Session, model, obj_id: int, cascade: Optional[Callable[[], None]] = None) -> bool:
+    try:
+        if cascade is not None:
+            cascade()  # a Core DELETE skips the ORM cascades, so the children go first, in the same transaction
+        deleted = db.execute(delete(model).where(model.id == obj_id).returning(model.id)).first() is not None
+        if deleted:
+            changefeed.record(db, model, 'delete', obj_id)
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        raise Conflict(f"{model.__name__} {obj_id} is still referenced") from e
+    return deleted
+
+
+def _with_address(db: Session, obj):
+    # RETURNING cannot join; the response nests the address, so load it here (identity map first)
+    if obj is not None:
+        set_committed_value(obj, 'address', db.get(models.Address, obj.address_id) if obj.address_id else None)
+    return obj
+
+
+def _list(db: Session, model, key, limit: int, after: Optional[Sequence[Any]], options: Sequence = (), where: Sequence = ()):
+    stmt = keyset_page(select(model).options(*options).where(*where), key, after, limit)
+    return db.execute(stmt).unique().scalars().all()
+
+
+def _iter(db: Session, model, key, after: Optional[Sequence[Any]], chunk_size: int, options: Sequence = (), where: Sequence = ()) -> Iterator:
+    stmt = keyset_page(select(model).options(*options).where(*where), key, after, None)
+    result = db.execute(stmt.execution_options(yield_per=chunk_size))
+    yield from result.scalars()
 
 
 def create_address(db: Session, **data) -> models.Address:
-    addr = models.Address(**data)
-    db.add(addr)
-    db.commit()
-    db.refresh(addr)
-    return addr
+    return _create(db, models.Address, data)
 
 
 def get_address(db: Session, address_id: int) -> Optional[models.Address]:
@@ -17,106 +132,103 @@ def get_address(db: Session, address_id: int) -> Optional[models.Address]:
 
 
 def update_address(db: Session, address_id: int, **changes) -> Optional[models.Address]:
-    obj = db.get(models.Address, address_id)
-    if not obj:
-        return None
-    for k, v in changes.items():
-        setattr(obj, k, v)
-    db.commit()
-    db.refresh(obj)
-    return obj
+    if 'city' in changes:
+        rollups.move_address(db, address_id, changes['city'])
+    return _update(db, models.Address, address_id, changes)
+
+
+def list_addresses(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None, options: Sequence = ()) -> List[models.Address]:
+    return _list(db, models.Address, ADDRESS_KEY, limit, after, options)
+
+
+def iter_addresses(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE, options: Sequence = ()) -> Iterator[models.Address]:
+    return _iter(db, models.Address, ADDRESS_KEY, after, chunk_size, options)
+
+
+def _unlink_address(db: Session, address_id: int) -> None:
+    # patients and dentists at the address keep their rows, without an address (as the ORM used to leave them)
+    rollups.move_address(db, address_id, None)
+    for model in (models.Patient, models.Dentist):
+        stmt = update(model).where(model.address_id == address_id).values(address_id=None).returning(model)
+        for obj in db.execute(stmt).scalars().all():
+            if model is models.Patient:
+                search.track(db, obj)
+            changefeed.record_row(db, obj, 'update', ('address_id',))
 
 
 def delete_address(db: Session, address_id: int) -> bool:
-    obj = db.get(models.Address, address_id)
-    if not obj:
-        return False
-    db.delete(obj)
-    db.commit()
-    return True
+    return _delete(db, models.Address, address_id, lambda: _unlink_address(db, address_id))
 
 
 # Patients
 def create_patient(db: Session, **data) -> models.Patient:
-    p = models.Patient(**data)
-    db.add(p)
-    db.commit()
-    db.refresh(p)
-    return p
+    p = _with_address(db, insert_returning(db, models.Patient, data))
+    search.track(db, p)
+    changefeed.record_row(db, p)
+    return commit_returning(db, p, p.address)
+
 
+def get_patient(db: Session, patient_id: int, options: Sequence = ()) -> Optional[models.Patient]:
+    return db.get(models.Patient, patient_id, options=options)
 
-def get_patient(db: Session, patient_id: int) -> Optional[models.Patient]:
-    return db.get(models.Patient, patient_id)
 
+def list_patients(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None, options: Sequence = ()) -> List[models.Patient]:
+    return _list(db, models.Patient, PATIENT_KEY, limit, after, options)
 
-def list_patients(db: Session, limit: int = 100) -> List[models.Patient]:
-    return db.execute(select(models.Patient).limit(limit)).scalars().all()
+
+def iter_patients(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE, options: Sequence = ()) -> Iterator[models.Patient]:
+    return _iter(db, models.Patient, PATIENT_KEY, after, chunk_size, options)
 
 
 def update_patient(db: Session, patient_id: int, **changes) -> Optional[models.Patient]:
-    obj = db.get(models.Patient, patient_id)
-    if not obj:
+    if 'address_id' in changes:
+        rollups.move_patient(db, patient_id, changes['address_id'])
+    p = _with_address(db, update_returning(db, models.Patient, patient_id, changes))
+    if p is None:
         return None
-    for k, v in changes.items():
-        setattr(obj, k, v)
-    db.commit()
-    db.refresh(obj)
-    return obj
+    search.track(db, p)
+    if changes:
+        changefeed.record_row(db, p, 'update', changes)
+    return commit_returning(db, p, p.address)
 
 
 def delete_patient(db: Session, patient_id: int) -> bool:
-    obj = db.get(models.Patient, patient_id)
-    if not obj:
-        return False
-    db.delete(obj)
-    db.commit()
-    return True
+    search.track_deleted(db, patient_id)
+    return _delete(db, models.Patient, patient_id,
+                   lambda: _delete_appointments(db, models.Appointment.patient_id == patient_id))
 
 
 # Dentists
 def create_dentist(db: Session, **data) -> models.Dentist:
-    d = models.Dentist(**data)
-    db.add(d)
-    db.commit()
-    db.refresh(d)
-    return d
+    return _create(db, models.Dentist, data)
 
 
 def get_dentist(db: Session, dentist_id: int) -> Optional[models.Dentist]:
     return db.get(models.Dentist, dentist_id)
 
 
-def list_dentists(db: Session, limit: int = 100) -> List[models.Dentist]:
-    return db.execute(select(models.Dentist).limit(limit)).scalars().all()
+def list_dentists(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None, options: Sequence = ()) -> List[models.Dentist]:
+    return _list(db, models.Dentist, DENTIST_KEY, limit, after, options)
+
+
+def iter_dentists(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE, options: Sequence = ()) -> Iterator[models.Dentist]:
+    return _iter(db, models.Dentist, DENTIST_KEY, after, chunk_size, options)
 
 
 def update_dentist(db: Session, dentist_id: int, **changes) -> Optional[models.Dentist]:
-    obj = db.get(models.Dentist, dentist_id)
-    if not obj:
-        return None
-    for k, v in changes.items():
-        setattr(obj, k, v)
-    db.commit()
-    db.refresh(obj)
-    return obj
+    return _update(db, models.Dentist, dentist_id, changes)
 
 
 def delete_dentist(db: Session, dentist_id: int) -> bool:
-    obj = db.get(models.Dentist, dentist_id)
-    if not obj:
-        return False
-    db.delete(obj)
-    db.commit()
-    return True
+    def cascade():
+        _delete_appointments(db, models.Appointment.dentist_id == dentist_id)
+        db.execute(delete(models.WorkingHours).where(models.WorkingHours.dentist_id == dentist_id))
+    return _delete(db, models.Dentist, dentist_id, cascade)
 
 
 # Surgeries
 def create_surgery(db: Session, **data) -> models.Surgery:
-    s = models.Surgery(**data)
-    db.add(s)
-    db.commit()
-    db.refresh(s)
-    return s
+    return _create(db, models.Surgery, data)
 
 
 def get_surgery(db: Session, surgery_id: int) -> Optional[models.Surgery]:
@@ -124,60 +236,90 @@ def get_surgery(db: Session, surgery_id: int) -> Optional[models.Surgery]:
 
 
 def update_surgery(db: Session, surgery_id: int, **changes) -> Optional[models.Surgery]:
-    obj = db.get(models.Surgery, surgery_id)
-    if not obj:
-        return None
-    for k, v in changes.items():
-        setattr(obj, k, v)
-    db.commit()
-    db.refresh(obj)
-    return obj
+    return _update(db, models.Surgery, surgery_id, changes)
+
+
+def _unlink_surgery(db: Session, surgery_id: int) -> None:
+    # the appointments stay booked, without a surgery; only their surgery counts go
+    A = models.Appointment
+    stmt = update(A).where(A.surgery_id == surgery_id).values(surgery_id=None).returning(*(getattr(A, c) for c in _ROLLUP_COLUMNS))
+    for row in db.execute(stmt).mappings().all():
+        rollups.track(db, dict(row, surgery_id=surgery_id), -1)
+        rollups.track(db, dict(row))
 
 
 def delete_surgery(db: Session, surgery_id: int) -> bool:
-    obj = db.get(models.Surgery, surgery_id)
-    if not obj:
-        return False
-    db.delete(obj)
-    db.commit()
-    return True
+    return _delete(db, models.Surgery, surgery_id, lambda: _unlink_surgery(db, surgery_id))
 
 
 # Appointments
 def create_appointment(db: Session, **data) -> models.Appointment:
-    a = models.Appointment(**data)
-    db.add(a)
-    db.commit()
-    db.refresh(a)
-    return a
+    a = insert_returning(db, models.Appointment, data)
+    rollups.track(db, a)
+    return commit_returning(db, a)
 
 
 def get_appointment(db: Session, appointment_id: int) -> Optional[models.Appointment]:
     return db.get(models.Appointment, appointment_id)
 
 
-def list_appointments(db: Session, limit: int = 100) -> List[models.Appointment]:
-    return db.execute(select(models.Appointment).limit(limit)).scalars().all()
+def appointment_filters(dentist_id: Optional[int], patient_id: Optional[int], surgery_id: Optional[int],
+                         start: Optional[datetime], end: Optional[datetime]) -> list:
+    # equality on dentist/patient/surgery plus a scheduled_at range: served by the (<owner>_id, scheduled_at) indexes
+    A = models.Appointment
+    where = [col == value for col, value in ((A.dentist_id, dentist_id), (A.patient_id, patient_id), (A.surgery_id, surgery_id))
+             if value is not None]
+    if start is not None:
+        where.append(A.scheduled_at >= start)
+    if end is not None:
+        where.append(A.scheduled_at < end)
+    return where
+
+
+def list_appointments(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None, options: Sequence = (),
+                      dentist_id: Optional[int] = None, patient_id: Optional[int] = None, surgery_id: Optional[int] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[models.Appointment]:
+    where = appointment_filters(dentist_id, patient_id, surgery_id, start, end)
+    return _list(db, models.Appointment, APPOINTMENT_KEY, limit, after, options, where)
+
+
+def iter_appointments(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE, options: Sequence = (),
+                      dentist_id: Optional[int] = None, patient_id: Optional[int] = None, surgery_id: Optional[int] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None) -> Iterator[models.Appointment]:
+    where = appointment_filters(dentist_id, patient_id, surgery_id, start, end)
+    return _iter(db, models.Appointment, APPOINTMENT_KEY, after, chunk_size, options, where)
+
+
+# columns the daily rollups are keyed or summed by
+_ROLLUP_COLUMNS = ('dentist_id', 'surgery_id', 'patient_id', 'scheduled_at', 'duration_minutes')
 
 
 def update_appointment(db: Session, appointment_id: int, **changes) -> Optional[models.Appointment]:
-    obj = db.get(models.Appointment, appointment_id)
-    if not obj:
-        return None
-    for k, v in changes.items():
-        setattr(obj, k, v)
-    db.commit()
-    db.refresh(obj)
-    return obj
+    A = models.Appointment
+    before = None
+    if changes.keys() & set(_ROLLUP_COLUMNS):
+        before = db.execute(select(*(getattr(A, c) for c in _ROLLUP_COLUMNS)).where(A.id == appointment_id)).first()
+    a = update_returning(db, A, appointment_id, changes)
+    if a is not None and before is not None:
+        rollups.track(db, before, -1)
+        rollups.track(db, a)
+    return commit_returning(db, a) if a is not None else None
+
+
+def _delete_appointments(db: Session, *where) -> None:
+    A = models.Appointment
+    for row in db.execute(delete(A).where(*where).returning(*(getattr(A, c) for c in _ROLLUP_COLUMNS))):
+        rollups.track(db, row, -1)
+    rollups.settle(db)  # count them off under their patients' cities while those can still be read
 
 
 def delete_appointment(db: Session, appointment_id: int) -> bool:
-    obj = db.get(models.Appointment, appointment_id)
-    if not obj:
-        return False
-    db.delete(obj)
+    A = models.Appointment
+    deleted = db.execute(delete(A).where(A.id == appointment_id).returning(*(getattr(A, c) for c in _ROLLUP_COLUMNS))).first()
+    if deleted is not None:
+        rollups.track(db, deleted, -1)
     db.commit()
-    return True
+    return deleted is not None
 
 
 # Users and Roles
@@ -216,6 +358,7 @@ def update_user(db: Session, user_id: int, **changes) -> Optional[models.User]:
     if not obj:
         return None
     roles = changes.pop('roles', None)
+    old_username = obj.username
     for k, v in changes.items():
         setattr(obj, k, v)
     if roles is not None:
@@ -227,7 +370,10 @@ def update_user(db: Session, user_id: int, **changes) -> Optional[models.User]:
                 r = db.get(models.Role, int(role))
                 if r:
                     obj.roles.append(r)
+    usernames = (old_username, obj.username)
     db.commit()
+    # after the commit so a concurrent request cannot re-cache the old roles
+    principals.invalidate(*usernames)
     db.refresh(obj)
     return obj
 
@@ -236,6 +382,8 @@ def delete_user(db: Session, user_id: int) -> bool:
     obj = db.get(models.User, user_id)
     if not obj:
         return False
+    username = obj.username
     db.delete(obj)
     db.commit()
+    principals.invalidate(username)
     return True
@@ -0,0 +1,78 @@
+"""Async variants of the crud helpers.
+
+Each coroutine takes the request session (an AsyncSession in DB_MODE=async, a
+plain Session otherwise) and runs the matching crud function through
+`database.run_db`, so the query logic lives only in crud.py. Pass `out=` a
+response model to serialize the result while the session can still lazy-load.
+The streaming `iter_*` helpers have no async variant; exports keep using them
+on a sync session.
+"""
+from typing import Any, Callable, Optional
+import crud
+from database import run_db
+
+
+def _convert(out, result):
+    if out is None or result is None or isinstance(result, bool):
+        return result
+    if isinstance(result, list):
+        return [out.model_validate(r, from_attributes=True) for r in result]
+    return out.model_validate(result, from_attributes=True)
+
+
+def _async_variant(fn: Callable) -> Callable:
+    async def variant(db, *args, out: Optional[Any] = None, **kwargs):
+        def call(session):
+            return _convert(out, fn(session, *args, **kwargs))
+        return await run_db(db, call)
+    variant.__name__ = fn.__name__
+    variant.__qualname__ = fn.__name__
+    variant.__doc__ = f"Async variant of crud.{fn.__name__}."
+    return variant
+
+
+# Addresses
+create_address = _async_variant(crud.create_address)
+get_address = _async_variant(crud.get_address)
+update_address = _async_variant(crud.update_address)
+list_addresses = _async_variant(crud.list_addresses)
+delete_address = _async_variant(crud.delete_address)
+
+
+# Patients
+create_patient = _async_variant(crud.create_patient)
+get_patient = _async_variant(crud.get_patient)
+list_patients = _async_variant(crud.list_patients)
+update_patient = _async_variant(crud.update_patient)
+delete_patient = _async_variant(crud.delete_patient)
+
+
+# Dentists
+create_dentist = _async_variant(crud.create_dentist)
+get_dentist = _async_variant(crud.get_dentist)
+list_dentists = _async_variant(crud.list_dentists)
+update_dentist = _async_variant(crud.update_dentist)
+delete_dentist = _async_variant(crud.delete_dentist)
+
+
+# Surgeries
+create_surgery = _async_variant(crud.create_surgery)
+get_surgery = _async_variant(crud.get_surgery)
+update_surgery = _async_variant(crud.update_surgery)
+delete_surgery = _async_variant(crud.delete_surgery)
+
+
+# Appointments
+create_appointment = _async_variant(crud.create_appointment)
+get_appointment = _async_variant(crud.get_appointment)
+list_appointments = _async_variant(crud.list_appointments)
+update_appointment = _async_variant(crud.update_appointment)
+delete_appointment = _async_variant(crud.delete_appointment)
+
+
+# Users and Roles
+create_role = _async_variant(crud.create_role)
+create_user = _async_variant(crud.create_user)
+get_user = _async_variant(crud.get_user)
+update_user = _async_variant(crud.update_user)
+delete_user = _async_variant(crud.delete_user)
@@ -1,7 +1,15 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy.pool import NullPool
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
 from dotenv import load_dotenv
+import dbdiag
+import httpcache  # noqa: F401 -- registers the response cache version bumps, for scripts as well as the API
+import replicas
 
 load_dotenv("/Final-project/code/.env")
 
@@ -9,9 +17,150 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL not set. Copy .env.example to .env and set DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, echo=False, future=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+# DB_MODE=async serves API requests through an AsyncEngine (asyncpg / aiosqlite);
+# the sync engine is always built for startup, seeding, scripts and streaming exports.
+DB_MODE = os.getenv("DB_MODE", "sync").lower()
+ASYNC_DB = DB_MODE == "async"
+
+# Connection pool sizing (ignored for SQLite, which uses SQLAlchemy's default pool)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+_ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+def async_url(url: str) -> str:
+    u = make_url(url)
+    backend = u.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {backend}; set ASYNC_DATABASE_URL")
+    return u.set(drivername=f"{backend}+{_ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+
+def pool_options(url: str, is_async: bool = False) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "poolclass": dbdiag.TimedAsyncAdaptedQueuePool if is_async else dbdiag.TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def enforce_sqlite_foreign_keys(engine) -> None:
+    # SQLite ignores foreign keys unless asked per connection; crud relies on violations to report missing rows
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _foreign_keys_on(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+_session_class = dbdiag.TrackedSession if dbdiag.SESSION_DEBUG else Session
+if replicas.REPLICA_URLS:
+    # reads of GET requests go through the replica pinned in session.info (see replicas)
+    _session_class = type("RoutingSession", (replicas.RoutingSessionMixin, _session_class), {})
+
+engine = create_engine(DATABASE_URL, echo=False, future=True, **pool_options(DATABASE_URL))
+dbdiag.instrument_pool(engine)
+enforce_sqlite_foreign_keys(engine)
+SessionLocal = sessionmaker(bind=engine, class_=_session_class, autoflush=False, autocommit=False, future=True)
 Base = declarative_base()
 
-def get_session():
-    return SessionLocal()
+async_engine = None
+AsyncSessionLocal = None
+if ASYNC_DB:
+    # imported here so sync deployments do not need greenlet or an async driver
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    _async_url = os.getenv("ASYNC_DATABASE_URL") or async_url(DATABASE_URL)
+    async_engine = create_async_engine(_async_url, echo=False, **pool_options(_async_url, is_async=True))
+    dbdiag.instrument_pool(async_engine.sync_engine)
+    enforce_sqlite_foreign_keys(async_engine.sync_engine)
+    # no expire_on_commit: touching an expired attribute outside run_sync would need IO
+    AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, sync_session_class=_session_class,
+                                     autoflush=False, expire_on_commit=False)
+
+
+def _make_replica(name: str, url: str) -> replicas.Replica:
+    if ASYNC_DB:
+        replica_async_url = async_url(url)
+        bind = create_async_engine(replica_async_url, echo=False,
+                                   **pool_options(replica_async_url, is_async=True)).sync_engine
+    else:
+        bind = create_engine(url, echo=False, future=True, **pool_options(url))
+    dbdiag.instrument_pool(bind, name)
+    enforce_sqlite_foreign_keys(bind)
+    return replicas.Replica(name, bind, create_engine(url, future=True, poolclass=NullPool))
+
+
+replica_set = None
+if replicas.REPLICA_URLS:
+    replica_set = replicas.ReplicaSet([_make_replica(f"replica{i}", url) for i, url in enumerate(replicas.REPLICA_URLS, 1)])
+
+
+def replica_for(request) -> "replicas.Replica | None":
+    """The replica a request's reads should use, or None for the primary."""
+    return replica_set.for_request(request) if replica_set is not None else None
+
+
+def get_session(replica=None):
+    return SessionLocal(info={"replica": replica}) if replica is not None else SessionLocal()
+
+
+def get_async_session(replica=None):
+    if AsyncSessionLocal is None:
+        raise RuntimeError("Async database access requires DB_MODE=async")
+    return AsyncSessionLocal(info={"replica": replica}) if replica is not None else AsyncSessionLocal()
+
+
+async def get_db(request: Request):
+    """Request-scoped session dependency; FastAPI resolves it once per request for every dependant.
+
+    Yields an AsyncSession in DB_MODE=async and a sync Session otherwise; use it via run_db/crud_async.
+    GET/HEAD requests read from a replica when replicas are configured.
+    """
+    replica = replica_for(request)
+    if ASYNC_DB:
+        async with get_async_session(replica) as db:
+            yield db
+    else:
+        db = get_session(replica)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+@asynccontextmanager
+async def open_db():
+    """A primary session outside a request's dependencies, e.g. for a WebSocket handshake; see get_db."""
+    if ASYNC_DB:
+        async with get_async_session() as db:
+            yield db
+    else:
+        db = get_session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+async def run_db(db, fn, *args, **kwargs):
+    """Call sync-style `fn(session, *args, **kwargs)` without blocking the event loop.
+
+    With an AsyncSession the function runs through `run_sync` on the async driver;
+    with a plain Session it runs in the threadpool.
+    """
+    if ASYNC_DB:
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
@@ -0,0 +1,124 @@
+"""Connection pool and session diagnostics.
+
+Pool checkout wait and hold times are recorded into histograms from pool events.
+With DB_SESSION_DEBUG enabled every Session remembers the stack that opened it,
+and `UnclosedSessionMiddleware` logs the ones a request left open.
+"""
+import logging
+import os
+import time
+import traceback
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SESSION_DEBUG = os.getenv("DB_SESSION_DEBUG", "false").lower() in ("1", "true", "yes")
+
+POOL_CHECKOUT_WAIT = metrics.histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection (including connects)")
+POOL_CHECKOUT_DURATION = metrics.histogram(
+    "db_pool_checkout_duration_seconds", "Time a connection stayed checked out of the pool")
+
+
+class _TimedCheckout:
+    # QueuePool has no event for "waiting", so time the internal get that blocks on the queue
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+_pools: Dict[str, object] = {}
+
+
+def _pool_connections():
+    samples = {}
+    for label, pool in list(_pools.items()):
+        if not hasattr(pool, "checkedout"):
+            continue  # NullPool/StaticPool keep no counts
+        samples[(label, "checked_out")] = pool.checkedout()
+        samples[(label, "idle")] = pool.checkedin()
+        samples[(label, "overflow")] = max(0, pool.overflow())
+    return samples
+
+
+metrics.gauge("db_pool_connections", "Pooled connections by state", _pool_connections, ("engine", "state"))
+
+
+def instrument_pool(engine, label: Optional[str] = None) -> None:
+    _pools[label or ("async" if engine.dialect.is_async else "sync")] = engine.pool
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is not None:
+            POOL_CHECKOUT_DURATION.observe(time.perf_counter() - started)
+
+
+# --- unclosed session tracking ---
+
+_open_sessions: ContextVar[Optional[Dict[int, Tuple[str, str]]]] = ContextVar("open_sessions", default=None)
+
+
+class TrackedSession(Session):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the dict is shared with threadpool copies of the request context
+        self._debug_open = _open_sessions.get()
+        if self._debug_open is not None:
+            self._debug_open[id(self)] = (repr(self), "".join(traceback.format_stack(limit=12)[:-1]))
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self._debug_open is not None:
+                self._debug_open.pop(id(self), None)
+
+
+def report_unclosed(registry: Dict[int, Tuple[str, str]], label: str) -> int:
+    for name, stack in list(registry.values()):
+        logger.warning("%s left %s open; opened at:\n%s", label, name, stack)
+    return len(registry)
+
+
+class UnclosedSessionMiddleware:
+    """ASGI middleware that reports sessions still open once a request has fully finished.
+
+    Runs outside the whole call (including streamed bodies and dependency teardown),
+    so anything still registered here was never closed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        registry: Dict[int, Tuple[str, str]] = {}
+        token = _open_sessions.set(registry)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _open_sessions.reset(token)
+            report_unclosed(registry, f"{scope['method']} {scope['path']}")
@@ -0,0 +1,106 @@
+"""Streaming CSV/NDJSON exports of the clinic dataset.
+
+Rows are read with a server-side cursor (`stream_results`) in partitions of
+`EXPORT_CHUNK_SIZE` and encoded one partition at a time, so memory use does
+not depend on table size. Appointments are denormalized with their patient,
+dentist and surgery; patients with their address.
+"""
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Callable, Dict, Iterator, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, aliased
+import models
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 2000))
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def _addresses():
+    a = models.Address
+    return select(a.id, a.street, a.city, a.state, a.postal_code, a.country, a.updated_at), a
+
+
+def _patients():
+    p, a = models.Patient, models.Address
+    stmt = select(
+        p.id, p.first_name, p.last_name, p.email, p.phone, p.address_id,
+        a.street.label("address_street"), a.city.label("address_city"), a.state.label("address_state"),
+        a.postal_code.label("address_postal_code"), a.country.label("address_country"), p.updated_at,
+    ).outerjoin(a, p.address_id == a.id)
+    return stmt, p
+
+
+def _dentists():
+    d = models.Dentist
+    return select(d.id, d.first_name, d.last_name, d.specialty, d.email, d.phone, d.address_id, d.updated_at), d
+
+
+def _appointments():
+    ap, p, d, s = models.Appointment, models.Patient, models.Dentist, models.Surgery
+    stmt = select(
+        ap.id, ap.scheduled_at, ap.duration_minutes, ap.notes,
+        ap.patient_id, p.first_name.label("patient_first_name"), p.last_name.label("patient_last_name"),
+        ap.dentist_id, d.first_name.label("dentist_first_name"), d.last_name.label("dentist_last_name"),
+        d.specialty.label("dentist_specialty"),
+        ap.surgery_id, s.title.label("surgery_title"), ap.updated_at,
+    ).join(p, ap.patient_id == p.id).join(d, ap.dentist_id == d.id).outerjoin(s, ap.surgery_id == s.id)
+    return stmt, ap
+
+
+DATASETS: Dict[str, Callable] = {
+    "addresses": _addresses,
+    "patients": _patients,
+    "dentists": _dentists,
+    "appointments": _appointments,
+}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"cannot encode {type(value).__name__}")
+
+
+def _encode_csv(columns, rows, header: bool) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    if header:
+        writer.writerow(columns)
+    writer.writerows(["" if v is None else (v.isoformat() if isinstance(v, datetime) else v) for v in row] for row in rows)
+    return buf.getvalue()
+
+
+def _encode_ndjson(columns, rows) -> str:
+    return "".join(json.dumps(dict(zip(columns, row)), default=_json_default, separators=(",", ":")) + "\n" for row in rows)
+
+
+def iter_export(db: Session, dataset: str, fmt: str = "csv", updated_since: Optional[datetime] = None,
+                chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[str]:
+    """Yield the export as text chunks, one per partition of `chunk_size` rows."""
+    stmt, entity = DATASETS[dataset]()
+    if updated_since is not None:
+        stmt = stmt.where(entity.updated_at >= updated_since)
+    stmt = stmt.order_by(entity.id).execution_options(stream_results=True, yield_per=chunk_size)
+    result = db.execute(stmt)
+    columns = list(result.keys())
+    first = True
+    for rows in result.partitions():
+        yield _encode_csv(columns, rows, first) if fmt == "csv" else _encode_ndjson(columns, rows)
+        first = False
+    if first and fmt == "csv":
+        yield _encode_csv(columns, [], True)
+
+
+def gzip_chunks(chunks: Iterator[str]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
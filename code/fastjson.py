@@ -0,0 +1,37 @@
+"""JSON encoding for responses.
+
+Uses orjson when installed (several times faster than the stdlib encoder on
+large lists and native for datetime/date/time), falling back to `json`.
+"""
+import json
+from datetime import date, datetime, time
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """Default response class. Endpoints that build plain dicts from trusted rows return it
+    directly, which also skips FastAPI's response_model validation."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
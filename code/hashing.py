@@ -0,0 +1,138 @@
+"""Password hashing service.
+
+PBKDF2 hashing is CPU bound, so the async API below runs it in a dedicated,
+bounded process pool instead of the request threadpool. At most
+`HASH_MAX_IN_FLIGHT` operations are accepted at a time; beyond that callers
+get `HashingOverloaded` straight away (the API turns it into a 503) rather
+than queueing behind a login burst.
+
+In-flight and queued hashes, finished hashes by outcome and hash durations are
+on /metrics (`password_hash_*`).
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from passlib.context import CryptContext
+import metrics
+
+# Raising PBKDF2_ROUNDS makes older hashes count as outdated, so they are rehashed on next login
+PBKDF2_ROUNDS = os.getenv("PBKDF2_ROUNDS")
+_rounds = {"pbkdf2_sha256__default_rounds": int(PBKDF2_ROUNDS), "pbkdf2_sha256__min_rounds": int(PBKDF2_ROUNDS)} if PBKDF2_ROUNDS else {}
+
+# Use pbkdf2_sha256 to avoid bcrypt backend installation/version issues and 72-byte limit
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto", **_rounds)
+
+# per API worker; the launcher exports its worker count as WEB_CONCURRENCY, so by default all of them together
+# hash on about half the cores
+_API_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY") or 1))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2 // _API_WORKERS)))
+HASH_MAX_IN_FLIGHT = int(os.getenv("HASH_MAX_IN_FLIGHT", max(HASH_WORKERS, 1) * 4))
+HASH_RETRY_AFTER_SECONDS = int(os.getenv("HASH_RETRY_AFTER_SECONDS", 1))
+
+
+class HashingOverloaded(Exception):
+    pass
+
+
+# Module-level so they can be pickled into the worker processes
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+class HashingStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0  # raised or cancelled
+        self.rejected = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": max(0, self.in_flight - max(HASH_WORKERS, 1)),
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "seconds_total": self.seconds_total,
+                "seconds_max": self.seconds_max,
+            }
+
+
+stats = HashingStats()
+HASH_DURATION = metrics.histogram("password_hash_duration_seconds", "Time from accepting a hash until it finished or failed")
+
+metrics.gauge("password_hash_in_flight", "Hashes accepted and not yet finished", lambda: stats.snapshot()["in_flight"])
+metrics.gauge("password_hash_queue_depth", "Accepted hashes waiting for a free worker",
+              lambda: stats.snapshot()["queue_depth"])
+metrics.gauge("password_hashes_total", "Hashes by outcome; rejected ones were refused at HASH_MAX_IN_FLIGHT",
+              lambda: {(k,): v for k, v in stats.snapshot().items() if k in ("completed", "failed", "rejected")},
+              ("outcome",), kind="counter")
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> Optional[ProcessPoolExecutor]:
+    global _executor
+    if HASH_WORKERS <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # spawn: forking a process that already runs the server's threads is not safe
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def shutdown() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+async def _run(fn, *args):
+    with stats._lock:
+        if stats.in_flight >= HASH_MAX_IN_FLIGHT:
+            stats.rejected += 1
+            raise HashingOverloaded()
+        stats.in_flight += 1
+    started = time.perf_counter()
+    finished = False
+    try:
+        # HASH_WORKERS=0 hashes in the default threadpool (useful for tests and tiny deployments)
+        result = await asyncio.get_running_loop().run_in_executor(_get_executor(), fn, *args)
+        finished = True
+        return result
+    finally:
+        elapsed = time.perf_counter() - started
+        HASH_DURATION.observe(elapsed)
+        with stats._lock:
+            stats.in_flight -= 1
+            if finished:
+                stats.completed += 1
+            else:
+                stats.failed += 1
+            stats.seconds_total += elapsed
+            stats.seconds_max = max(stats.seconds_max, elapsed)
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password)
+
+
+async def verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """Return (matches, new_hash); new_hash is set when the stored hash uses outdated settings."""
+    return await _run(_verify_and_update, password, hashed)
@@ -0,0 +1,374 @@
+"""HTTP response cache with ETags for hot read endpoints.
+
+Every committed session bumps a version counter for each table it wrote (the
+crud helpers, bulk ingest and plain ORM flushes alike). A cached route declares
+the tables its body is built from; its ETag is a hash of the request URL and
+those tables' versions, so it can be checked -- and a 304 sent -- without
+touching the database. Serialized 200 bodies are kept in a per-process LRU
+bounded by total size, keyed by the same ETag.
+
+Versions live in `DatabaseVersions` (the default: a `cache_versions` row per
+table, bumped inside the writing transaction, so every worker and every script
+that writes through SQLAlchemy moves them), `RedisVersions`
+(`CACHE_BACKEND=redis`; bumped after the commit, by this app's sessions only) or
+`LocalVersions` (`CACHE_BACKEND=local`; per process, one worker only, and the
+fake shared store for tests).
+
+A body read from a replica may predate the versions its ETag would be built
+from, so such responses are sent without an ETag and never stored; only bodies
+read from the primary are cached and revalidated.
+"""
+import hashlib
+import os
+import secrets
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+from starlette.concurrency import run_in_threadpool
+import metrics
+import replicas
+
+CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "database").lower()
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", 1024 * 1024))
+
+# whether the versions are seen by every process, so writes from other workers and scripts invalidate too
+SHARED = CACHE_BACKEND != "local"
+# whether several worker processes can serve the cache without handing out each other's stale bodies (see main)
+MULTIPROCESS_SAFE = not CACHE_ENABLED or SHARED
+
+CACHE_CONTROL = "no-cache"  # clients may keep the body but must revalidate with If-None-Match
+
+
+class DatabaseVersions:
+    """Version counters in the `cache_versions` table of the primary, shared by every process using the database.
+
+    Reads cost one query per cached request; bumps are written by the transaction that wrote the tables
+    (see `_bump_in_transaction`), so no commit can be seen without its new versions.
+    """
+
+    bumps_in_transaction = True
+
+    async def versions(self, tables: Sequence[str]) -> Tuple[str, ...]:
+        # imported here: database imports this module to register the version bumps
+        import database
+
+        if database.async_engine is not None:
+            async with database.async_engine.connect() as conn:
+                rows = (await conn.execute(self._select(tables))).all()
+        else:
+            rows = await run_in_threadpool(self._read, database.engine, tables)
+        found = dict(rows)
+        return tuple(str(found.get(t, 0)) for t in tables)
+
+    @staticmethod
+    def _select(tables: Sequence[str]):
+        import models
+
+        V = models.CacheVersion
+        return select(V.table_name, V.version).where(V.table_name.in_(tables))
+
+    def _read(self, engine, tables: Sequence[str]):
+        with engine.connect() as conn:
+            return conn.execute(self._select(tables)).all()
+
+    def bump_on(self, conn, tables: Iterable[str]) -> None:
+        import models
+
+        V = models.CacheVersion
+        dialect = conn.dialect.name
+        if dialect not in ("postgresql", "sqlite"):
+            raise RuntimeError(f"CACHE_BACKEND=database needs ON CONFLICT support; {dialect} is not supported")
+        dml = postgresql if dialect == "postgresql" else sqlite
+        # a new counter starts at random, so a recreated database does not hand out the ETags of the old one;
+        # sorted, so concurrent commits lock the rows in the same order
+        stmt = dml.insert(V).values([{"table_name": t, "version": secrets.randbits(48)} for t in sorted(tables)])
+        conn.execute(stmt.on_conflict_do_update(index_elements=[V.table_name], set_={"version": V.version + 1}))
+
+
+class LocalVersions:
+    """Version counters in this process. Share one instance between caches to fake a shared store."""
+
+    bumps_in_transaction = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        # a restarted process must not reuse the ETags of the previous one
+        self.generation = uuid.uuid4().hex
+
+    async def versions(self, tables: Sequence[str]) -> Tuple[str, ...]:
+        with self._lock:
+            return (self.generation,) + tuple(str(self._counters.get(t, 0)) for t in tables)
+
+    def bump(self, tables: Iterable[str]) -> None:
+        with self._lock:
+            for t in tables:
+                self._counters[t] = self._counters.get(t, 0) + 1
+
+
+class RedisVersions:
+    """Version counters in Redis, shared by every worker. Requires the `redis` package."""
+
+    bumps_in_transaction = False
+
+    def __init__(self, url: str = CACHE_REDIS_URL, prefix: str = "adsweb:cache:"):
+        # imported here so deployments without a shared cache do not need redis installed
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package (pip install 'redis>=4.2'); "
+                               "it is not in requirements.txt because the default local backend does not use it") from e
+
+        self.prefix = prefix
+        self._sync = redis.Redis.from_url(url)
+        self._async = redis.asyncio.Redis.from_url(url)
+
+    async def versions(self, tables: Sequence[str]) -> Tuple[str, ...]:
+        generation_key = self.prefix + "generation"
+        values = await self._async.mget([generation_key] + [self.prefix + "v:" + t for t in tables])
+        if values[0] is None:
+            # a flushed or restarted Redis starts the counters again; a new generation keeps old ETags from matching
+            await self._async.set(generation_key, uuid.uuid4().hex, nx=True)
+            values = await self._async.mget([generation_key] + [self.prefix + "v:" + t for t in tables])
+        return tuple((v or b"0").decode() for v in values)
+
+    def bump(self, tables: Iterable[str]) -> None:
+        pipe = self._sync.pipeline(transaction=False)
+        for t in tables:
+            pipe.incr(self.prefix + "v:" + t)
+        pipe.execute()
+
+
+class BodyCache:
+    """LRU of serialized responses, evicted by total body size."""
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, max_entry_bytes: int = CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[List[Tuple[bytes, bytes]], bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, headers: List[Tuple[bytes, bytes]], body: bytes) -> None:
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (headers, body)
+            self.size += len(body)
+            while self.size > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified,
+                "evictions": self.evictions, "bytes": bodies.size}
+
+
+def _make_backend():
+    if CACHE_BACKEND == "database":
+        return DatabaseVersions()
+    if CACHE_BACKEND == "redis":
+        return RedisVersions()
+    if CACHE_BACKEND != "local":
+        raise RuntimeError(f"unknown CACHE_BACKEND {CACHE_BACKEND!r} (expected database, redis or local)")
+    return LocalVersions()
+
+
+backend = _make_backend()
+bodies = BodyCache()
+stats = CacheStats()
+
+metrics.gauge("response_cache_events_total", "Response cache lookups and evictions",
+              lambda: {(k,): v for k, v in stats.snapshot().items() if k != "bytes"}, ("event",), kind="counter")
+metrics.gauge("response_cache_bytes", "Size of the cached response bodies", lambda: bodies.size)
+
+
+# --- version bumps in the writing transaction (DatabaseVersions) ---
+
+VERSIONS_TABLE = "cache_versions"
+
+
+def mark_written(conn, table_name: str) -> None:
+    """Bump `table_name` when `conn` commits; for writes the statement hook cannot see (raw SQL, COPY)."""
+    if backend.bumps_in_transaction and table_name != VERSIONS_TABLE:
+        conn.info.setdefault("cache_tables", set()).add(table_name)
+
+
+@event.listens_for(Engine, "before_execute")
+def _collect_executed(conn, clauseelement, multiparams, params, execution_options):
+    # every INSERT/UPDATE/DELETE construct, from sessions and Core scripts alike
+    if isinstance(clauseelement, UpdateBase):
+        table = getattr(clauseelement, "table", None)
+        if table is not None:
+            mark_written(conn, table.name)
+
+
+@event.listens_for(Engine, "commit")
+def _bump_in_transaction(conn):
+    # runs just before the DBAPI commit, so the bump commits (or fails) with the writes
+    written = conn.info.pop("cache_tables", None)
+    if written:
+        backend.bump_on(conn, written)
+
+
+@event.listens_for(Engine, "rollback")
+def _discard_executed(conn):
+    conn.info.pop("cache_tables", None)
+
+
+# --- version bumps from committed sessions (RedisVersions, LocalVersions) ---
+
+@event.listens_for(Session, "after_flush")
+def _collect_flushed(session, flush_context):
+    written = session.info.setdefault("cache_tables", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        if table:
+            written.add(table)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_statement(orm_execute_state):
+    # INSERT/UPDATE/DELETE ... RETURNING and bulk inserts bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None:
+            orm_execute_state.session.info.setdefault("cache_tables", set()).add(table.name)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_versions(session):
+    written = session.info.pop("cache_tables", None)
+    if written and not backend.bumps_in_transaction:
+        backend.bump(sorted(written))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_versions(session, previous_transaction):
+    session.info.pop("cache_tables", None)
+
+
+# --- middleware ---
+
+def _route_pattern(template: str):
+    return re.compile("^" + re.sub(r"\{[^/]+\}", "[^/]+", template) + "$")
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so a W/ prefix added by a proxy still matches
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+
+class ResponseCacheMiddleware:
+    """ASGI middleware serving the GET routes in `rules` from the version-keyed cache.
+
+    `rules` maps a route template (e.g. "/patients/{id}") to the tables its response reads.
+    Only 200 application/json responses are stored; anything else passes through.
+    """
+
+    def __init__(self, app, rules: Dict[str, Sequence[str]], versions=None, body_cache: Optional[BodyCache] = None):
+        self.app = app
+        self.rules = [(_route_pattern(template), template, tuple(sorted(tables))) for template, tables in rules.items()]
+        self.versions = versions
+        self.bodies = body_cache or bodies
+
+    def _match(self, path: str) -> Tuple[Optional[str], Optional[Tuple[str, ...]]]:
+        for pattern, template, tables in self.rules:
+            if pattern.match(path):
+                return template, tables
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or not CACHE_ENABLED:
+            return await self.app(scope, receive, send)
+        template, tables = self._match(scope["path"])
+        if tables is None:
+            return await self.app(scope, receive, send)
+        scope["route_template"] = template  # for request metrics when answered without routing
+
+        query = urlencode(sorted(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)))
+        versions = await (self.versions or backend).versions(tables)
+        digest = hashlib.sha256("|".join((scope["path"], query) + tables + versions).encode()).hexdigest()
+        etag = f'"{digest[:32]}"'
+        validators = [(b"etag", etag.encode()), (b"cache-control", CACHE_CONTROL.encode())]
+
+        request_headers = dict(scope["headers"])
+        if_none_match = request_headers.get(b"if-none-match")
+        if if_none_match and _etag_matches(if_none_match.decode("latin-1"), etag):
+            stats.not_modified += 1
+            await send({"type": "http.response.start", "status": 304, "headers": validators})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        entry = self.bodies.get(etag)
+        if entry is not None:
+            stats.hits += 1
+            headers, body = entry
+            await send({"type": "http.response.start", "status": 200, "headers": headers + validators})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        stats.misses += 1
+        captured = {"store": False, "headers": [], "chunks": [], "size": 0}
+
+        async def send_and_capture(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                content_type = dict(headers).get(b"content-type", b"")
+                if (message["status"] == 200 and content_type.startswith(b"application/json")
+                        and replicas.SCOPE_KEY not in scope):
+                    captured["store"] = True
+                    captured["headers"] = headers
+                    message = dict(message, headers=headers + validators)
+            elif message["type"] == "http.response.body" and captured["store"]:
+                captured["chunks"].append(message.get("body", b""))
+                captured["size"] += len(captured["chunks"][-1])
+                if captured["size"] > self.bodies.max_entry_bytes:
+                    captured["store"] = False  # too big to keep; stop buffering
+                    captured["chunks"] = []
+                elif not message.get("more_body", False):
+                    self.bodies.put(etag, captured["headers"], b"".join(captured["chunks"]))
+            await send(message)
+
+        await self.app(scope, receive, send_and_capture)
@@ -0,0 +1,15 @@
+"""Eager-loading strategies for the API response models.
+
+Each tuple holds the loader options that populate every relationship the
+matching `*Out` model serializes, so an endpoint returning that model issues a
+fixed number of SELECTs no matter how many rows it returns.
+"""
+from sqlalchemy.orm import joinedload
+import models
+
+# many-to-one: joined into the parent SELECT (also safe with yield_per streaming)
+PATIENT_OUT = (joinedload(models.Patient.address),)
+ADDRESS_OUT = ()
+APPOINTMENT_OUT = ()
+DENTIST_OUT = ()
+SURGERY_OUT = ()
@@ -1,14 +1,174 @@
 """FastAPI application entrypoint.
 
-This module exposes a top-level `app` object (imported from `api.py`) so
-uvicorn can run the application with `python -m uvicorn code.main:app --reload`.
-If executed directly, it will start a uvicorn server.
+`app` (defined in api.py) can be imported from here, so `uvicorn main:app` keeps
+working. Run directly, this module starts the server:
+
+    python main.py                  production: one-time prestart, then WEB_CONCURRENCY workers, no reload
+    python main.py --dev            a single worker that reloads on code changes
+    python main.py --prestart-only  run the schema/seed prestart and exit (e.g. as a release step)
+    python main.py --measure        time the prestart and a few worker cold starts, and list the slowest imports
 """
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
 
-from api import app  # the FastAPI app is defined in api.py
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', 8002))
+# uvicorn's own variable; requests are served on an event loop per worker, so unset (0) means one worker per core
+# -- or just one while the response cache keeps its versions per process (see worker_count)
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 0))
 
-if __name__ == '__main__':
+# set by the launcher so each worker can report how long it took to come up
+LAUNCHED_AT_ENV = 'ADSWEB_LAUNCHED_AT'
+
+
+def _load_app():
+    started = time.perf_counter()
+    from api import app
+    import_seconds = time.perf_counter() - started
+
+    def report_ready():
+        import logging
+        since_launch = os.getenv(LAUNCHED_AT_ENV)
+        # uvicorn only configures its own loggers
+        logging.getLogger('uvicorn.error').info(
+            'worker %d ready: imports %.2fs, startup done %.2fs after import%s', os.getpid(), import_seconds,
+            time.perf_counter() - started - import_seconds,
+            f', {time.time() - float(since_launch):.2f}s after launch' if since_launch else '')
+
+    app.router.on_startup.append(report_ready)
+    return app, import_seconds
+
+
+def __getattr__(name):
+    # `app` is imported on first access, so the launcher process (which only runs the prestart
+    # and supervises the workers) never imports the API itself
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    app, _ = _load_app()
+    globals()['app'] = app
+    return app
+
+
+def run_prestart() -> float:
+    import database
+    import prestart
+
+    seconds = prestart.run(database.engine)
+    # the workers open their own connections
+    database.engine.dispose()
+    return seconds
+
+
+def worker_count(requested: int) -> int:
+    import httpcache
+
+    if httpcache.MULTIPROCESS_SAFE:
+        return requested or os.cpu_count() or 1
+    if requested > 1:
+        # each worker would bump only its own versions and keep serving bodies the others made stale
+        raise SystemExit(f'{requested} workers need a response cache shared between them: set CACHE_BACKEND=redis '
+                         'or RESPONSE_CACHE=false, or run one worker')
+    return 1
+
+
+def serve(workers: int, host: str, port: int, access_log: bool) -> None:
+    import uvicorn
+    import prestart
+
+    workers = worker_count(workers)
+    prestart_seconds = run_prestart()
+    print(f'prestart done in {prestart_seconds:.2f}s; starting {workers} worker(s) on {host}:{port}', flush=True)
+    os.environ[prestart.DONE_ENV] = '1'
+    os.environ[LAUNCHED_AT_ENV] = repr(time.time())
+    os.environ['WEB_CONCURRENCY'] = str(workers)  # the workers size their hashing pools by it (see hashing)
+    uvicorn.run('main:app', host=host, port=port, workers=workers, reload=False, access_log=access_log,
+                proxy_headers=True)
+
+
+def serve_dev(host: str, port: int) -> None:
     import uvicorn
 
-    # Run the FastAPI app with reload in development
-    uvicorn.run(app, host='0.0.0.0', port=8002, reload=True)
+    uvicorn.run('main:app', host=host, port=port, reload=True)
+
+
+def _measure_worker() -> None:
+    # runs in a fresh interpreter, like a newly spawned worker
+    import asyncio
+
+    app, import_seconds = _load_app()
+    started = time.perf_counter()
+
+    async def lifespan():
+        async with app.router.lifespan_context(app):
+            pass
+
+    asyncio.run(lifespan())
+    print(json.dumps({'imports': import_seconds, 'startup': time.perf_counter() - started}))
+
+
+def _slowest_imports(importtime_log: str, top: int = 10):
+    # `-X importtime` lines: "import time: <self us> | <cumulative us> | <indent><module>"
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        rows.append((len(module) - len(module.lstrip()), module.strip(), int(cumulative) / 1e6))
+    api_depth = next((depth for depth, module, _ in rows if module == 'api'), None)
+    if api_depth is None:
+        return []
+    direct = [(module, seconds) for depth, module, seconds in rows if depth == api_depth + 2]
+    return sorted(direct, key=lambda r: -r[1])[:top]
+
+
+def measure(runs: int) -> None:
+    import prestart
+
+    print(f'prestart: {run_prestart():.2f}s')
+    env = dict(os.environ, **{prestart.DONE_ENV: '1'})
+    log = ''
+    for i in range(runs):
+        started = time.perf_counter()
+        child = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--measure-worker'],
+                               env=env, capture_output=True, text=True, check=True)
+        wall = time.perf_counter() - started
+        timings = json.loads(child.stdout.strip().splitlines()[-1])
+        log = child.stderr
+        print(f'worker cold start {i + 1}: {wall:.2f}s total (imports {timings["imports"]:.2f}s, '
+              f'startup {timings["startup"]:.2f}s, interpreter and the rest {wall - timings["imports"] - timings["startup"]:.2f}s)')
+    print('slowest imports of api (cumulative):')
+    for module, seconds in _slowest_imports(log):
+        print(f'  {module:<24} {seconds * 1000:7.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the ADSWeb API')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WEB_CONCURRENCY, help='worker processes (WEB_CONCURRENCY; default one per CPU)')
+    parser.add_argument('--no-access-log', dest='access_log', action='store_false')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--dev', action='store_true', help='single worker with auto-reload')
+    mode.add_argument('--prestart-only', action='store_true', help='run the one-time startup work and exit')
+    mode.add_argument('--measure', type=int, nargs='?', const=3, metavar='RUNS', help='time worker cold starts')
+    mode.add_argument('--measure-worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.dev:
+        serve_dev(args.host, args.port)
+    elif args.prestart_only:
+        print(f'prestart done in {run_prestart():.2f}s')
+    elif args.measure:
+        measure(args.measure)
+    elif args.measure_worker:
+        _measure_worker()
+    else:
+        serve(args.workers, args.host, args.port, args.access_log)
+
+
+if __name__ == '__main__':
+    main()
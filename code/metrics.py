@@ -0,0 +1,192 @@
+"""In-process metric primitives shared by the diagnostics modules.
+
+Histograms and counters may carry labels; `render()` writes every registered
+metric in the Prometheus text exposition format for the /metrics endpoint.
+"""
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style (upper bounds, plus +Inf)."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative, running = [], 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return {"buckets": dict(zip(self.buckets + (float("inf"),), cumulative)), "count": running, "sum": total}
+
+
+class Counter:
+    """Monotonic counter; `inc` takes the label values in `labelnames` order."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: Tuple[str, ...] = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class HistogramFamily:
+    """Histograms of one metric split by label values; children are created on first use."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children: Dict[Tuple[str, ...], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> Histogram:
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.name, self.help, self.buckets))
+        return child
+
+    def children(self) -> Dict[Tuple[str, ...], Histogram]:
+        with self._lock:
+            return dict(self._children)
+
+
+class Gauge:
+    """Value read from `fn` at scrape time; `fn` returns a number or {label values: number}."""
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: Sequence[str] = (), kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+
+_histograms: Dict[str, Histogram] = {}
+_metrics: Dict[str, object] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(name: str, factory: Callable):
+    with _registry_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = factory()
+        return metric
+
+
+def histogram(name: str, help: str, buckets: Optional[Sequence[float]] = None) -> Histogram:
+    h = _register(name, lambda: Histogram(name, help, buckets or DEFAULT_BUCKETS))
+    with _registry_lock:
+        _histograms[name] = h
+    return h
+
+
+def histograms() -> Dict[str, Histogram]:
+    with _registry_lock:
+        return dict(_histograms)
+
+
+def histogram_family(name: str, help: str, labelnames: Sequence[str],
+                     buckets: Optional[Sequence[float]] = None) -> HistogramFamily:
+    return _register(name, lambda: HistogramFamily(name, help, labelnames, buckets or DEFAULT_BUCKETS))
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(name, lambda: Counter(name, help, labelnames))
+
+
+def gauge(name: str, help: str, fn: Callable, labelnames: Sequence[str] = (), kind: str = "gauge") -> Gauge:
+    """Register a scrape-time callback; `kind="counter"` for totals kept elsewhere."""
+    with _registry_lock:
+        g = _metrics[name] = Gauge(name, help, fn, labelnames, kind)
+        return g
+
+
+# --- Prometheus text format ---
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _histogram_lines(name: str, labelnames, labelvalues, h: Histogram, out: List[str]) -> None:
+    snap = h.snapshot()
+    for bound, count in snap["buckets"].items():
+        le = 'le="%s"' % _number(bound)
+        out.append(f"{name}_bucket{_labels(labelnames, labelvalues, le)} {count}")
+    out.append(f"{name}_sum{_labels(labelnames, labelvalues)} {_number(snap['sum'])}")
+    out.append(f"{name}_count{_labels(labelnames, labelvalues)} {snap['count']}")
+
+
+def render() -> str:
+    with _registry_lock:
+        registered = sorted(_metrics.items())
+    out: List[str] = []
+    for name, metric in registered:
+        if isinstance(metric, Histogram):
+            out += [f"# HELP {name} {metric.help}", f"# TYPE {name} histogram"]
+            _histogram_lines(name, (), (), metric, out)
+        elif isinstance(metric, HistogramFamily):
+            out += [f"# HELP {name} {metric.help}", f"# TYPE {name} histogram"]
+            for values, child in sorted(metric.children().items()):
+                _histogram_lines(name, metric.labelnames, values, child, out)
+        elif isinstance(metric, Counter):
+            out += [f"# HELP {name} {metric.help}", f"# TYPE {name} counter"]
+            for values, value in sorted(metric.snapshot().items()):
+                out.append(f"{name}{_labels(metric.labelnames, values)} {_number(value)}")
+        elif isinstance(metric, Gauge):
+            value = metric.fn()
+            if value is None:
+                continue
+            out += [f"# HELP {name} {metric.help}", f"# TYPE {name} {metric.kind}"]
+            samples = value.items() if isinstance(value, dict) else [((), value)]
+            for values, v in sorted(samples):
+                out.append(f"{name}{_labels(metric.labelnames, values)} {_number(v)}")
+    return "\n".join(out) + "\n"
@@ -0,0 +1,136 @@
+"""Versioned schema migrations.
+
+Applied versions are recorded in `schema_migrations`. Index migrations use
+`CREATE INDEX CONCURRENTLY` on PostgreSQL, which does not block writes to a
+live table but cannot run inside a transaction, so every step is written to be
+safe to re-run after an interruption. On PostgreSQL `upgrade` holds an advisory
+lock, so several workers starting at once apply each migration only once.
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, select, text
+import partitions
+import rollups
+import search
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key held while migrating
+_MIGRATION_LOCK = 0x6d696772
+
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', String(50), primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: str
+    description: str
+    apply: Callable
+
+
+def create_index(engine, name: str, table: str, columns: Sequence[str], using: Optional[str] = None) -> None:
+    """CREATE INDEX IF NOT EXISTS; concurrently on PostgreSQL.
+
+    `columns` may be expressions with an operator class, e.g. "(lower(last_name)) text_pattern_ops";
+    `using` picks the index method, e.g. "gin".
+    """
+    definition = f"{f'USING {using} ' if using else ''}({', '.join(columns)})"
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}'))
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if table == partitions.PARENT and partitions.is_partitioned(conn):
+            partitions.create_index(conn, name, columns, using)
+            return
+        # an interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index behind that IF NOT EXISTS would keep
+        valid = conn.execute(text(
+            'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name'
+        ), {'name': name}).scalar()
+        if valid is False:
+            logger.warning('dropping invalid index %s', name)
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+        conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}'))
+
+
+def _indexes(*specs: Tuple[str, str, Sequence[str]]) -> Callable:
+    def apply(engine):
+        for name, table, columns in specs:
+            create_index(engine, name, table, columns)
+    return apply
+
+
+def _search_indexes(engine) -> None:
+    if engine.dialect.name != 'postgresql':
+        return  # other backends search an in-process index (see search)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    for name, using, columns in search.PG_INDEXES:
+        create_index(engine, name, 'patients', columns, using)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration('0001', 'keyset pagination and updated_at indexes', _indexes(
+        ('ix_addresses_city_id', 'addresses', ('city', 'id')),
+        ('ix_patients_last_name_id', 'patients', ('last_name', 'id')),
+        ('ix_dentists_last_name_id', 'dentists', ('last_name', 'id')),
+        ('ix_appointments_scheduled_at_id', 'appointments', ('scheduled_at', 'id')),
+        ('ix_addresses_updated_at', 'addresses', ('updated_at',)),
+        ('ix_patients_updated_at', 'patients', ('updated_at',)),
+        ('ix_dentists_updated_at', 'dentists', ('updated_at',)),
+        ('ix_appointments_updated_at', 'appointments', ('updated_at',)),
+    )),
+    Migration('0002', 'appointment schedule indexes', _indexes(
+        ('ix_appointments_dentist_id_scheduled_at', 'appointments', ('dentist_id', 'scheduled_at')),
+        ('ix_appointments_surgery_id_scheduled_at', 'appointments', ('surgery_id', 'scheduled_at')),
+        ('ix_appointments_patient_id_scheduled_at', 'appointments', ('patient_id', 'scheduled_at')),
+        ('ix_dentist_working_hours_dentist_id', 'dentist_working_hours', ('dentist_id',)),
+    )),
+    Migration('0003', 'monthly partitions for appointments (PostgreSQL only)', partitions.convert),
+    Migration('0004', 'backfill daily appointment rollups', rollups.rebuild),
+    Migration('0005', 'patient search indexes (PostgreSQL only)', _search_indexes),
+]
+
+
+def applied(engine) -> dict:
+    _metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        return {row.version: row.applied_at for row in conn.execute(select(schema_migrations))}
+
+
+def pending(engine) -> List[Migration]:
+    done = applied(engine)
+    return [m for m in MIGRATIONS if m.version not in done]
+
+
+def _apply_pending(engine) -> List[str]:
+    ran = []
+    for migration in pending(engine):
+        logger.info('applying migration %s: %s', migration.version, migration.description)
+        migration.apply(engine)
+        with engine.begin() as conn:
+            conn.execute(schema_migrations.insert().values(
+                version=migration.version, description=migration.description, applied_at=datetime.utcnow()))
+        ran.append(migration.version)
+    return ran
+
+
+def upgrade(engine) -> List[str]:
+    """Apply pending migrations in order; returns the versions applied."""
+    if engine.dialect.name != 'postgresql':
+        return _apply_pending(engine)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock_conn:
+        lock_conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': _MIGRATION_LOCK})
+        try:
+            return _apply_pending(engine)
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': _MIGRATION_LOCK})
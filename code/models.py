@@ -1,11 +1,16 @@
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
+    Date,
     DateTime,
+    Time,
     ForeignKey,
     Text,
     Table,
+    Index,
+    JSON,
 )
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -22,12 +27,14 @@ user_roles = Table(
 
 class Address(Base):
     __tablename__ = 'addresses'
+    __table_args__ = (Index('ix_addresses_city_id', 'city', 'id'),)
     id = Column(Integer, primary_key=True)
     street = Column(String(200), nullable=False)
     city = Column(String(100), nullable=False)
     state = Column(String(100), nullable=True)
     postal_code = Column(String(20), nullable=True)
     country = Column(String(100), nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Backrefs
     patients = relationship('Patient', back_populates='address')
@@ -39,12 +46,14 @@ class Address(Base):
 
 class Patient(Base):
     __tablename__ = 'patients'
+    __table_args__ = (Index('ix_patients_last_name_id', 'last_name', 'id'),)
     id = Column(Integer, primary_key=True)
     first_name = Column(String(100), nullable=False)
     last_name = Column(String(100), nullable=False)
     email = Column(String(200), nullable=True, unique=True)
     phone = Column(String(50), nullable=True)
     address_id = Column(Integer, ForeignKey('addresses.id'), nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     address = relationship('Address', back_populates='patients')
     appointments = relationship('Appointment', back_populates='patient', cascade='all, delete-orphan')
@@ -55,6 +64,7 @@ class Patient(Base):
 
 class Dentist(Base):
     __tablename__ = 'dentists'
+    __table_args__ = (Index('ix_dentists_last_name_id', 'last_name', 'id'),)
     id = Column(Integer, primary_key=True)
     first_name = Column(String(100), nullable=False)
     last_name = Column(String(100), nullable=False)
@@ -62,9 +72,11 @@ class Dentist(Base):
     email = Column(String(200), nullable=True, unique=True)
     phone = Column(String(50), nullable=True)
     address_id = Column(Integer, ForeignKey('addresses.id'), nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     address = relationship('Address', back_populates='dentists')
     appointments = relationship('Appointment', back_populates='dentist', cascade='all, delete-orphan')
+    working_hours = relationship('WorkingHours', back_populates='dentist', cascade='all, delete-orphan')
 
     def __repr__(self):
         return f"<Dentist(id={self.id}, name={self.first_name} {self.last_name})>"
@@ -84,12 +96,21 @@ class Surgery(Base):
 
 class Appointment(Base):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        Index('ix_appointments_scheduled_at_id', 'scheduled_at', 'id'),
+        Index('ix_appointments_dentist_id_scheduled_at', 'dentist_id', 'scheduled_at'),
+        Index('ix_appointments_surgery_id_scheduled_at', 'surgery_id', 'scheduled_at'),
+        Index('ix_appointments_patient_id_scheduled_at', 'patient_id', 'scheduled_at'),
+    )
     id = Column(Integer, primary_key=True)
     patient_id = Column(Integer, ForeignKey('patients.id'), nullable=False)
     dentist_id = Column(Integer, ForeignKey('dentists.id'), nullable=False)
     surgery_id = Column(Integer, ForeignKey('surgeries.id'), nullable=True)
     scheduled_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     notes = Column(Text, nullable=True)
+    # NULL means availability.DEFAULT_DURATION_MINUTES
+    duration_minutes = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     patient = relationship('Patient', back_populates='appointments')
     dentist = relationship('Dentist', back_populates='appointments')
@@ -99,6 +120,59 @@ class Appointment(Base):
         return f"<Appointment(id={self.id}, patient_id={self.patient_id}, dentist_id={self.dentist_id})>"
 
 
+class WorkingHours(Base):
+    __tablename__ = 'dentist_working_hours'
+    id = Column(Integer, primary_key=True)
+    dentist_id = Column(Integer, ForeignKey('dentists.id'), nullable=False, index=True)
+    weekday = Column(Integer, nullable=False)  # 0 = Monday
+    starts_at = Column(Time, nullable=False)
+    ends_at = Column(Time, nullable=False)
+
+    dentist = relationship('Dentist', back_populates='working_hours')
+
+    def __repr__(self):
+        return f"<WorkingHours(dentist_id={self.dentist_id}, weekday={self.weekday}, {self.starts_at}-{self.ends_at})>"
+
+
+class AppointmentDailyStat(Base):
+    """Appointments and booked minutes per day for one dentist, surgery or city (see rollups.py)."""
+    __tablename__ = 'appointment_daily_stats'
+    __table_args__ = (Index('ix_appointment_daily_stats_dimension_day', 'dimension', 'day'),)
+    dimension = Column(String(20), primary_key=True)  # dentist, surgery or city
+    key = Column(String(100), primary_key=True)  # dentist/surgery id, or the city ('' for no address)
+    day = Column(Date, primary_key=True)
+    appointments = Column(Integer, nullable=False, default=0)
+    minutes = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<AppointmentDailyStat({self.dimension}={self.key}, day={self.day}, appointments={self.appointments})>"
+
+
+class Change(Base):
+    """One committed insert, update or delete of a synced row, numbered in commit order (see changefeed.py)."""
+    __tablename__ = 'change_log'
+    __table_args__ = {'sqlite_autoincrement': True}  # never reuse a pruned seq
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    entity = Column(String(20), nullable=False)  # table name, e.g. patients
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(6), nullable=False)  # insert, update or delete
+    data = Column(JSON, nullable=True)  # inserted row or updated columns; null for deletes
+    changed_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<Change(seq={self.seq}, {self.op} {self.entity} {self.entity_id})>"
+
+
+class CacheVersion(Base):
+    """Version counter of one table for the response cache's ETags (see httpcache.DatabaseVersions)."""
+    __tablename__ = 'cache_versions'
+    table_name = Column(String(64), primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<CacheVersion({self.table_name}={self.version})>"
+
+
 class Role(Base):
     __tablename__ = 'roles'
     id = Column(Integer, primary_key=True)
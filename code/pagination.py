@@ -0,0 +1,49 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, Callable, Optional, Sequence, Tuple
+
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+
+# Response header carrying the cursor for the next page of a keyset-paginated list
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'cannot encode {type(value).__name__} in a cursor')
+
+
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps(list(values), default=_default, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, types: Sequence[Callable[[Any], Any]]) -> Tuple[Any, ...]:
+    """Decode an opaque cursor back into its key values, coercing each with `types`."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise InvalidCursor('malformed cursor')
+        return tuple(t(v) for t, v in zip(types, values))
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor('malformed cursor') from e
+
+
+def keyset_page(stmt, columns: Sequence, after: Optional[Sequence[Any]], limit: Optional[int]):
+    """Order `stmt` by `columns` and restrict it to rows strictly after the `after` key."""
+    if after is not None:
+        stmt = stmt.where(tuple_(*columns) > tuple_(*after))
+    return stmt.order_by(*columns).limit(limit)
@@ -0,0 +1,168 @@
+"""Monthly range partitioning of `appointments` on PostgreSQL.
+
+Migration 0003 (`convert`) rebuilds `appointments` as a table partitioned by the
+month of `scheduled_at`. Queries with a time range then only touch the partitions
+in that range, and `archive` retires a whole month by dropping its partition.
+Rows for months without a partition land in `appointments_default`. `ensure` is
+run at prestart, after bulk generation and by scripts/archive_appointments.py.
+It creates partitions for the months found in the default partition (moving
+their rows over) and for the next `PARTITION_MONTHS_AHEAD` months.
+
+The partitioned table's primary key is (id, scheduled_at) because it has to
+include the partition key. Ids still come from the same sequence, and the ORM
+keeps mapping `id` alone. Other backends keep the plain table, and everything
+here is a no-op for them.
+"""
+import logging
+import os
+from datetime import date, datetime
+from typing import List, Optional, Sequence
+
+from sqlalchemy import text
+import models
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+
+PARENT = models.Appointment.__tablename__
+DEFAULT_PARTITION = f'{PARENT}_default'
+
+# pg_advisory_xact_lock key held while adding partitions
+_PARTITION_LOCK = 0x70617274
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    years, index = divmod(month.month - 1 + n, 12)
+    return date(month.year + years, index + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'{PARENT}_y{month.year:04d}m{month.month:02d}'
+
+
+def is_partitioned(conn) -> bool:
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)'), {'t': PARENT}).scalar() == 'p'
+
+
+def partitions(conn) -> List[str]:
+    """Names of the attached monthly partitions, oldest first."""
+    rows = conn.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = to_regclass(:t) ORDER BY c.relname'), {'t': PARENT})
+    return [name for name, in rows if name != DEFAULT_PARTITION]
+
+
+def _bounds(month: date) -> str:
+    return f"FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+
+
+def _months_with_rows(conn, table: str) -> List[date]:
+    return [month_start(m) for m, in conn.execute(text(f"SELECT DISTINCT date_trunc('month', scheduled_at) FROM {table}"))]
+
+
+def _wanted_months(found: Sequence[date], today: Optional[date], ahead: int) -> List[date]:
+    current = month_start(today or datetime.utcnow())
+    return sorted(set(found) | {add_months(current, n) for n in range(ahead + 1)})
+
+
+def _add_partition(conn, month: date) -> int:
+    """Create the partition for `month`, moving its rows out of the default partition; returns rows moved."""
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    waiting = conn.execute(text(f'SELECT count(*) FROM {DEFAULT_PARTITION} WHERE scheduled_at >= :s AND scheduled_at < :e'),
+                           {'s': start, 'e': end}).scalar()
+    if not waiting:
+        conn.execute(text(f'CREATE TABLE {name} PARTITION OF {PARENT} FOR VALUES {_bounds(month)}'))
+        return 0
+    # a new partition may not overlap rows still in the default one, so move them into a standalone table first
+    conn.execute(text(f'CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    conn.execute(text(
+        f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE scheduled_at >= :s AND scheduled_at < :e RETURNING *) '
+        f'INSERT INTO {name} SELECT * FROM moved'), {'s': start, 'e': end})
+    conn.execute(text(f'ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES {_bounds(month)}'))
+    return waiting
+
+
+def ensure(engine, ahead: int = PARTITION_MONTHS_AHEAD, today: Optional[date] = None) -> List[str]:
+    """Add partitions for months waiting in the default partition and the months ahead; returns those created."""
+    if engine.dialect.name != 'postgresql':
+        return []
+    created = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+        conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _PARTITION_LOCK})
+        existing = set(partitions(conn))
+        for month in _wanted_months(_months_with_rows(conn, DEFAULT_PARTITION), today, ahead):
+            if partition_name(month) in existing:
+                continue
+            moved = _add_partition(conn, month)
+            logger.info('created partition %s (%d rows moved from %s)', partition_name(month), moved, DEFAULT_PARTITION)
+            created.append(partition_name(month))
+    return created
+
+
+def convert(engine) -> None:
+    """Rebuild `appointments` as a monthly partitioned table (migration 0003).
+
+    Runs in one transaction holding an ACCESS EXCLUSIVE lock, so writes to appointments
+    wait while existing rows are copied; schedule it with that in mind on a large table.
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+    table = models.Appointment.__table__
+    staging = f'{PARENT}_partitioned'
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            return
+        conn.execute(text(f'LOCK TABLE {PARENT} IN ACCESS EXCLUSIVE MODE'))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': PARENT}).scalar()
+        months = _wanted_months(_months_with_rows(conn, PARENT), None, PARTITION_MONTHS_AHEAD)
+
+        conn.execute(text(
+            f'CREATE TABLE {staging} (LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (scheduled_at)'))
+        for month in months:
+            conn.execute(text(f'CREATE TABLE {partition_name(month)} PARTITION OF {staging} FOR VALUES {_bounds(month)}'))
+        conn.execute(text(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {staging} DEFAULT'))
+        copied = conn.execute(text(f'INSERT INTO {staging} SELECT * FROM {PARENT}')).rowcount
+        if sequence:
+            # dropping the old table would otherwise drop the id sequence with it
+            conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY {staging}.id'))
+        conn.execute(text(f'DROP TABLE {PARENT}'))
+        conn.execute(text(f'ALTER TABLE {staging} RENAME TO {PARENT}'))
+
+        conn.execute(text(f'ALTER TABLE {PARENT} ADD CONSTRAINT {PARENT}_pkey PRIMARY KEY (id, scheduled_at)'))
+        for fk in table.foreign_key_constraints:
+            columns = [c.name for c in fk.columns]
+            referred = fk.elements[0].column.table.name
+            conn.execute(text(
+                f'ALTER TABLE {PARENT} ADD CONSTRAINT {PARENT}_{"_".join(columns)}_fkey FOREIGN KEY ({", ".join(columns)}) '
+                f'REFERENCES {referred} ({", ".join(e.column.name for e in fk.elements)})'))
+        for index in table.indexes:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS {index.name} ON {PARENT} ({", ".join(c.name for c in index.columns)})'))
+    logger.info('partitioned %s by month: %d rows in %d partitions', PARENT, copied, len(months))
+
+
+def create_index(conn, name: str, columns: Sequence[str], using: Optional[str] = None) -> None:
+    """CREATE INDEX for the partitioned table without blocking writes (`conn` in autocommit).
+
+    CONCURRENTLY is not supported on a partitioned table: create the index on the parent only,
+    build each partition's index concurrently, then attach them, which makes the parent index valid.
+    """
+    definition = f"{f'USING {using} ' if using else ''}({', '.join(columns)})"
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON ONLY {PARENT} {definition}'))
+    for partition in partitions(conn) + [DEFAULT_PARTITION]:
+        child = f'{name}_{partition[len(PARENT) + 1:]}'[:63]
+        conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {child} ON {partition} {definition}'))
+        attached = conn.execute(text(
+            'SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:child) AND inhparent = to_regclass(:parent)'),
+            {'child': child, 'parent': name}).first()
+        if not attached:
+            conn.execute(text(f'ALTER INDEX {name} ATTACH PARTITION {child}'))
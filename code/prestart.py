@@ -0,0 +1,56 @@
+"""One-time startup work: schema upgrade (search indexes included), partitions and seed data.
+
+`python main.py` runs this once before starting the server workers and sets
+`ADSWEB_PRESTART_DONE=1` in their environment, so workers boot without touching
+the schema. Workers started any other way (plain `uvicorn main:app`) still run
+it at startup; on PostgreSQL an advisory lock makes them take turns, and the
+ones that follow find nothing left to do.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+DONE_ENV = 'ADSWEB_PRESTART_DONE'
+
+# pg_advisory_lock key held while running the prestart steps
+_PRESTART_LOCK = 0x70726573
+
+
+def done() -> bool:
+    return os.getenv(DONE_ENV, '').lower() in ('1', 'true', 'yes')
+
+
+@contextmanager
+def _locked(engine):
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock_conn:
+        lock_conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': _PRESTART_LOCK})
+        try:
+            yield
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': _PRESTART_LOCK})
+
+
+def run(engine) -> float:
+    """Upgrade the schema, add upcoming partitions and seed roles/admin; returns the seconds taken."""
+    # imported here: workers whose prestart already ran never need them
+    import partitions
+    import schema
+    import seed
+
+    started = time.perf_counter()
+    with _locked(engine):
+        if schema.MIGRATE_ON_STARTUP:
+            schema.upgrade(engine)
+        partitions.ensure(engine)
+        seed.seed_initial_data()
+    elapsed = time.perf_counter() - started
+    logger.info('prestart finished in %.2fs', elapsed)
+    return elapsed
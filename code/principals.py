@@ -0,0 +1,73 @@
+"""Authenticated principal cache.
+
+`auth.get_current_user` resolves a token subject to a `Principal` (id, username
+and role names) and keeps it here so authorizing a request does not need the
+database. Entries expire after a TTL and the least recently used ones are
+evicted once the cache is full; writers that change a user's roles call
+`invalidate`. Changes made by another process are picked up when the TTL runs out.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import FrozenSet, Iterable, Optional
+
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 60))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+
+
+@dataclass(frozen=True)
+class Principal:
+    id: Optional[int]
+    username: str
+    roles: FrozenSet[str]
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(id=user.id, username=user.username, roles=frozenset(r.name for r in user.roles))
+
+
+class PrincipalCache:
+    def __init__(self, ttl: float = PRINCIPAL_CACHE_TTL_SECONDS, maxsize: int = PRINCIPAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            principal, expires = entry
+            if expires < time.monotonic():
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return principal
+
+    def put(self, principal: Principal) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[principal.username] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, usernames: Iterable[str]) -> None:
+        with self._lock:
+            for username in usernames:
+                self._entries.pop(username, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+cache = PrincipalCache()
+
+
+def invalidate(*usernames: str) -> None:
+    cache.invalidate(usernames)
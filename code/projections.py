@@ -0,0 +1,250 @@
+"""Column projections for the list endpoints.
+
+Lists select only the columns their response carries and turn each row into a
+plain dict, skipping ORM identity-map bookkeeping and per-row model
+validation; the dicts are encoded straight to JSON by `fastjson`. Field names
+match the corresponding `*Out` models in api.py.
+
+Clients may narrow a list to some of those fields (`fields=` on the list
+endpoints, see `parse_fields`): only the chosen columns are selected, and the
+address join is left out unless the address is included. A list always keeps
+`id` and the columns it is sorted by, which its cursor is built from.
+
+`get_*` fetch given ids with one `IN` query, and `related` loads the patients,
+dentists and surgeries a page of appointments refers to, one query per kind,
+for the compound `/appointments?include=` document.
+"""
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import crud
+import models
+from pagination import keyset_page, STREAM_CHUNK_SIZE
+
+ADDRESS_FIELDS = ('id', 'street', 'city', 'state', 'postal_code', 'country')
+PATIENT_FIELDS = ('id', 'first_name', 'last_name', 'email', 'phone')
+DENTIST_FIELDS = ('id', 'first_name', 'last_name', 'specialty', 'email', 'phone')
+SURGERY_FIELDS = ('id', 'title', 'description')
+APPOINTMENT_FIELDS = ('id', 'patient_id', 'dentist_id', 'surgery_id', 'scheduled_at', 'duration_minutes', 'notes')
+
+# list name -> (selectable fields, keyset key)
+LISTS = {
+    'addresses': (ADDRESS_FIELDS, crud.ADDRESS_KEY),
+    'patients': (PATIENT_FIELDS, crud.PATIENT_KEY),
+    'dentists': (DENTIST_FIELDS, crud.DENTIST_KEY),
+    'surgeries': (SURGERY_FIELDS, crud.SURGERY_KEY),
+    'appointments': (APPOINTMENT_FIELDS, crud.APPOINTMENT_KEY),
+}
+
+Row = Dict[str, Any]
+
+
+def _names(value: Optional[str]) -> List[str]:
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def parse_fields(name: str, value: Optional[str], required: Sequence[str] = ()) -> Tuple[str, ...]:
+    """The fields of list `name` to return for a `fields=` value (all when empty), in response order.
+
+    `required` fields are kept whatever was asked for. Raises ValueError naming any unknown field.
+    """
+    allowed, key = LISTS[name]
+    wanted = set(_names(value))
+    if not wanted:
+        return allowed
+    unknown = wanted.difference(allowed)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}; expected some of {', '.join(allowed)}")
+    wanted.update(column.key for column in key)
+    wanted.update(required)
+    return tuple(f for f in allowed if f in wanted)
+
+
+def parse_ids(value: Optional[str], limit: int) -> Optional[List[int]]:
+    """Distinct ids from an `ids=1,2,3` value, in the order given; None when empty.
+
+    Raises ValueError on a non-integer or more than `limit` ids.
+    """
+    names = _names(value)
+    if not names:
+        return None
+    try:
+        ids = list(dict.fromkeys(int(name) for name in names))
+    except ValueError:
+        raise ValueError('ids must be comma-separated integers') from None
+    if len(ids) > limit:
+        raise ValueError(f'At most {limit} ids per request')
+    return ids
+
+
+def parse_include(value: Optional[str], allowed: Sequence[str]) -> Set[str]:
+    """The related records named in an `include=` value; raises ValueError on one not in `allowed`."""
+    names = set(_names(value))
+    unknown = names.difference(allowed)
+    if unknown:
+        raise ValueError(f"Cannot include {', '.join(sorted(unknown))}; expected some of {', '.join(allowed) or 'nothing'}")
+    return names
+
+
+def _columns(model, fields: Sequence[str]):
+    return [getattr(model, f) for f in fields]
+
+
+def _addresses(fields: Sequence[str] = ADDRESS_FIELDS):
+    return select(*_columns(models.Address, fields))
+
+
+def _with_address(model, fields: Sequence[str], address: bool):
+    # the address nests: one outer join, address columns after the owner's
+    if not address:
+        return select(*_columns(model, fields))
+    A = models.Address
+    return select(*_columns(model, fields), *_columns(A, ADDRESS_FIELDS)).outerjoin(A, model.address_id == A.id)
+
+
+def _surgeries(fields: Sequence[str] = SURGERY_FIELDS):
+    return select(*_columns(models.Surgery, fields))
+
+
+def _appointments(fields: Sequence[str] = APPOINTMENT_FIELDS):
+    return select(*_columns(models.Appointment, fields))
+
+
+def _flat(fields):
+    def convert(rows) -> List[Row]:
+        return [dict(zip(fields, row)) for row in rows]
+    return convert
+
+
+def _nested(fields):
+    n = len(fields)
+
+    def convert(rows) -> List[Row]:
+        out = []
+        for row in rows:
+            owner = dict(zip(fields, row[:n]))
+            owner['address'] = dict(zip(ADDRESS_FIELDS, row[n:])) if row[n] is not None else None
+            out.append(owner)
+        return out
+    return convert
+
+
+def _rows(fields, address: bool = False):
+    return _nested(fields) if address else _flat(fields)
+
+
+def _list(db: Session, stmt, key, convert, limit: int, after: Optional[Sequence[Any]]) -> List[Row]:
+    return convert(db.execute(keyset_page(stmt, key, after, limit)).all())
+
+
+def _by_ids(db: Session, stmt, model, convert, ids: Sequence[int]) -> List[Row]:
+    # in the order asked for; ids with no row are left out
+    rows = {row['id']: row for row in convert(db.execute(stmt.where(model.id.in_(ids))).all())}
+    return [rows[i] for i in ids if i in rows]
+
+
+def _iter(db: Session, stmt, key, convert, after: Optional[Sequence[Any]], chunk_size: int) -> Iterator[List[Row]]:
+    # yields one converted partition at a time so streams keep flat memory use
+    result = db.execute(keyset_page(stmt, key, after, None).execution_options(stream_results=True, yield_per=chunk_size))
+    for rows in result.partitions():
+        yield convert(rows)
+
+
+def list_addresses(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None,
+                   fields: Sequence[str] = ADDRESS_FIELDS) -> List[Row]:
+    return _list(db, _addresses(fields), crud.ADDRESS_KEY, _flat(fields), limit, after)
+
+
+def iter_addresses(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                   fields: Sequence[str] = ADDRESS_FIELDS) -> Iterator[List[Row]]:
+    return _iter(db, _addresses(fields), crud.ADDRESS_KEY, _flat(fields), after, chunk_size)
+
+
+def list_patients(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None,
+                  fields: Sequence[str] = PATIENT_FIELDS, address: bool = True) -> List[Row]:
+    return _list(db, _with_address(models.Patient, fields, address), crud.PATIENT_KEY, _rows(fields, address), limit, after)
+
+
+def iter_patients(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                  fields: Sequence[str] = PATIENT_FIELDS, address: bool = True) -> Iterator[List[Row]]:
+    return _iter(db, _with_address(models.Patient, fields, address), crud.PATIENT_KEY, _rows(fields, address), after, chunk_size)
+
+
+def list_dentists(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None,
+                  fields: Sequence[str] = DENTIST_FIELDS, address: bool = False) -> List[Row]:
+    return _list(db, _with_address(models.Dentist, fields, address), crud.DENTIST_KEY, _rows(fields, address), limit, after)
+
+
+def iter_dentists(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                  fields: Sequence[str] = DENTIST_FIELDS, address: bool = False) -> Iterator[List[Row]]:
+    return _iter(db, _with_address(models.Dentist, fields, address), crud.DENTIST_KEY, _rows(fields, address), after, chunk_size)
+
+
+def list_surgeries(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None,
+                   fields: Sequence[str] = SURGERY_FIELDS) -> List[Row]:
+    return _list(db, _surgeries(fields), crud.SURGERY_KEY, _flat(fields), limit, after)
+
+
+def iter_surgeries(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                   fields: Sequence[str] = SURGERY_FIELDS) -> Iterator[List[Row]]:
+    return _iter(db, _surgeries(fields), crud.SURGERY_KEY, _flat(fields), after, chunk_size)
+
+
+def list_appointments(db: Session, limit: int = 100, after: Optional[Sequence[Any]] = None,
+                      dentist_id: Optional[int] = None, patient_id: Optional[int] = None, surgery_id: Optional[int] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None,
+                      fields: Sequence[str] = APPOINTMENT_FIELDS) -> List[Row]:
+    stmt = _appointments(fields).where(*crud.appointment_filters(dentist_id, patient_id, surgery_id, start, end))
+    return _list(db, stmt, crud.APPOINTMENT_KEY, _flat(fields), limit, after)
+
+
+def iter_appointments(db: Session, after: Optional[Sequence[Any]] = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                      dentist_id: Optional[int] = None, patient_id: Optional[int] = None, surgery_id: Optional[int] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None,
+                      fields: Sequence[str] = APPOINTMENT_FIELDS) -> Iterator[List[Row]]:
+    stmt = _appointments(fields).where(*crud.appointment_filters(dentist_id, patient_id, surgery_id, start, end))
+    return _iter(db, stmt, crud.APPOINTMENT_KEY, _flat(fields), after, chunk_size)
+
+
+# --- by id ---
+
+def get_addresses(db: Session, ids: Sequence[int], fields: Sequence[str] = ADDRESS_FIELDS) -> List[Row]:
+    return _by_ids(db, _addresses(fields), models.Address, _flat(fields), ids)
+
+
+def get_patients(db: Session, ids: Sequence[int], fields: Sequence[str] = PATIENT_FIELDS, address: bool = True) -> List[Row]:
+    return _by_ids(db, _with_address(models.Patient, fields, address), models.Patient, _rows(fields, address), ids)
+
+
+def get_dentists(db: Session, ids: Sequence[int], fields: Sequence[str] = DENTIST_FIELDS, address: bool = False) -> List[Row]:
+    return _by_ids(db, _with_address(models.Dentist, fields, address), models.Dentist, _rows(fields, address), ids)
+
+
+def get_surgeries(db: Session, ids: Sequence[int], fields: Sequence[str] = SURGERY_FIELDS) -> List[Row]:
+    return _by_ids(db, _surgeries(fields), models.Surgery, _flat(fields), ids)
+
+
+def get_appointments(db: Session, ids: Sequence[int], fields: Sequence[str] = APPOINTMENT_FIELDS) -> List[Row]:
+    return _by_ids(db, _appointments(fields), models.Appointment, _flat(fields), ids)
+
+
+# include= name -> (key in the compound document, loader); patients come with their address, as from /patients
+RELATED = {
+    'patient': ('patients', get_patients),
+    'dentist': ('dentists', get_dentists),
+    'surgery': ('surgeries', get_surgeries),
+}
+
+
+def related(db: Session, appointments: Sequence[Row], include: Sequence[str]) -> Dict[str, List[Row]]:
+    """Each distinct patient, dentist and/or surgery the appointments refer to, one query per kind, by id."""
+    out: Dict[str, List[Row]] = {}
+    for name in RELATED:
+        if name not in include:
+            continue
+        key, load = RELATED[name]
+        ids = sorted({row[f'{name}_id'] for row in appointments if row[f'{name}_id'] is not None})
+        out[key] = load(db, ids) if ids else []
+    return out
@@ -0,0 +1,244 @@
+"""Read replica routing.
+
+With `DATABASE_REPLICA_URLS` set, the request session of a GET/HEAD request
+reads from a replica picked round-robin or by fewest checked-out connections
+(`REPLICA_STRATEGY`). Flushes and INSERT/UPDATE/DELETE statements always go to
+the primary, and a session that has written reads from the primary from then
+on. A background thread probes each replica every `REPLICA_CHECK_INTERVAL`
+seconds; replicas that fail the probe, drop a connection or lag more than
+`REPLICA_MAX_LAG_SECONDS` get no reads until a later probe passes. With no
+replica left, reads fall back to the primary.
+
+Read-your-writes: a response to a request that committed a write carries the
+commit time in an `X-Last-Write` header and a `last_write` cookie. A request
+presenting either reads from the primary until `READ_YOUR_WRITES_SECONDS` (or
+the replica's measured lag, if larger) have passed.
+"""
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REPLICA_URLS = [u.strip() for u in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if u.strip()]
+REPLICA_STRATEGY = os.getenv('REPLICA_STRATEGY', 'round_robin').lower()
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 5))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+
+STRATEGIES = ('round_robin', 'least_connections')
+READ_METHODS = ('GET', 'HEAD')
+SCOPE_KEY = 'db_replica'  # set in the ASGI scope of a request reading from a replica
+LAST_WRITE_HEADER = 'X-Last-Write'
+LAST_WRITE_COOKIE = 'last_write'
+
+# a caught-up standby reports no lag even when the primary has been idle for a while
+_PG_LAG = text(
+    'SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+
+READS_ROUTED = metrics.counter('db_reads_routed_total', 'Read-only request sessions by the database serving them',
+                               ('target',))
+
+
+class Replica:
+    """One replica: `bind` serves sessions, `probe_engine` (unpooled) runs the health checks."""
+
+    def __init__(self, name: str, bind, probe_engine):
+        self.name = name
+        self.bind = bind
+        self.probe_engine = probe_engine
+        self.healthy = False  # no reads until the first probe passes
+        self.lag = 0.0
+        self.checked_at: Optional[float] = None
+        self.error: Optional[str] = None
+
+        @event.listens_for(bind, 'handle_error')
+        def _mark_down(exception_context):
+            if exception_context.is_disconnect and self.healthy:
+                logger.warning('replica %s dropped a connection; reading from the others until it passes a check', name)
+                self.healthy = False
+
+    def connections(self) -> int:
+        pool = self.bind.pool
+        return pool.checkedout() if hasattr(pool, 'checkedout') else 0
+
+    def probe(self) -> None:
+        try:
+            with self.probe_engine.connect() as conn:
+                lag = conn.execute(_PG_LAG).scalar() if conn.dialect.name == 'postgresql' else 0
+        except Exception as exc:
+            if self.healthy or self.checked_at is None:
+                logger.warning('replica %s failed its health check: %s', self.name, exc)
+            self.healthy, self.error = False, str(exc)
+        else:
+            if not self.healthy and self.checked_at is not None:
+                logger.info('replica %s is back', self.name)
+            self.healthy, self.lag, self.error = True, float(lag or 0), None
+        self.checked_at = time.time()
+
+    def status(self) -> dict:
+        return {'name': self.name, 'healthy': self.healthy, 'lag_seconds': self.lag, 'checked_at': self.checked_at,
+                'connections': self.connections(), 'error': self.error}
+
+
+class ReplicaSet:
+    def __init__(self, replicas: List[Replica], strategy: str = REPLICA_STRATEGY,
+                 max_lag: float = REPLICA_MAX_LAG_SECONDS, interval: float = REPLICA_CHECK_INTERVAL):
+        if strategy not in STRATEGIES:
+            raise RuntimeError(f'unknown REPLICA_STRATEGY {strategy!r} (expected one of {", ".join(STRATEGIES)})')
+        self.replicas = replicas
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.interval = interval
+        self._turn = itertools.count()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        metrics.gauge('db_replica_healthy', 'Whether a replica is receiving reads (1) or not (0)',
+                      lambda: {(r.name,): int(r.healthy and r.lag <= self.max_lag) for r in self.replicas}, ('replica',))
+        metrics.gauge('db_replica_lag_seconds', 'Replication lag measured by the last health check',
+                      lambda: {(r.name,): r.lag for r in self.replicas}, ('replica',))
+
+    def choose(self, last_write: Optional[float] = None) -> Optional[Replica]:
+        """A replica for a read-only session, or None to read from the primary."""
+        since_write = time.time() - last_write if last_write is not None else math.inf
+        eligible = [r for r in self.replicas if r.healthy and r.lag <= self.max_lag
+                    and since_write > max(READ_YOUR_WRITES_SECONDS, r.lag)]
+        if not eligible:
+            READS_ROUTED.inc(labels=('primary',))
+            return None
+        if self.strategy == 'least_connections':
+            replica = min(eligible, key=Replica.connections)
+        else:
+            replica = eligible[next(self._turn) % len(eligible)]
+        READS_ROUTED.inc(labels=(replica.name,))
+        return replica
+
+    def for_request(self, request) -> Optional[Replica]:
+        if request is None or request.method not in READ_METHODS:
+            return None
+        replica = self.choose(last_write(request))
+        if replica is not None:
+            request.scope[SCOPE_KEY] = replica.name  # the response cache must not keep what it may lag behind on
+        return replica
+
+    def check(self) -> None:
+        for replica in self.replicas:
+            replica.probe()
+
+    def _run(self) -> None:
+        while True:
+            self.check()
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self) -> None:
+        """Start the health checks in a daemon thread (once per process)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='replica-health', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+
+class RoutingSessionMixin:
+    """Session that reads through the replica in `info['replica']` until it writes."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get('replica')
+        if replica is not None:
+            if not self._flushing and not isinstance(clause, UpdateBase):
+                return replica.bind
+            # later reads must see this session's own writes
+            self.info['replica'] = None
+        return super().get_bind(mapper, clause=clause, **kw)
+
+
+def last_write(request) -> Optional[float]:
+    value = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+# --- committed writes of the current request ---
+
+class _RequestWrites:
+    __slots__ = ('committed_at',)
+
+    def __init__(self):
+        self.committed_at: Optional[float] = None
+
+
+_request_writes: ContextVar[Optional[_RequestWrites]] = ContextVar('request_writes', default=None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['replica_wrote'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _executed(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['replica_wrote'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    if session.info.pop('replica_wrote', False):
+        writes = _request_writes.get()
+        if writes is not None:
+            writes.committed_at = time.time()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _rolled_back(session, previous_transaction):
+    session.info.pop('replica_wrote', None)
+
+
+class ReadYourWritesMiddleware:
+    """ASGI middleware stamping responses of requests that committed a write with the commit time."""
+
+    def __init__(self, app):
+        self.app = app
+        # past the lag limit replicas get no reads anyway, so the cookie need not outlive it
+        self.max_age = math.ceil(max(READ_YOUR_WRITES_SECONDS, REPLICA_MAX_LAG_SECONDS)) + 1
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        writes = _RequestWrites()
+        token = _request_writes.set(writes)
+
+        async def send_with_stamp(message):
+            if message['type'] == 'http.response.start' and writes.committed_at is not None:
+                stamp = f'{writes.committed_at:.3f}'
+                message['headers'] = list(message.get('headers', [])) + [
+                    (LAST_WRITE_HEADER.lower().encode(), stamp.encode()),
+                    (b'set-cookie', f'{LAST_WRITE_COOKIE}={stamp}; Max-Age={self.max_age}; Path=/; '
+                                    f'HttpOnly; SameSite=Lax'.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stamp)
+        finally:
+            _request_writes.reset(token)
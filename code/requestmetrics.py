@@ -0,0 +1,64 @@
+"""Per-route request latency, SQL statement and database time metrics.
+
+`RequestMetricsMiddleware` wraps the whole app: it binds a `sqlstats` counter
+to the request, reports the statement count in the `X-SQL-Statements` header
+and, once the response has been sent, records the request under its route
+template (not the raw path, so ids do not explode the label set).
+"""
+import time
+
+import metrics
+import sqlstats
+
+REQUEST_DURATION = metrics.histogram_family(
+    'http_request_duration_seconds', 'Request latency by route, including streamed bodies',
+    ('method', 'route', 'status'))
+REQUEST_STATEMENTS = metrics.counter(
+    'http_request_sql_statements_total', 'SQL statements issued while serving requests', ('method', 'route'))
+REQUEST_DB_SECONDS = metrics.counter(
+    'http_request_db_seconds_total', 'Time spent in SQL statements while serving requests', ('method', 'route'))
+
+_in_flight = 0
+metrics.gauge('http_requests_in_flight', 'Requests currently being served', lambda: _in_flight)
+
+_STATEMENT_HEADER = sqlstats.STATEMENT_COUNT_HEADER.lower().encode()
+UNMATCHED_ROUTE = 'unmatched'
+
+
+def route_label(scope) -> str:
+    route = scope.get('route')
+    if route is not None:
+        return getattr(route, 'path', UNMATCHED_ROUTE)
+    # set by middleware that answered before routing (the response cache)
+    return scope.get('route_template', UNMATCHED_ROUTE)
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        global _in_flight
+        status = 500
+        started = time.perf_counter()
+        _in_flight += 1
+        with sqlstats.count_statements() as counter:
+            async def send_with_count(message):
+                nonlocal status
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                    message['headers'] = list(message.get('headers', [])) + [
+                        (_STATEMENT_HEADER, str(counter.count).encode())]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_count)
+            finally:
+                _in_flight -= 1
+                method, route = scope['method'], route_label(scope)
+                REQUEST_DURATION.labels(method, route, str(status)).observe(time.perf_counter() - started)
+                if counter.count:
+                    REQUEST_STATEMENTS.inc(counter.count, (method, route))
+                    REQUEST_DB_SECONDS.inc(counter.seconds, (method, route))
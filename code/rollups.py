@@ -0,0 +1,254 @@
+"""Per-day appointment counts for the /stats dashboards.
+
+`appointment_daily_stats` holds the number of appointments and booked minutes
+per day for every dentist, surgery and city (of the patient's address). The
+appointment write paths (crud, availability.book and bulk ingest) `track` the
+rows they insert or delete (deleting a patient or dentist deletes theirs), and
+just before the session commits the resulting deltas are upserted in the same transaction, so the counts always agree with
+the committed appointments. Reading a range costs one row per day and key
+however long the history is.
+
+City counts follow where the patients live now: a patient changing address,
+or an address changing city, moves the counts of their live appointments
+(`move_patient`, `move_address`) in the same transaction.
+
+Archiving leaves the counts alone, so they keep covering archived months;
+archived rows record the city they were counted under, and stay there.
+`rebuild` recounts everything from the table and the archive. Use it to repair
+the counts after writes that bypassed those paths (raw SQL, seed.generate).
+"""
+import logging
+import os
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Date, String, cast, delete, event, func, insert, literal, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+import availability
+import models
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ('dentist', 'surgery', 'city')
+PERIODS = ('day', 'week')
+# longest range /stats answers; keeps every response bounded by days x keys
+STATS_MAX_DAYS = int(os.getenv('STATS_MAX_DAYS', 366))
+# rows per multi-row upsert
+UPSERT_BATCH = 1000
+
+Stat = models.AppointmentDailyStat
+Delta = Dict[Tuple[str, str, date], List[int]]
+
+
+def _minutes(duration_minutes: Optional[int]) -> int:
+    return duration_minutes or availability.DEFAULT_DURATION_MINUTES
+
+
+# --- incremental maintenance ---
+
+def track(session: Session, appointment: Any, sign: int = 1) -> None:
+    """Count an appointment inserted (+1) or deleted (-1) by this session's transaction.
+
+    `appointment` may be a model instance, a row or a dict with the appointment's columns.
+    """
+    get = appointment.get if isinstance(appointment, dict) else lambda f: getattr(appointment, f)
+    session.info.setdefault('rollup_rows', []).append(
+        (sign, get('dentist_id'), get('surgery_id'), get('patient_id'), get('scheduled_at'), get('duration_minutes')))
+
+
+def track_inserted(session: Session, rows: Sequence[Dict[str, Any]]) -> None:
+    for row in rows:
+        track(session, row)
+
+
+def _deltas(session: Session, rows: Sequence[tuple]) -> Delta:
+    P, A = models.Patient, models.Address
+    # an archived row carries the city it was counted under as a 7th item
+    patient_ids = {row[3] for row in rows if len(row) == 6}
+    cities = dict(session.execute(select(P.id, A.city).outerjoin(A, P.address_id == A.id).where(P.id.in_(patient_ids))).all()) if patient_ids else {}
+    deltas: Delta = defaultdict(lambda: [0, 0])
+    for sign, dentist_id, surgery_id, patient_id, scheduled_at, duration, *counted in rows:
+        day = scheduled_at.date()
+        city = counted[0] if counted else cities.get(patient_id)
+        keys = [('dentist', str(dentist_id)), ('city', city or '')]
+        if surgery_id is not None:
+            keys.append(('surgery', str(surgery_id)))
+        for dimension, key in keys:
+            delta = deltas[(dimension, key, day)]
+            delta[0] += sign
+            delta[1] += sign * _minutes(duration)
+    return deltas
+
+
+def _pending(session: Session) -> Delta:
+    return session.info.setdefault('rollup_deltas', defaultdict(lambda: [0, 0]))
+
+
+def settle(session: Session) -> None:
+    """Turn the rows tracked so far into deltas now, before a write removes or moves their patients."""
+    rows = session.info.pop('rollup_rows', None)
+    if rows:
+        pending = _pending(session)
+        for row, (n, m) in _deltas(session, rows).items():
+            pending[row][0] += n
+            pending[row][1] += m
+
+
+def _move_city(session: Session, patients, old: Optional[str], new: Optional[str]) -> None:
+    old, new = old or '', new or ''
+    if old == new:
+        return
+    settle(session)
+    A, P = models.Appointment, models.Patient
+    pending = _pending(session)
+    for scheduled_at, duration in session.execute(
+            select(A.scheduled_at, A.duration_minutes).join(P, P.id == A.patient_id).where(patients)):
+        for city, sign in ((old, -1), (new, 1)):
+            delta = pending[('city', city, scheduled_at.date())]
+            delta[0] += sign
+            delta[1] += sign * _minutes(duration)
+
+
+def move_patient(session: Session, patient_id: int, address_id: Optional[int]) -> None:
+    """Move a patient's appointments to the city of `address_id`. Call before the patient is updated."""
+    P, Ad = models.Patient, models.Address
+    new = select(Ad.city).where(Ad.id == address_id).scalar_subquery()
+    row = session.execute(select(Ad.city, new).select_from(P).outerjoin(Ad, Ad.id == P.address_id)
+                          .where(P.id == patient_id)).first()
+    if row is not None:
+        _move_city(session, P.id == patient_id, *row)
+
+
+def move_address(session: Session, address_id: int, city: Optional[str]) -> None:
+    """Move the appointments of the patients at an address to its new `city`. Call before the address is updated."""
+    Ad = models.Address
+    old = session.execute(select(Ad.city).where(Ad.id == address_id)).first()
+    if old is not None:
+        _move_city(session, models.Patient.address_id == address_id, old[0], city)
+
+
+def _upsert(session: Session, deltas: Delta) -> None:
+    dialect = session.get_bind().dialect.name
+    if dialect not in ('postgresql', 'sqlite'):
+        raise RuntimeError(f'appointment rollups need ON CONFLICT support; {dialect} is not supported')
+    dml = postgresql if dialect == 'postgresql' else sqlite
+    # sorted, so concurrent commits lock the rows in the same order and cannot deadlock
+    values = [{'dimension': d, 'key': k, 'day': day, 'appointments': n, 'minutes': m}
+              for (d, k, day), (n, m) in sorted(deltas.items()) if n or m]
+    for i in range(0, len(values), UPSERT_BATCH):
+        stmt = dml.insert(Stat).values(values[i:i + UPSERT_BATCH])
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[Stat.dimension, Stat.key, Stat.day],
+            set_={'appointments': Stat.appointments + stmt.excluded.appointments,
+                  'minutes': Stat.minutes + stmt.excluded.minutes}))
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply(session):
+    settle(session)
+    deltas = session.info.pop('rollup_deltas', None)
+    if deltas:
+        _upsert(session, deltas)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    # a rolled back savepoint leaves the enclosing transaction's rows to be counted
+    if not session.in_transaction():
+        session.info.pop('rollup_rows', None)
+        session.info.pop('rollup_deltas', None)
+
+
+# --- full rebuild ---
+
+def _day(dialect: str, column):
+    return func.date(column) if dialect == 'sqlite' else cast(column, Date)
+
+
+def _live_counts(dialect: str):
+    A, P, Ad = models.Appointment, models.Patient, models.Address
+    day = _day(dialect, A.scheduled_at)
+    minutes = func.sum(func.coalesce(A.duration_minutes, availability.DEFAULT_DURATION_MINUTES))
+    by_owner = [
+        select(literal(dimension), cast(column, String), day, func.count(), minutes)
+        .where(column.is_not(None)).group_by(column, day)
+        for dimension, column in (('dentist', A.dentist_id), ('surgery', A.surgery_id))
+    ]
+    city = func.coalesce(Ad.city, '')
+    by_city = (select(literal('city'), city, day, func.count(), minutes).select_from(A)
+               .join(P, P.id == A.patient_id).outerjoin(Ad, Ad.id == P.address_id).group_by(city, day))
+    return by_owner + [by_city]
+
+
+def _recount(db: Session, directory: Optional[str]) -> None:
+    import archive
+
+    A = models.Appointment
+    dialect = db.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # bookings wait until the recount commits, so none is counted twice or missed
+        db.execute(text(f'LOCK TABLE {A.__tablename__} IN SHARE MODE'))
+    db.execute(delete(Stat))
+    for stmt in _live_counts(dialect):
+        db.execute(insert(Stat).from_select(('dimension', 'key', 'day', 'appointments', 'minutes'), stmt))
+    for month in archive.archived_months(directory):
+        rows = list(archive.read_month(month, directory))
+        # a half-finished archive run leaves rows in both places; the live copy was counted above
+        live = set(db.scalars(select(A.id).where(A.id.in_([r['id'] for r in rows])))) if rows else set()
+        for i in range(0, len(rows), UPSERT_BATCH):
+            batch = [(1, r['dentist_id'], r['surgery_id'], r['patient_id'], r['scheduled_at'], r['duration_minutes'])
+                     + ((r['city'],) if 'city' in r else ())
+                     for r in rows[i:i + UPSERT_BATCH] if r['id'] not in live]
+            if batch:
+                _upsert(db, _deltas(db, batch))
+
+
+def _snapshot(db: Session) -> Dict[Tuple[str, str, date], Tuple[int, int]]:
+    rows = db.execute(select(Stat.dimension, Stat.key, Stat.day, Stat.appointments, Stat.minutes)
+                      .where(Stat.appointments != 0))
+    return {(d, k, day): (n, m) for d, k, day, n, m in rows}
+
+
+def rebuild(engine, directory: Optional[str] = None) -> int:
+    """Recount every day from the appointments table and the archive; returns the stat rows written."""
+    # the commit moves the shared cache versions (see httpcache), so every worker drops its cached /stats
+    # responses; a server on CACHE_BACKEND=local would not see it, so it does not cache /stats at all
+    with Session(engine) as db:
+        _recount(db, directory)
+        written = db.scalar(select(func.count()).select_from(Stat))
+        db.commit()
+    logger.info('rebuilt appointment rollups: %d rows', written)
+    return written
+
+
+def verify(engine, directory: Optional[str] = None) -> List[Tuple[Tuple[str, str, date], Any, Any]]:
+    """Compare the rollups with a recount, changing nothing; returns (row, kept, recounted) for each difference."""
+    with Session(engine) as db:
+        kept = _snapshot(db)
+        _recount(db, directory)
+        recounted = _snapshot(db)
+        db.rollback()
+    return [(row, kept.get(row), recounted.get(row)) for row in sorted(kept.keys() | recounted.keys())
+            if kept.get(row) != recounted.get(row)]
+
+
+# --- reading ---
+
+def stats(db: Session, dimension: str, start: date, end: date, period: str = 'day',
+          key: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Counts per `period` (weeks start on Monday) and key for days in [start, end), oldest first."""
+    where = [Stat.dimension == dimension, Stat.day >= start, Stat.day < end]
+    if key is not None:
+        where.append(Stat.key == key)
+    rows = db.execute(select(Stat.key, Stat.day, Stat.appointments, Stat.minutes).where(*where)).all()
+    totals: Dict[Tuple[date, str], List[int]] = defaultdict(lambda: [0, 0])
+    for row_key, day, appointments, minutes in rows:
+        if period == 'week':
+            day -= timedelta(days=day.weekday())
+        total = totals[(day, row_key)]
+        total[0] += appointments
+        total[1] += minutes
+    return [{'key': row_key, 'period': day, 'appointments': n, 'minutes': m}
+            for (day, row_key), (n, m) in sorted(totals.items()) if n]
@@ -0,0 +1,38 @@
+"""Schema creation and in-place upgrades for existing databases.
+
+`create_all` only creates missing tables, so columns added to existing models
+(nullable ones only) are added here as well. Indexes on existing tables come from
+the versioned migrations in `migrations`, which build them concurrently on PostgreSQL.
+"""
+import logging
+import os
+
+from sqlalchemy import inspect
+from database import Base
+import migrations
+import models  # noqa: F401  (registers the tables on Base.metadata)
+
+logger = logging.getLogger(__name__)
+
+# Set to false when migrations are run out of band with scripts/migrate.py
+MIGRATE_ON_STARTUP = os.getenv('DB_MIGRATE_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+
+
+def _add_column(conn, table, column) -> None:
+    col_type = column.type.compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}')
+
+
+def upgrade(engine) -> None:
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            missing = [c for c in table.columns if c.name not in existing]
+            for column in missing:
+                if not column.nullable:
+                    raise RuntimeError(f'cannot add NOT NULL column {table.name}.{column.name} in place')
+                logger.info('adding column %s.%s', table.name, column.name)
+                _add_column(conn, table, column)
+    migrations.upgrade(engine)
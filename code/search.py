@@ -0,0 +1,258 @@
+"""Patient search.
+
+On PostgreSQL searches run against pg_trgm GIN and `text_pattern_ops` B-tree
+expression indexes created by migration 0005. Other backends (SQLite for
+local runs) use an in-process n-gram index built from the patients table on
+first use and kept current from committed ORM sessions.
+"""
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Session
+import models
+
+NGRAM = 3
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+_PHONE_LIKE = re.compile(r'^[\d\s+().-]+$')
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_email(value: Optional[str]) -> str:
+    return (value or '').strip().lower()
+
+
+def normalize_phone(value: Optional[str]) -> str:
+    return _NON_DIGITS.sub('', value or '')
+
+
+def normalize_term(term: str) -> str:
+    term = term.strip()
+    if _PHONE_LIKE.match(term) and any(c.isdigit() for c in term):
+        return normalize_phone(term)
+    return term.lower()
+
+
+# --- PostgreSQL ---
+
+def _phone_key_sql(t: str = '') -> str:
+    return f"regexp_replace({t}phone, '[^0-9]', '', 'g')"
+
+
+def _doc_sql(t: str = '') -> str:
+    # only IMMUTABLE functions, so the same expression can back an index
+    return (f"lower({t}first_name || ' ' || {t}last_name || ' ' || coalesce({t}email, '') || ' ' || "
+            f"coalesce({_phone_key_sql(t)}, ''))")
+
+
+def _prefix_keys_sql(t: str = '') -> Tuple[str, ...]:
+    return (f'lower({t}last_name)', f'lower({t}first_name)', f'lower({t}email)', _phone_key_sql(t))
+
+
+# (name, index method, key expressions) of the patients indexes, created by migration 0005 (see migrations)
+PG_INDEXES = [
+    ('ix_patients_search_trgm', 'gin', (f'({_doc_sql()}) gin_trgm_ops',)),
+    ('ix_patients_last_name_prefix', None, (f'({_prefix_keys_sql()[0]}) text_pattern_ops',)),
+    ('ix_patients_first_name_prefix', None, (f'({_prefix_keys_sql()[1]}) text_pattern_ops',)),
+    ('ix_patients_email_prefix', None, (f'({_prefix_keys_sql()[2]}) text_pattern_ops',)),
+    ('ix_patients_phone_prefix', None, (f'({_prefix_keys_sql()[3]}) text_pattern_ops',)),
+]
+
+
+def _escape_like(term: str) -> str:
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _pg_search(db: Session, term: str, limit: int, prefix: bool, options: Sequence) -> List[models.Patient]:
+    stmt = select(models.Patient).options(*options)
+    if prefix:
+        keys = _prefix_keys_sql('patients.')
+        stmt = stmt.where(text(' OR '.join(f"{k} LIKE :p ESCAPE '\\'" for k in keys))).order_by(
+            text(f'({keys[0]} LIKE :p) DESC'), models.Patient.last_name, models.Patient.id)
+        params = {'p': _escape_like(term) + '%'}
+    else:
+        name = "lower(patients.first_name || ' ' || patients.last_name)"
+        stmt = stmt.where(text(f"{_doc_sql('patients.')} LIKE :p ESCAPE '\\'")).order_by(
+            text(f'similarity({name}, :t) DESC'), models.Patient.last_name, models.Patient.id)
+        params = {'p': '%' + _escape_like(term) + '%', 't': term}
+    return db.execute(stmt.limit(limit), params).unique().scalars().all()
+
+
+# --- in-process fallback ---
+
+def _grams(s: str) -> Set[str]:
+    return {s[i:i + NGRAM] for i in range(len(s) - NGRAM + 1)}
+
+
+class NgramIndex:
+    """Trigram postings for substring search plus a sorted token list for prefix search."""
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._docs: Dict[int, Tuple[str, Tuple[str, ...], str]] = {}
+        self._postings: Dict[str, Set[int]] = defaultdict(set)
+        self._tokens: List[Tuple[str, int]] = []
+
+    def clear(self) -> None:
+        with self._lock:
+            self.loaded = False
+            self._docs.clear()
+            self._postings.clear()
+            self._tokens = []
+
+    def load(self, db: Session) -> None:
+        with self._lock:
+            self.clear()
+            rows = db.execute(select(
+                models.Patient.id, models.Patient.first_name, models.Patient.last_name,
+                models.Patient.email, models.Patient.phone,
+            ))
+            for row in rows:
+                self.add(*row)
+            self.loaded = True
+
+    def add(self, patient_id: int, first_name: str, last_name: str, email: Optional[str], phone: Optional[str]) -> None:
+        # same order as _doc_sql, so substring matches across fields agree with PostgreSQL
+        tokens = tuple(t for t in (
+            (first_name or '').lower(), (last_name or '').lower(), normalize_email(email), normalize_phone(phone),
+        ) if t)
+        doc = ' '.join(tokens)
+        with self._lock:
+            self.remove(patient_id)
+            self._docs[patient_id] = (doc, tokens, (last_name or '').lower())
+            for g in _grams(doc):
+                self._postings[g].add(patient_id)
+            for t in tokens:
+                insort(self._tokens, (t, patient_id))
+
+    def remove(self, patient_id: int) -> None:
+        with self._lock:
+            entry = self._docs.pop(patient_id, None)
+            if entry is None:
+                return
+            doc, tokens, _ = entry
+            for g in _grams(doc):
+                ids = self._postings.get(g)
+                if ids is not None:
+                    ids.discard(patient_id)
+                    if not ids:
+                        del self._postings[g]
+            for t in tokens:
+                i = bisect_left(self._tokens, (t, patient_id))
+                if i < len(self._tokens) and self._tokens[i] == (t, patient_id):
+                    del self._tokens[i]
+
+    def _prefix_matches(self, term: str) -> Set[int]:
+        ids = set()
+        i = bisect_left(self._tokens, (term, -1))
+        while i < len(self._tokens) and self._tokens[i][0].startswith(term):
+            ids.add(self._tokens[i][1])
+            i += 1
+        return ids
+
+    def _substring_matches(self, term: str) -> Set[int]:
+        grams = sorted(_grams(term), key=lambda g: len(self._postings.get(g, ())))
+        if not grams:
+            return set()
+        ids = set(self._postings.get(grams[0], ()))
+        for g in grams[1:]:
+            ids &= self._postings.get(g, set())
+            if not ids:
+                return ids
+        return {i for i in ids if term in self._docs[i][0]}
+
+    def search(self, term: str, limit: int, prefix: bool) -> List[int]:
+        with self._lock:
+            ids = self._prefix_matches(term)
+            if not prefix and len(term) >= NGRAM:
+                ids |= self._substring_matches(term)
+
+            def rank(patient_id):
+                _, tokens, last_name = self._docs[patient_id]
+                if term in tokens:
+                    score = 0
+                elif any(t.startswith(term) for t in tokens):
+                    score = 1
+                else:
+                    score = 2
+                return score, last_name, patient_id
+
+            return sorted(ids, key=rank)[:limit]
+
+
+_index = NgramIndex()
+
+
+def invalidate() -> None:
+    """Drop the in-process index; callers that write patients outside the ORM session use this."""
+    _index.clear()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    if not _index.loaded:
+        return
+    pending = session.info.setdefault('search_changes', {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, models.Patient):
+            pending[obj.id] = (obj.first_name, obj.last_name, obj.email, obj.phone)
+    for obj in session.deleted:
+        if isinstance(obj, models.Patient):
+            pending[obj.id] = None
+
+
+def track(session: Session, patient: models.Patient) -> None:
+    """Record a patient written with an INSERT/UPDATE ... RETURNING statement, which bypasses the flush hook."""
+    if _index.loaded:
+        session.info.setdefault('search_changes', {})[patient.id] = (
+            patient.first_name, patient.last_name, patient.email, patient.phone)
+
+
+def track_deleted(session: Session, patient_id: int) -> None:
+    if _index.loaded:
+        session.info.setdefault('search_changes', {})[patient_id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    pending = session.info.pop('search_changes', None)
+    if not pending or not _index.loaded:
+        return
+    for patient_id, fields in pending.items():
+        if fields is None:
+            _index.remove(patient_id)
+        else:
+            _index.add(patient_id, *fields)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('search_changes', None)
+
+
+def _fallback_search(db: Session, term: str, limit: int, prefix: bool, options: Sequence) -> List[models.Patient]:
+    if not _index.loaded:
+        _index.load(db)
+    ids = _index.search(term, limit, prefix)
+    if not ids:
+        return []
+    rows = db.execute(select(models.Patient).options(*options).where(models.Patient.id.in_(ids))).unique().scalars()
+    by_id = {p.id: p for p in rows}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def search_patients(db: Session, term: str, limit: int = DEFAULT_LIMIT, prefix: bool = False, options: Sequence = ()) -> List[models.Patient]:
+    term = normalize_term(term)
+    if not term:
+        return []
+    # a term shorter than a trigram cannot use the substring indexes; treat it as a typeahead prefix
+    prefix = prefix or len(term) < NGRAM
+    if db.get_bind().dialect.name == 'postgresql':
+        return _pg_search(db, term, limit, prefix, options)
+    return _fallback_search(db, term, limit, prefix, options)
@@ -1,6 +1,16 @@
+import argparse
+import csv
+import io
 import os
-from database import get_session
-import crud, models
+import random
+import time as _time
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Sequence, Tuple
+
+from sqlalchemy import func, select, text
+from database import engine, get_session
+import crud, httpcache, models, partitions, rollups
 
 
 def ensure_role(db, role_name: str, description: str = None):
@@ -33,3 +43,291 @@ def seed_initial_data():
                 db.commit()
     finally:
         db.close()
+
+
+# --- synthetic data generator ---
+#
+# `python seed.py generate --scale 100k` fills the clinic tables with realistic, deterministic
+# data for performance work: households sharing an address, dentists with weekly schedules and
+# appointment histories that grow towards the present and peak on weekday mornings. Rows are
+# written in batches with COPY on PostgreSQL and multi-row INSERTs elsewhere.
+
+GENERATE_BATCH_SIZE = int(os.getenv('GENERATE_BATCH_SIZE', 10000))
+DEFAULT_ANCHOR = date(2026, 1, 5)  # "today" of the generated data; fixed so a seed always gives the same rows
+
+
+@dataclass(frozen=True)
+class Scale:
+    patients: int
+    dentists: int
+    appointments: int
+
+
+# named after the appointment row count
+SCALES = {
+    '1k': Scale(patients=300, dentists=5, appointments=1_000),
+    '100k': Scale(patients=25_000, dentists=60, appointments=100_000),
+    '10m': Scale(patients=2_000_000, dentists=1_500, appointments=10_000_000),
+}
+
+_FIRST_NAMES = ('Olivia', 'Amelia', 'Isla', 'Ava', 'Mia', 'Ivy', 'Lily', 'Isabella', 'Rosie', 'Sophia', 'Grace', 'Freya',
+                'Willow', 'Florence', 'Emily', 'Ella', 'Poppy', 'Evie', 'Elsie', 'Charlotte', 'Aisha', 'Fatima', 'Maryam',
+                'Zara', 'Priya', 'Noah', 'Oliver', 'George', 'Arthur', 'Muhammad', 'Leo', 'Harry', 'Oscar', 'Archie',
+                'Henry', 'Theodore', 'Freddie', 'Jack', 'Charlie', 'Theo', 'Thomas', 'Jacob', 'Alfie', 'Finley', 'Isaac',
+                'Omar', 'Ali', 'Yusuf', 'Arjun', 'Kai', 'Mateo', 'Luca', 'Adam', 'James', 'William', 'Daniel', 'Samuel')
+_LAST_NAMES = ('Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Robinson',
+               'Wright', 'Thompson', 'Evans', 'Walker', 'White', 'Roberts', 'Green', 'Hall', 'Wood', 'Jackson', 'Clarke',
+               'Khan', 'Ahmed', 'Ali', 'Hussain', 'Shah', 'Singh', 'Kaur', 'Lewis', 'Harris', 'Martin', 'Cooper', 'King',
+               'Lee', 'Baker', 'Harrison', 'Morgan', 'Allen', 'James', 'Scott', 'Phillips', 'Watson', 'Davis', 'Parker',
+               'Price', 'Bennett', 'Young', 'Griffiths', 'Mitchell', 'Kelly', 'Cook', 'Carter', 'Richardson', 'Bailey',
+               'Collins', 'Bell', 'Shaw', 'Murphy', 'Miller', 'Cox', 'Richards', 'Khan', 'Marshall', 'Anderson', 'Simpson',
+               'Ellis', 'Adams', 'Singh', 'Begum', 'Wilkinson', 'Foster', 'Chapman', 'Powell', 'Webb', 'Rogers', 'Gray',
+               'Mason', 'Nowak', 'Kowalski', 'Okafor', 'Mensah', 'Nguyen', 'Chen', 'Wang', 'Rossi', 'Murray', 'Hunt')
+_STREETS = ('High Street', 'Station Road', 'Main Street', 'Park Road', 'Church Road', 'Church Street', 'London Road',
+            'Victoria Road', 'Green Lane', 'Manor Road', 'Church Lane', 'Park Avenue', 'The Avenue', 'The Crescent',
+            'Queens Road', 'New Road', 'Grange Road', 'Kings Road', 'Mill Lane', 'School Lane', 'Springfield Road')
+_CITIES = (('Leeds', 'LS'), ('Manchester', 'M'), ('Birmingham', 'B'), ('Bristol', 'BS'), ('Sheffield', 'S'),
+           ('Liverpool', 'L'), ('Newcastle', 'NE'), ('Nottingham', 'NG'), ('Leicester', 'LE'), ('York', 'YO'),
+           ('Bradford', 'BD'), ('Cardiff', 'CF'), ('Coventry', 'CV'), ('Hull', 'HU'), ('Brighton', 'BN'))
+_SPECIALTIES = ('General Dentistry', 'General Dentistry', 'General Dentistry', 'Orthodontics', 'Periodontics',
+                'Endodontics', 'Paediatric Dentistry', 'Oral Surgery', 'Prosthodontics', 'Hygienist')
+_NOTES = ('Check-up', 'Scale and polish', 'Filling', 'Crown fitting', 'Root canal', 'Extraction', 'Emergency appointment',
+          'Whitening consultation', 'Brace adjustment', 'X-ray review')
+_DURATIONS = (15, 30, 30, 30, 30, 45, 60)
+_HOUSEHOLD_SIZES = (1, 2, 3, 4, 5)
+_HOUSEHOLD_WEIGHTS = (30, 33, 16, 14, 7)
+_WEEKDAY_LOAD = (1.25, 1.15, 1.0, 1.0, 0.85, 0.35, 0.0)
+_GRID_MINUTES = 15
+
+
+def _zipf_weights(n: int, s: float = 0.9) -> List[float]:
+    return [1 / (rank + 1) ** s for rank in range(n)]
+
+
+class _Writer:
+    """Buffers rows for one table and writes them in batches, committing after each."""
+
+    def __init__(self, conn, table, columns: Sequence[str], batch_size: int, after: Sequence['_Writer'] = ()):
+        self.conn = conn
+        self.after = after  # writers holding rows this table references; flushed first
+        self.table = table
+        self.columns = tuple(columns)
+        self.batch_size = batch_size
+        self.rows: List[tuple] = []
+        self.written = 0
+        self._copy = conn.dialect.name == 'postgresql' and conn.dialect.driver == 'psycopg2'
+
+    def add(self, row: tuple) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        for writer in self.after:
+            writer.flush()
+        if self._copy:
+            buf = io.StringIO()
+            csv.writer(buf).writerows(['' if v is None else v for v in row] for row in self.rows)
+            buf.seek(0)
+            cursor = self.conn.connection.dbapi_connection.cursor()
+            try:
+                # unquoted empty fields are NULL in CSV COPY; no generated text is empty
+                cursor.copy_expert(f"COPY {self.table.name} ({', '.join(self.columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+            finally:
+                cursor.close()
+            httpcache.mark_written(self.conn, self.table.name)
+        else:
+            self.conn.execute(self.table.insert(), [dict(zip(self.columns, row)) for row in self.rows])
+        self.conn.commit()
+        self.written += len(self.rows)
+        self.rows = []
+
+
+def _next_id(conn, model) -> int:
+    return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _working_hours(rng: random.Random) -> Dict[int, Tuple[time, time]]:
+    days = sorted(rng.sample(range(5), rng.choice((4, 5, 5, 5)))) + ([5] if rng.random() < 0.2 else [])
+    hours = {}
+    for d in days:
+        opens = rng.choice((time(8, 0), time(8, 30), time(9, 0), time(9, 0)))
+        closes = time(13, 0) if d == 5 else rng.choice((time(16, 0), time(17, 0), time(17, 0), time(18, 0)))
+        hours[d] = (opens, closes)
+    return hours
+
+
+def _slot_weights(opens: time, closes: time) -> List[float]:
+    # busiest first thing and after school; quietest over lunch
+    weights = []
+    minute = opens.hour * 60 + opens.minute
+    end = closes.hour * 60 + closes.minute
+    while minute + _GRID_MINUTES <= end:
+        hour = minute / 60
+        weights.append(1.6 if hour < 11 else 0.6 if 12 <= hour < 14 else 1.4 if hour >= 15.5 else 1.0)
+        minute += _GRID_MINUTES
+    return weights
+
+
+def generate(engine, scale: Scale, seed: int = 42, anchor: date = DEFAULT_ANCHOR, history_days: int = 3 * 365,
+             future_days: int = 90, batch_size: int = GENERATE_BATCH_SIZE, log=print) -> Dict[str, int]:
+    """Append deterministic synthetic clinic data at `scale`; returns rows written per table."""
+    rng = random.Random(seed)
+    stamp = datetime.combine(anchor, time(0, 0))
+    written: Dict[str, int] = {}
+    with engine.connect() as conn:
+        started = _time.perf_counter()
+
+        # households: one address shared by 1-5 patients, mostly with the same surname
+        address_id, patient_id = _next_id(conn, models.Address), _next_id(conn, models.Patient)
+        first_patient = patient_id
+        addresses = _Writer(conn, models.Address.__table__,
+                            ('id', 'street', 'city', 'state', 'postal_code', 'country', 'updated_at'), batch_size)
+        patients = _Writer(conn, models.Patient.__table__,
+                           ('id', 'first_name', 'last_name', 'email', 'phone', 'address_id', 'updated_at'), batch_size,
+                           after=(addresses,))
+        surname_weights = _zipf_weights(len(_LAST_NAMES))
+        while patient_id - first_patient < scale.patients:
+            size = min(rng.choices(_HOUSEHOLD_SIZES, _HOUSEHOLD_WEIGHTS)[0], scale.patients - (patient_id - first_patient))
+            household_address = None
+            if rng.random() < 0.95:
+                city, area = rng.choice(_CITIES)
+                addresses.add((address_id, f'{rng.randint(1, 250)} {rng.choice(_STREETS)}', city, None,
+                               f'{area}{rng.randint(1, 29)} {rng.randint(1, 9)}{rng.choice("ABDEFGHJLNPQRSTUWXYZ")}'
+                               f'{rng.choice("ABDEFGHJLNPQRSTUWXYZ")}', 'United Kingdom', stamp))
+                household_address = address_id
+                address_id += 1
+            surname = rng.choices(_LAST_NAMES, surname_weights)[0]
+            for _ in range(size):
+                last = surname if rng.random() < 0.85 else rng.choices(_LAST_NAMES, surname_weights)[0]
+                first = rng.choice(_FIRST_NAMES)
+                email = f'{first}.{last}.{patient_id}@example.com'.lower() if rng.random() < 0.9 else None
+                phone = f'07{rng.randint(100, 999)} {patient_id % 1000000:06d}' if rng.random() < 0.95 else None
+                patients.add((patient_id, first, last, email, phone, household_address, stamp))
+                patient_id += 1
+        patients.flush()
+        addresses.flush()
+        written['addresses'], written['patients'] = addresses.written, patients.written
+        log(f'addresses {addresses.written:,} patients {patients.written:,} ({_time.perf_counter() - started:.1f}s)')
+
+        # dentists, each with their own surgery and weekly working hours
+        dentist_id, surgery_id, hours_id = (_next_id(conn, m) for m in (models.Dentist, models.Surgery, models.WorkingHours))
+        dentists = _Writer(conn, models.Dentist.__table__,
+                           ('id', 'first_name', 'last_name', 'specialty', 'email', 'phone', 'address_id', 'updated_at'), batch_size)
+        surgeries = _Writer(conn, models.Surgery.__table__, ('id', 'title', 'description'), batch_size)
+        hours_rows = _Writer(conn, models.WorkingHours.__table__, ('id', 'dentist_id', 'weekday', 'starts_at', 'ends_at'),
+                             batch_size, after=(dentists,))
+        schedule = []
+        for _ in range(scale.dentists):
+            first, last = rng.choice(_FIRST_NAMES), rng.choice(_LAST_NAMES)
+            dentists.add((dentist_id, first, last, rng.choice(_SPECIALTIES), f'dr.{first}.{last}.{dentist_id}@clinic.example'.lower(),
+                          f'0113 {dentist_id % 1000000:06d}', None, stamp))
+            surgeries.add((surgery_id, f'Surgery {surgery_id}', f'Room for Dr {last}'))
+            week = _working_hours(rng)
+            for weekday, (opens, closes) in week.items():
+                hours_rows.add((hours_id, dentist_id, weekday, opens, closes))
+                hours_id += 1
+            schedule.append((dentist_id, surgery_id, week))
+            dentist_id += 1
+            surgery_id += 1
+        dentists.flush()
+        surgeries.flush()
+        hours_rows.flush()
+        written['dentists'], written['surgeries'], written['working_hours'] = dentists.written, surgeries.written, hours_rows.written
+
+        # appointment histories: busier towards the present, tailing off into the future,
+        # heavier early in the week and at the start and end of each day
+        days = [anchor - timedelta(days=n) for n in range(history_days, 0, -1)] + \
+               [anchor + timedelta(days=n) for n in range(future_days)]
+
+        def day_weight(i: int, day: date) -> float:
+            if day < anchor:
+                growth = 0.4 + 0.6 * i / max(1, history_days)
+            else:
+                growth = max(0.05, 1 - (day - anchor).days / max(1, future_days))
+            return growth * _WEEKDAY_LOAD[day.weekday()]
+
+        weights = [day_weight(i, d) for i, d in enumerate(days)]
+        total_weight = sum(w for _, _, week in schedule for d, w in zip(days, weights) if d.weekday() in week)
+        per_weight = scale.appointments / total_weight if total_weight else 0
+        grids = {}
+        appointment_id = _next_id(conn, models.Appointment)
+        appointments = _Writer(conn, models.Appointment.__table__,
+                               ('id', 'patient_id', 'dentist_id', 'surgery_id', 'scheduled_at', 'duration_minutes', 'notes',
+                                'updated_at'), batch_size)
+        patient_span = patient_id - first_patient
+        for dentist, surgery, week in schedule:
+            for day, weight in zip(days, weights):
+                if day.weekday() not in week or not patient_span:
+                    continue
+                opens, closes = week[day.weekday()]
+                slot_weights = grids.get((opens, closes)) or grids.setdefault((opens, closes), _slot_weights(opens, closes))
+                expected = weight * per_weight
+                n = min(int(expected) + (rng.random() < expected - int(expected)), len(slot_weights))
+                if not n:
+                    continue
+                picks = dict.fromkeys(rng.choices(range(len(slot_weights)), slot_weights, k=n * 2))
+                starts = sorted(list(picks)[:n])
+                day_start = datetime.combine(day, opens)
+                for k, slot in enumerate(starts):
+                    # never run into the next appointment or past closing
+                    room = (starts[k + 1] if k + 1 < len(starts) else len(slot_weights)) - slot
+                    duration = min(rng.choice(_DURATIONS), room * _GRID_MINUTES)
+                    # a minority of patients account for most visits
+                    patient = first_patient + int(patient_span * rng.random() ** 2.5)
+                    appointments.add((appointment_id, patient, dentist, surgery,
+                                      day_start + timedelta(minutes=slot * _GRID_MINUTES), duration,
+                                      rng.choice(_NOTES) if rng.random() < 0.3 else None, stamp))
+                    appointment_id += 1
+                if appointments.written and appointments.written % (batch_size * 50) == 0:
+                    log(f'appointments {appointments.written:,}')
+        appointments.flush()
+        written['appointments'] = appointments.written
+        log(f'appointments {appointments.written:,} ({_time.perf_counter() - started:.1f}s total)')
+
+        if conn.dialect.name == 'postgresql':
+            # months without a partition went to the default one
+            partitions.ensure(engine)
+            # explicit ids bypassed the sequences; move them past the new rows and refresh planner statistics
+            for model in (models.Address, models.Patient, models.Dentist, models.Surgery, models.WorkingHours, models.Appointment):
+                table = model.__tablename__
+                conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+            conn.commit()
+            conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql(
+                'ANALYZE addresses, patients, dentists, surgeries, dentist_working_hours, appointments')
+    # rows went in without the write paths that keep the daily rollups current
+    written['appointment_daily_stats'] = rollups.rebuild(engine)
+    log(f'appointment rollups rebuilt ({written["appointment_daily_stats"]:,} rows)')
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed roles/admin, or generate synthetic clinic data')
+    sub = parser.add_subparsers(dest='command')
+    gen = sub.add_parser('generate', help='append deterministic synthetic data')
+    gen.add_argument('--scale', choices=sorted(SCALES), default='1k', help='preset, named after the appointment count')
+    gen.add_argument('--patients', type=int, help='override the preset')
+    gen.add_argument('--dentists', type=int, help='override the preset')
+    gen.add_argument('--appointments', type=int, help='override the preset')
+    gen.add_argument('--seed', type=int, default=42)
+    gen.add_argument('--anchor', type=date.fromisoformat, default=DEFAULT_ANCHOR, help='date the history runs up to')
+    gen.add_argument('--history-days', type=int, default=3 * 365)
+    gen.add_argument('--future-days', type=int, default=90)
+    gen.add_argument('--batch-size', type=int, default=GENERATE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    import schema
+    schema.upgrade(engine)
+    seed_initial_data()
+    if args.command == 'generate':
+        preset = SCALES[args.scale]
+        scale = Scale(patients=args.patients or preset.patients, dentists=args.dentists or preset.dentists,
+                      appointments=args.appointments if args.appointments is not None else preset.appointments)
+        generate(engine, scale, seed=args.seed, anchor=args.anchor, history_days=args.history_days,
+                 future_days=args.future_days, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Per-request SQL statement counting and timing.
+
+Listeners on every `Engine` bump the counter bound to the current context,
+so a request (or a test) can assert on how many statements it issued and how
+long they took. Every statement is also timed into a histogram, and those over
+`SQL_SLOW_QUERY_SECONDS` are logged with their literals normalized away.
+"""
+import functools
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Response header the API uses to report the statement count of a request
+STATEMENT_COUNT_HEADER = 'X-SQL-Statements'
+
+SLOW_QUERY_SECONDS = float(os.getenv('SQL_SLOW_QUERY_SECONDS', 0.5))
+
+STATEMENT_DURATION = metrics.histogram('db_statement_duration_seconds', 'Time spent executing each SQL statement')
+SLOW_STATEMENTS = metrics.counter('db_slow_statements_total', 'Statements slower than SQL_SLOW_QUERY_SECONDS')
+
+
+class StatementCounter:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+_current: ContextVar[Optional[StatementCounter]] = ContextVar('sql_statement_counter', default=None)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|\$\d+|(?<!:):\w+|\?")
+_IN_LIST = re.compile(r'\bIN \((?:\?, )*\?\)', re.IGNORECASE)
+_VALUES_ROWS = re.compile(r'(\((?:\?, )*\?\))(?:, \((?:\?, )*\?\))+')
+_SPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=512)
+def normalize(statement: str) -> str:
+    """SQL with literals and bind parameters replaced by `?` and IN/VALUES lists collapsed, for grouping."""
+    sql = _LITERALS.sub('?', _SPACE.sub(' ', statement).strip())
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _VALUES_ROWS.sub(r'\1, ...', sql)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count(conn, cursor, statement, parameters, context, executemany):
+    counter = _current.get()
+    if counter is not None:
+        counter.count += 1
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('statement_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    STATEMENT_DURATION.observe(elapsed)
+    counter = _current.get()
+    if counter is not None:
+        counter.seconds += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        SLOW_STATEMENTS.inc()
+        logger.warning('slow query (%.3fs): %s', elapsed, normalize(statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _discard_timing(exception_context):
+    # a failed statement never reaches after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('statement_started'):
+        conn.info['statement_started'].pop()
+
+
+@contextmanager
+def count_statements() -> Iterator[StatementCounter]:
+    # the counter is a mutable object so threadpool workers running on a copy of this context still update it
+    counter = StatementCounter()
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        _current.reset(token)
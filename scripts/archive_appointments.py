@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Archive old appointments and add upcoming appointment partitions.
+
+Usage: python scripts/archive_appointments.py [--older-than-months 24] [--dry-run]
+
+Meant for cron (daily or monthly). Adds the partitions for the months ahead on
+PostgreSQL, then moves every month older than the horizon into the compressed
+archive under APPOINTMENT_ARCHIVE_DIR (see code/archive.py). Safe to re-run.
+"""
+import argparse
+import os
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from database import engine
+import archive
+import partitions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old appointments and add upcoming partitions')
+    parser.add_argument('--older-than-months', type=int, default=archive.ARCHIVE_AFTER_MONTHS)
+    parser.add_argument('--today', type=date.fromisoformat, help='pretend today is this date')
+    parser.add_argument('--archive-dir', default=archive.ARCHIVE_DIR)
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be archived')
+    args = parser.parse_args()
+
+    if not args.dry_run:
+        for name in partitions.ensure(engine, today=args.today):
+            print(f'created partition {name}')
+    moved = archive.archive(engine, args.older_than_months, today=args.today, directory=args.archive_dir,
+                            dry_run=args.dry_run)
+    verb = 'would archive' if args.dry_run else 'archived'
+    for month, rows in moved.items():
+        print(f'{month}  {verb} {rows:,} appointments')
+    print(f'{verb} {sum(moved.values()):,} appointments from {len(moved)} month(s) into {args.archive_dir}')
+
+
+if __name__ == '__main__':
+    main()
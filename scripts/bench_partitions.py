@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Benchmark the hot appointment queries as the history grows.
+
+For 1, 2 and 4 years of history (at a constant number of appointments per
+year) builds a fresh database with seed.generate, then times the median of:
+
+- week: a dentist's schedule for the current week (the calendar view)
+- overlap: the overlap check run when booking
+- upcoming: a patient's next appointments
+
+With monthly partitions (PostgreSQL) these should stay flat as history grows,
+and the plan column shows how many partitions each query scans.
+
+Usage: python scripts/bench_partitions.py [--years 1 2 4] [--per-year 25000] [--repeat 50]
+Uses throwaway SQLite files unless --database-url is given. A PostgreSQL
+database given there is WIPED before each run (pass --reset-database to agree).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, time as dtime, timedelta
+
+_tmpdir = tempfile.mkdtemp()
+# the app modules need a DATABASE_URL at import; each run below builds its own engine
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_tmpdir, 'unused.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.orm import Session
+
+import availability
+import models
+import projections
+import schema
+import seed
+
+
+def _fresh_engine(url, years):
+    if url is None:
+        return create_engine('sqlite:///' + os.path.join(_tmpdir, f'history{years}y.db'))
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text('DROP SCHEMA public CASCADE'))
+        conn.execute(text('CREATE SCHEMA public'))
+    return engine
+
+
+def _partitions_scanned(db, stmt) -> str:
+    if db.bind.dialect.name != 'postgresql':
+        return '-'
+    compiled = stmt.compile(dialect=db.bind.dialect, compile_kwargs={'literal_binds': True})
+    plan = db.execute(text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    scanned = set()
+
+    def walk(node):
+        if node.get('Relation Name', '').startswith(models.Appointment.__tablename__):
+            scanned.add(node['Relation Name'])
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan[0]['Plan'])
+    return str(len(scanned))
+
+
+def _queries(db, now: datetime):
+    A = models.Appointment
+    dentists = db.scalars(select(models.Dentist.id).order_by(models.Dentist.id)).all()
+    patients = db.scalars(select(A.patient_id).where(A.scheduled_at >= now).distinct().limit(200)).all()
+    monday = datetime.combine(now.date() - timedelta(days=now.weekday()), dtime())
+    week = (monday, monday + timedelta(days=7))
+    slot = (now + timedelta(days=1, hours=10), now + timedelta(days=1, hours=10, minutes=30))
+    return [
+        ('week', lambda i: projections.list_appointments(db, limit=500, dentist_id=dentists[i % len(dentists)],
+                                                         start=week[0], end=week[1]),
+         select(A.id).where(A.dentist_id == dentists[0], A.scheduled_at >= week[0], A.scheduled_at < week[1])),
+        ('overlap', lambda i: availability.overlapping(db, slot[0], slot[1], dentist_id=dentists[i % len(dentists)]),
+         select(A.id).where(A.dentist_id == dentists[0], A.scheduled_at < slot[1],
+                            A.scheduled_at > slot[0] - timedelta(minutes=availability.MAX_DURATION_MINUTES))),
+        ('upcoming', lambda i: projections.list_appointments(db, limit=20, patient_id=patients[i % len(patients)],
+                                                             start=now),
+         select(A.id).where(A.patient_id == patients[0], A.scheduled_at >= now).order_by(A.scheduled_at).limit(20)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark appointment queries against growing history')
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--per-year', type=int, default=25000, help='appointments per year of history')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--database-url', help='PostgreSQL database to use (wiped); default throwaway SQLite')
+    parser.add_argument('--reset-database', action='store_true', help='confirm --database-url may be wiped')
+    args = parser.parse_args()
+    if args.database_url and not args.reset_database:
+        parser.error('--database-url is wiped before each run; pass --reset-database to confirm')
+
+    now = datetime.combine(seed.DEFAULT_ANCHOR, dtime(9))
+    print(f'{"history":<8} {"rows":>10} {"query":<9} {"median ms":>10} {"p95 ms":>8} {"partitions":>10}')
+    for years in args.years:
+        engine = _fresh_engine(args.database_url, years)
+        schema.upgrade(engine)
+        scale = seed.Scale(patients=max(300, args.per_year // 4), dentists=max(5, args.per_year // 1500),
+                           appointments=args.per_year * years)
+        seed.generate(engine, scale, history_days=365 * years, log=lambda *a, **k: None)
+        with Session(engine) as db:
+            rows = db.scalar(select(func.count()).select_from(models.Appointment))
+            for name, run, probe in _queries(db, now):
+                run(0)  # warm caches
+                timings = []
+                for i in range(args.repeat):
+                    started = time.perf_counter()
+                    run(i)
+                    timings.append((time.perf_counter() - started) * 1000)
+                    db.expunge_all()
+                p95 = statistics.quantiles(timings, n=20)[-1]
+                print(f'{str(years) + "y":<8} {rows:>10,} {name:<9} {statistics.median(timings):>10.2f} {p95:>8.2f} '
+                      f'{_partitions_scanned(db, probe):>10}')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the patient list serialization paths, in rows/sec.
+
+- orm+validate+json: ORM objects with the address joined, PatientOut validation,
+  FastAPI's jsonable_encoder and the stdlib encoder (the previous list path)
+- orm+validate+orjson: the same objects and validation, encoded with fastjson
+- projection+orjson: column projection to dicts encoded with fastjson (the current list path)
+- sparse+orjson: the same with `fields=first_name,last_name`, no address join (typeahead and rosters)
+
+Usage: python scripts/bench_serialization.py [--rows 20000] [--repeat 5]
+Uses a throwaway SQLite database unless DATABASE_URL is set.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_tmpdir, 'bench.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import insert, func, select
+
+import api
+import crud
+import database
+import fastjson
+import loaders
+import models
+import projections
+import schema
+
+
+def _seed(rows: int) -> None:
+    db = database.get_session()
+    try:
+        existing = db.scalar(select(func.count()).select_from(models.Patient))
+        if existing >= rows:
+            return
+        address_ids = db.execute(insert(models.Address).returning(models.Address.id, sort_by_parameter_order=True), [
+            {'street': f'{i} High Street', 'city': f'City {i % 97}', 'postal_code': f'LS{i % 30} 1AA', 'country': 'UK'}
+            for i in range(rows // 2)]).scalars().all()
+        db.execute(insert(models.Patient), [
+            {'first_name': f'First{i}', 'last_name': f'Last{i % 5000:05d}', 'email': f'p{i}@example.com',
+             'phone': f'0113 {i:07d}', 'address_id': address_ids[i % len(address_ids)] if i % 3 else None}
+            for i in range(existing, rows)])
+        db.commit()
+    finally:
+        db.close()
+
+
+def _orm_validate_json(db, n):
+    patients = crud.list_patients(db, limit=n, options=loaders.PATIENT_OUT)
+    out = [api.PatientOut.model_validate(p, from_attributes=True) for p in patients]
+    return json.dumps(jsonable_encoder(out)).encode()
+
+
+def _orm_validate_orjson(db, n):
+    patients = crud.list_patients(db, limit=n, options=loaders.PATIENT_OUT)
+    return fastjson.dumps([api.PatientOut.model_validate(p, from_attributes=True).model_dump() for p in patients])
+
+
+def _projection_orjson(db, n):
+    return fastjson.dumps(projections.list_patients(db, limit=n))
+
+
+def _sparse_orjson(db, n):
+    return fastjson.dumps(projections.list_patients(db, limit=n, fields=projections.parse_fields('patients', 'first_name,last_name'),
+                                                    address=False))
+
+
+PATHS = [
+    ('orm+validate+json', _orm_validate_json),
+    ('orm+validate+orjson', _orm_validate_orjson),
+    ('projection+orjson', _projection_orjson),
+    ('sparse+orjson', _sparse_orjson),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark list serialization paths')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    schema.upgrade(database.engine)
+    _seed(args.rows)
+    baseline = None
+    print(f'{"path":<22} {"rows/sec":>12} {"speedup":>8}')
+    for name, fn in PATHS:
+        best = float('inf')
+        for _ in range(args.repeat):
+            db = database.get_session()
+            try:
+                started = time.perf_counter()
+                body = fn(db, args.rows)
+                best = min(best, time.perf_counter() - started)
+            finally:
+                db.close()
+        rate = args.rows / best
+        baseline = baseline or rate
+        print(f'{name:<22} {rate:>12,.0f} {rate / baseline:>7.1f}x  ({len(body):,} bytes)')
+
+
+if __name__ == '__main__':
+    main()
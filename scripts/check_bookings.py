@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Check appointment booking and availability against a throwaway database.
+
+Drives the API in-process: books appointments with and without a UTC offset
+and checks that times are stored as naive UTC, that a clash given in another
+offset is still refused with 409, and that the availability, list and history
+endpoints accept offset `from`/`to` and answer in UTC, and that bulk ingest
+refuses rows that clash with a booking or with an earlier row of the batch.
+Exits non-zero on the first failed expectation.
+
+Usage: python scripts/check_bookings.py
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bookings.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from fastapi.testclient import TestClient
+
+import api
+import crud
+import database
+import models
+
+MONDAY = '2026-11-02'
+
+
+def expect(label, actual, expected):
+    if actual != expected:
+        print(f'FAIL {label}: got {actual!r}, expected {expected!r}', file=sys.stderr)
+        sys.exit(1)
+    print(f'ok   {label}')
+
+
+def _staff_headers(client):
+    client.post('/auth/register', params={'username': 'booker', 'email': 'booker@example.com', 'password': 'booker'})
+    with database.get_session() as db:
+        user = db.query(models.User).filter_by(username='booker').one()
+        role = db.query(models.Role).filter_by(name='staff').first() or crud.create_role(db, name='staff')
+        crud.update_user(db, user.id, roles=[role])
+    token = client.post('/auth/token', data={'username': 'booker', 'password': 'booker'}).json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def main():
+    with TestClient(api.app) as client:
+        patient = client.post('/patients', json={'first_name': 'Tz', 'last_name': 'Aware'}).json()
+        dentist = client.post('/dentists', json={'first_name': 'Ut', 'last_name': 'Ce'}).json()
+
+        def book(at, **extra):
+            return client.post('/appointments', json={'patient_id': patient['id'], 'dentist_id': dentist['id'],
+                                                      'scheduled_at': at, **extra})
+
+        r = book(f'{MONDAY}T10:00:00+01:00')
+        expect('offset booking is stored as naive UTC', (r.status_code, r.json().get('scheduled_at')),
+               (201, f'{MONDAY}T09:00:00'))
+        expect('clash given in another offset is refused', book(f'{MONDAY}T04:15:00-05:00').status_code, 409)
+        expect('naive booking is taken as UTC', book(f'{MONDAY}T09:30:00').status_code, 201)
+        expect('Z suffix books too', book(f'{MONDAY}T11:00:00Z', duration_minutes=60).status_code, 201)
+
+        r = client.get(f'/dentists/{dentist["id"]}/availability',
+                       params={'from': f'{MONDAY}T10:00:00+01:00', 'to': f'{MONDAY}T14:00:00+02:00'})
+        expect('availability takes offset bounds', (r.status_code, [s['start'] for s in r.json().get('slots', [])]),
+               (200, [f'{MONDAY}T10:00:00', f'{MONDAY}T10:30:00']))
+        r = client.get(f'/dentists/{dentist["id"]}/availability',
+                       params={'from': f'{MONDAY}T09:00:00Z', 'to': f'{MONDAY}T12:00:00'})
+        expect('availability takes mixed bounds', r.status_code, 200)
+
+        window = {'dentist_id': dentist['id'], 'from': f'{MONDAY}T10:15:00+01:00', 'to': f'{MONDAY}T12:00:00+01:00'}
+        for path in ('/appointments', '/appointments/history'):
+            r = client.get(path, params=window)
+            expect(f'{path} takes offset bounds', (r.status_code, [a['scheduled_at'] for a in r.json()]),
+                   (200, [f'{MONDAY}T09:30:00']))
+        r = client.get(f'/patients/{patient["id"]}/appointments', params={'from': f'{MONDAY}T11:00:00+00:00'})
+        expect('patient appointments take offset bounds', (r.status_code, len(r.json())), (200, 1))
+
+        auth = _staff_headers(client)
+        surgery = client.post('/surgeries', json={'title': 'Bulk Room'}).json()
+        rows = [{'patient_id': patient['id'], 'dentist_id': dentist['id'], 'scheduled_at': at, **extra} for at, extra in (
+            (f'{MONDAY}T09:15:00', {}),                                   # clashes with the 09:00 booking
+            (f'{MONDAY}T13:00:00+01:00', {'surgery_id': surgery['id']}),  # 12:00 UTC, free
+            (f'{MONDAY}T12:20:00', {}),                                   # clashes with the row above
+            (f'{MONDAY}T14:00:00', {'duration_minutes': 60}),             # free
+            (f'{MONDAY}T14:30:00', {}),                                   # clashes with the row above
+        )]
+        r = client.post('/appointments/bulk', json=rows, headers=auth)
+        result = r.json()
+        expect('bulk inserts the free rows', (r.status_code, result['inserted'], result['failed']), (200, 2, 3))
+        expect('bulk reports each clash', [(e['row'], e['error'].split(' at ')[0]) for e in result['errors']],
+               [(1, 'conflicts with appointment 1'), (3, 'conflicts with row 2'), (5, 'conflicts with row 4')])
+        r = client.get('/appointments', params={'dentist_id': dentist['id'], 'from': f'{MONDAY}T12:00:00Z'})
+        expect('bulk stores offset times as naive UTC', [a['scheduled_at'] for a in r.json()],
+               [f'{MONDAY}T12:00:00', f'{MONDAY}T14:00:00'])
+        r = client.post('/appointments/bulk', json=rows[1:2], headers=auth)
+        expect('a later batch clashes with an earlier one', r.json()['failed'], 1)
+    print('bookings ok')
+
+
+if __name__ == '__main__':
+    main()
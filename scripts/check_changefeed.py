@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Check the change feed end to end against a throwaway database.
+
+Drives the API in-process: writes patients and addresses through the crud
+endpoints and bulk ingest, then checks that GET /changes returns exactly the
+committed changes in order (a write that fails with 409 leaves nothing), that
+updates carry only the columns written, that a rejected bulk row leaves no
+inline address behind, that the WebSocket sends the backlog and then pushes a
+new change as it commits, that both need a staff token, and that a pruned
+`since` gets 410 (4410 on the socket), that deleting an address records its
+patients losing it, and that bulk rows retried one by one after a race keep
+no address or record of the rows that failed. Exits non-zero on the first failed expectation.
+
+Usage: python scripts/check_changefeed.py
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'changefeed.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import api
+import bulk as bulk_module
+import changefeed
+import crud
+import database
+import models
+
+
+def expect(label, actual, expected):
+    if actual != expected:
+        print(f'FAIL {label}: got {actual!r}, expected {expected!r}', file=sys.stderr)
+        sys.exit(1)
+    print(f'ok   {label}')
+
+
+def _staff_headers(client):
+    client.post('/auth/register', params={'username': 'feed', 'email': 'feed@example.com', 'password': 'feed'})
+    with database.get_session() as db:
+        user = db.query(models.User).filter_by(username='feed').one()
+        role = db.query(models.Role).filter_by(name='staff').first() or crud.create_role(db, name='staff')
+        crud.update_user(db, user.id, roles=[role])
+    token = client.post('/auth/token', data={'username': 'feed', 'password': 'feed'}).json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def ops(changes):
+    return [(c['entity'], c['op']) for c in changes]
+
+
+def main():
+    with TestClient(api.app) as client:
+        auth = _staff_headers(client)
+        token = auth['Authorization'].split()[1]
+        expect('feed needs a staff token', client.get('/changes').status_code, 401)
+        try:
+            with client.websocket_connect('/changes/ws'):
+                closed = None
+        except WebSocketDisconnect as e:
+            closed = e.code
+        expect('socket needs a staff token', closed, 1008)
+        start = int(client.get('/changes', headers=auth).headers[changefeed.HEAD_HEADER])
+
+        address = client.post('/addresses', json={'street': '1 Feed St', 'city': 'Leeds'}).json()
+        patient = client.post('/patients', json={'first_name': 'Ada', 'last_name': 'Sync', 'email': 'ada@example.com',
+                                                 'address_id': address['id']}).json()
+        duplicate = client.post('/patients', json={'first_name': 'Bea', 'last_name': 'Sync', 'email': 'ada@example.com'})
+        client.patch(f'/patient/{patient["id"]}', json={'phone': '0113 000'}, headers=auth)
+        client.delete(f'/patient/{patient["id"]}')
+        bulk = client.post('/patients/bulk', headers=auth, json=[
+            {'first_name': 'Cy', 'last_name': 'Bulk', 'email': 'cy@example.com', 'address': {'street': '2 Feed St', 'city': 'York'}},
+            {'first_name': 'Di', 'last_name': 'Bulk', 'address_id': 10 ** 6},
+            {'first_name': 'Ed', 'last_name': 'Bulk', 'email': 'cy@example.com', 'address': {'street': '3 Feed St', 'city': 'Hull'}},
+        ]).json()
+
+        r = client.get('/changes', headers=auth, params={'since': start})
+        changes = r.json()
+        expect('rejected duplicate left no record', duplicate.status_code, 409)
+        expect('committed changes in order', ops(changes), [
+            ('addresses', 'insert'), ('patients', 'insert'), ('patients', 'update'), ('patients', 'delete'),
+            ('addresses', 'insert'), ('patients', 'insert')])
+        expect('bulk rows that failed are not in the feed, nor their addresses', bulk['failed'], 2)
+        expect('seq increases', [c['seq'] for c in changes] == sorted({c['seq'] for c in changes}), True)
+        expect('head is the newest seq', int(r.headers[changefeed.HEAD_HEADER]), changes[-1]['seq'])
+        expect('insert carries the row', (changes[1]['id'], changes[1]['data']['email'], changes[1]['data']['address_id']),
+               (patient['id'], 'ada@example.com', address['id']))
+        expect('update carries only the columns written', changes[2]['data'], {'phone': '0113 000'})
+        expect('delete carries nothing', changes[3]['data'], None)
+        expect('bulk insert links the inline address', changes[5]['data']['address_id'], changes[4]['id'])
+
+        expect('entities filter', ops(client.get('/changes', headers=auth, params={'since': start, 'entities': 'addresses'}).json()),
+               [('addresses', 'insert')] * 2)
+        expect('limit pages', [c['seq'] for c in client.get('/changes', headers=auth, params={'since': start, 'limit': 2}).json()],
+               [c['seq'] for c in changes[:2]])
+        expect('unknown entity is rejected', client.get('/changes', headers=auth, params={'entities': 'users'}).status_code, 422)
+
+        with client.websocket_connect(f'/changes/ws?token={token}&since={changes[3]["seq"]}') as ws:
+            expect('socket sends the backlog first', ops(ws.receive_json()), ops(changes[4:]))
+            surgery = client.post('/surgeries', json={'title': 'Feed Room'}).json()
+            pushed = ws.receive_json()
+            expect('socket pushes a new change as it commits', [(c['entity'], c['op'], c['id']) for c in pushed],
+                   [('surgeries', 'insert', surgery['id'])])
+
+        expect('pruning keeps the newest record', changefeed.prune(database.engine, older_than_days=-1) > 0, True)
+        r = client.get('/changes', headers=auth, params={'since': start})
+        expect('pruned since gets 410 with the seq to resync from', (r.status_code, r.headers.get(changefeed.HEAD_HEADER)),
+               (410, str(pushed[-1]['seq'])))
+        with client.websocket_connect('/changes/ws?since=0', headers=auth) as ws:
+            try:
+                ws.receive_json()
+                closed = None
+            except WebSocketDisconnect as e:
+                closed = e.code
+        expect('pruned since closes the socket with 4410', closed, changefeed.CLOSE_EXPIRED)
+        head = int(r.headers[changefeed.HEAD_HEADER])
+        expect('caught-up client still reads from the head', client.get('/changes', headers=auth, params={'since': head}).json(), [])
+
+        address = client.post('/addresses', json={'street': '2 Feed St', 'city': 'York'}).json()
+        patient = client.post('/patients', json={'first_name': 'Cy', 'last_name': 'Sync', 'address_id': address['id']}).json()
+        head = int(client.get('/changes', headers=auth).headers[changefeed.HEAD_HEADER])
+        with database.get_session() as db:
+            crud.delete_address(db, address['id'])
+        changes = client.get('/changes', headers=auth, params={'since': head}).json()
+        expect('deleting an address unlinks its patients first', [(c['entity'], c['op'], c['id'], c['data']) for c in changes],
+               [('patients', 'update', patient['id'], {'address_id': None}), ('addresses', 'delete', address['id'], None)])
+
+        # a writer that takes an email between the batch checks and the insert sends bulk ingest row by row
+        head = changes[-1]['seq']
+        checks, bulk_module._check_constraints = bulk_module._check_constraints, lambda db, spec, rows, errors: None
+        try:
+            raced = client.post('/patients/bulk', headers=auth, json=[
+                {'first_name': 'Fa', 'last_name': 'Race', 'email': 'cy@example.com', 'address': {'street': '4 Feed St', 'city': 'Ely'}},
+                {'first_name': 'Gu', 'last_name': 'Race', 'address': {'street': '5 Feed St', 'city': 'Ely'}},
+                {'first_name': 'Ha', 'last_name': 'Race', 'address': {'street': '5 Feed St', 'city': 'Ely'}},
+            ]).json()
+        finally:
+            bulk_module._check_constraints = checks
+        changes = client.get('/changes', headers=auth, params={'since': head}).json()
+        expect('row-by-row fallback keeps the rows that fit', (raced['inserted'], raced['failed']), (2, 1))
+        expect('row-by-row fallback records only the addresses kept', ops(changes),
+               [('addresses', 'insert'), ('patients', 'insert'), ('patients', 'insert')])
+        expect('rows sharing an inline address still share it', {c['data']['address_id'] for c in changes[1:]}, {changes[0]['id']})
+        with database.get_session() as db:
+            expect('failed row left no address', db.query(models.Address).filter_by(street='4 Feed St').count(), 0)
+    print('change feed ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Check read replica routing end to end.
+
+Drives the API in-process against a primary and two replicas and checks that
+GET requests read from the replicas in turn, writes go to the primary, a client
+that just wrote reads it back from the primary, and lagging, failing or busy
+replicas are skipped, and that the response cache never keeps a body read from
+a lagging replica. Exits non-zero on the first failed expectation.
+
+Usage: python scripts/check_replicas.py
+Uses throwaway SQLite files as stand-ins, "replicating" by copying the primary
+file. To check against real PostgreSQL replicas set DATABASE_URL and
+DATABASE_REPLICA_URLS (comma-separated, two of them); the script then waits for
+rows to replicate instead.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+_tmpdir = tempfile.mkdtemp()
+if 'DATABASE_REPLICA_URLS' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'primary.db')
+    os.environ['DATABASE_REPLICA_URLS'] = ','.join(
+        'sqlite:///' + os.path.join(_tmpdir, f'replica{i}.db') for i in (1, 2))
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ['RESPONSE_CACHE'] = 'false'  # every GET must reach the database; the cache case turns it on
+os.environ['REPLICA_STRATEGY'] = 'round_robin'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+import api
+import database
+import httpcache
+
+replica_set = database.replica_set
+served = Counter()
+
+
+def _count_on(engine, name):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        served[name] += 1
+
+
+_count_on(database.async_engine.sync_engine if database.ASYNC_DB else database.engine, 'primary')
+for _replica in replica_set.replicas:
+    _count_on(_replica.bind, _replica.name)
+
+
+def served_by(fn) -> set:
+    served.clear()
+    fn()
+    return set(served)
+
+
+def replicate(patient_id: int) -> None:
+    if database.engine.dialect.name == 'sqlite':
+        primary = sqlite3.connect(make_url(database.DATABASE_URL).database)
+        for replica in replica_set.replicas:
+            target = sqlite3.connect(replica.probe_engine.url.database)
+            primary.backup(target)
+            target.close()
+        primary.close()
+        return
+    deadline = time.monotonic() + 30
+    for replica in replica_set.replicas:
+        with replica.probe_engine.connect() as conn:
+            while not conn.execute(text('SELECT 1 FROM patients WHERE id = :id'), {'id': patient_id}).first():
+                if time.monotonic() > deadline:
+                    raise SystemExit(f'{replica.name} did not replicate patient {patient_id} within 30s')
+                time.sleep(0.2)
+                conn.rollback()
+
+
+def expect(label, actual, expected):
+    if actual != expected:
+        print(f'FAIL {label}: got {actual!r}, expected {expected!r}', file=sys.stderr)
+        sys.exit(1)
+    print(f'ok   {label}')
+
+
+def main():
+    with TestClient(api.app) as client, TestClient(api.app) as other:
+        # health checks are driven by hand below
+        replica_set.stop()
+        replicate(0)
+        replica_set.check()
+        expect('replicas healthy after a check', [r.healthy for r in replica_set.replicas], [True, True])
+
+        expect('GET reads from replica1', served_by(lambda: client.get('/patients')), {'replica1'})
+        expect('next GET reads from replica2', served_by(lambda: client.get('/patients')), {'replica2'})
+
+        holder = {}
+        expect('POST writes to the primary', served_by(lambda: holder.update(r=client.post(
+            '/patients', json={'first_name': 'Rea', 'last_name': 'Plica'}))), {'primary'})
+        created = holder['r']
+        expect('write response carries X-Last-Write', 'x-last-write' in created.headers, True)
+        pid = created.json()['id']
+        expect('writer reads its write from the primary',
+               (served_by(lambda: holder.update(r=client.get(f'/patients/{pid}'))), holder['r'].status_code),
+               ({'primary'}, 200))
+        expect('other clients read the replica (not yet replicated)', other.get(f'/patients/{pid}').status_code, 404)
+        replicate(pid)
+        expect('other clients see the row once replicated', other.get(f'/patients/{pid}').status_code, 200)
+
+        first, second = replica_set.replicas
+        first.lag = replica_set.max_lag + 1
+        expect('lagging replica is skipped',
+               served_by(lambda: [other.get('/patients') for _ in range(2)]), {'replica2'})
+        first.lag = 0.0
+
+        good_probe = second.probe_engine
+        second.probe_engine = create_engine('sqlite:///' + os.path.join(_tmpdir, 'missing', 'x.db'), poolclass=NullPool)
+        replica_set.check()
+        expect('failed health check takes a replica out', (first.healthy, second.healthy), (True, False))
+        expect('reads go to the healthy replica', served_by(lambda: other.get('/patients')), {'replica1'})
+        first.healthy = False
+        expect('no healthy replica falls back to the primary', served_by(lambda: other.get('/patients')), {'primary'})
+        second.probe_engine = good_probe
+        replica_set.check()
+        expect('replicas come back after a passing check', [r.healthy for r in replica_set.replicas], [True, True])
+
+        httpcache.CACHE_ENABLED = True
+        replicate(pid)
+        other.get('/patients')
+        added = client.post('/patients', json={'first_name': 'Cac', 'last_name': 'He'}).json()['id']
+        stale = other.get('/patients')
+        expect('replica read behind the write gets no ETag', (added in {p['id'] for p in stale.json()},
+                                                            'etag' in stale.headers), (False, False))
+        fresh = client.get('/patients')
+        expect('writer reads its write with the cache on', (added in {p['id'] for p in fresh.json()},
+                                                            'etag' in fresh.headers), (True, True))
+        # a cache hit reads only the versions, from the primary
+        expect('others get the primary body from the cache', (served_by(lambda: holder.update(r=other.get('/patients'))),
+                                                               holder['r'].headers.get('etag')), ({'primary'}, fresh.headers['etag']))
+        httpcache.CACHE_ENABLED = False
+
+        replica_set.strategy = 'least_connections'
+        if database.ASYNC_DB:
+            print('skip least_connections (held connections need the sync pool)')
+        else:
+            with first.bind.connect():
+                expect('least_connections avoids the busy replica',
+                       {replica_set.choose().name for _ in range(3)}, {'replica2'})
+    print('replica routing ok')
+
+
+if __name__ == '__main__':
+    main()
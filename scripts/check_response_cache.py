@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Check that the response cache sees writes made by other processes.
+
+Drives the API in-process against a throwaway database, then writes from
+separate processes -- a plain Core UPDATE and `rebuild_rollups.py rebuild` --
+and checks that the ETags the API hands out change, that a rolled-back check
+leaves them alone, and that an unchanged resource still gets a 304.
+Exits non-zero on the first failed expectation.
+
+Usage: python scripts/check_response_cache.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'response_cache.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+os.environ['RESPONSE_CACHE'] = 'true'
+os.environ['CACHE_BACKEND'] = 'database'
+_scripts = os.path.dirname(os.path.abspath(__file__))
+_code = os.path.join(os.path.dirname(_scripts), 'code')
+sys.path.insert(0, _code)
+
+from fastapi.testclient import TestClient
+
+import api
+
+OTHER_PROCESS_UPDATE = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from sqlalchemy import update
+import database, models
+with database.engine.begin() as conn:
+    conn.execute(update(models.Patient).where(models.Patient.id == int(sys.argv[2])).values(phone='0113 496 0001'))
+"""
+
+
+def expect(label, actual, expected):
+    if actual != expected:
+        print(f'FAIL {label}: got {actual!r}, expected {expected!r}', file=sys.stderr)
+        sys.exit(1)
+    print(f'ok   {label}')
+
+
+def run(*args):
+    subprocess.run([sys.executable, *args], check=True, env=os.environ, stdout=subprocess.DEVNULL)
+
+
+def main():
+    with TestClient(api.app) as client:
+        pid = client.post('/patients', json={'first_name': 'Et', 'last_name': 'Ag'}).json()['id']
+        dentist = client.post('/dentists', json={'first_name': 'Ca', 'last_name': 'Che'}).json()['id']
+        client.post('/appointments', json={'patient_id': pid, 'dentist_id': dentist, 'scheduled_at': '2026-11-02T10:00:00'})
+        stats = ('/stats/dentists', {'from': '2026-11-02', 'period': 'week'})
+
+        first = client.get(f'/patients/{pid}')
+        etag = first.headers['etag']
+        expect('repeat request is not modified', client.get(f'/patients/{pid}', headers={'If-None-Match': etag}).status_code, 304)
+
+        run('-c', OTHER_PROCESS_UPDATE, _code, str(pid))
+        second = client.get(f'/patients/{pid}', headers={'If-None-Match': etag})
+        expect('write from another process changes the ETag', (second.status_code, second.json()['phone']),
+               (200, '0113 496 0001'))
+
+        before = client.get(stats[0], params=stats[1]).headers['etag']
+        run(os.path.join(_scripts, 'rebuild_rollups.py'), 'check')
+        expect('rolled-back check keeps the /stats ETag', client.get(stats[0], params=stats[1]).headers['etag'], before)
+        run(os.path.join(_scripts, 'rebuild_rollups.py'), 'rebuild')
+        r = client.get(stats[0], params=stats[1], headers={'If-None-Match': before})
+        expect('rebuild in another process changes the /stats ETag', r.status_code, 200)
+
+        dentists = client.get('/dentists')
+        expect('tables nobody wrote keep their ETag',
+               client.get('/dentists', headers={'If-None-Match': dentists.headers['etag']}).status_code, 304)
+    print('response cache ok')
+
+
+if __name__ == '__main__':
+    main()
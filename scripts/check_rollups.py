@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Check that the incremental appointment rollups match a rebuild.
+
+Books appointments for patients in two cities against a throwaway database,
+archives the oldest, then moves a patient, renames a city, updates and
+deletes appointments and patients and deletes an address and a surgery that
+are still referenced, calling `rollups.verify` after every step.
+Exits non-zero on the first difference or negative count.
+
+Usage: python scripts/check_rollups.py
+"""
+import os
+import sys
+import tempfile
+from collections import Counter
+from datetime import date, datetime
+
+_tmpdir = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_tmpdir, 'rollups.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from fastapi.testclient import TestClient
+
+import api
+import archive
+import crud
+import database
+import models
+import rollups
+
+ARCHIVE_DIR = os.path.join(_tmpdir, 'archive')
+
+
+def expect(label, actual, expected):
+    if actual != expected:
+        print(f'FAIL {label}: got {actual!r}, expected {expected!r}', file=sys.stderr)
+        sys.exit(1)
+    print(f'ok   {label}')
+
+
+def consistent(label):
+    expect(f'{label}: rollups match a rebuild', rollups.verify(database.engine, ARCHIVE_DIR), [])
+    with database.get_session() as db:
+        expect(f'{label}: no negative counts',
+               db.query(models.AppointmentDailyStat).filter(models.AppointmentDailyStat.appointments < 0).count(), 0)
+
+
+def cities(db):
+    totals = Counter()
+    for row in rollups.stats(db, 'city', date(2020, 1, 1), date(2030, 1, 1)):
+        totals[row['key']] += row['appointments']
+    return dict(totals)
+
+
+def main():
+    with TestClient(api.app) as client:
+        leeds = client.post('/addresses', json={'street': '1 Roll St', 'city': 'Leeds'}).json()['id']
+        york = client.post('/addresses', json={'street': '2 Roll St', 'city': 'York'}).json()['id']
+        mover = client.post('/patients', json={'first_name': 'Mo', 'last_name': 'Ver', 'address_id': leeds}).json()['id']
+        stayer = client.post('/patients', json={'first_name': 'St', 'last_name': 'Ay', 'address_id': leeds}).json()['id']
+        dentist = client.post('/dentists', json={'first_name': 'Ro', 'last_name': 'Llup'}).json()['id']
+        booked = [client.post('/appointments', json={'patient_id': p, 'dentist_id': dentist, 'scheduled_at': at}).json()['id']
+                  for p, at in ((mover, '2024-01-15T10:00:00'), (mover, '2026-11-03T10:00:00'),
+                                (mover, '2026-11-04T10:00:00'), (stayer, '2026-11-04T11:00:00'))]
+        consistent('booked')
+
+        archive.archive(database.engine, older_than_months=24, today=date(2026, 10, 18), directory=ARCHIVE_DIR)
+        consistent('archived')
+
+        with database.get_session() as db:
+            crud.update_patient(db, mover, address_id=york)
+            consistent('patient moved')
+            expect('live appointments follow the patient, archived ones stay', cities(db),
+                   {'Leeds': 2, 'York': 2})
+            crud.update_appointment(db, booked[1], scheduled_at=datetime(2026, 11, 5, 9))
+            consistent('moved patient rebooked')
+            crud.delete_appointment(db, booked[2])
+            consistent('moved patient cancelled')
+            crud.update_address(db, leeds, city='Wakefield')
+            consistent('city renamed')
+            expect('renamed city takes its live appointments', cities(db), {'Leeds': 1, 'Wakefield': 1, 'York': 1})
+            crud.update_patient(db, stayer, address_id=None)
+            consistent('patient without an address')
+            crud.delete_patient(db, mover)
+            consistent('moved patient deleted')
+
+            crud.update_patient(db, stayer, address_id=leeds)
+            surgery = crud.create_surgery(db, title='Roll Room').id
+            crud.update_appointment(db, booked[3], surgery_id=surgery)
+            consistent('appointment given a surgery')
+            expect('address still referenced can be deleted', crud.delete_address(db, leeds), True)
+            consistent('address deleted')
+            expect('its patient stays, without an address', crud.get_patient(db, stayer).address_id, None)
+            expect('surgery still referenced can be deleted', crud.delete_surgery(db, surgery), True)
+            consistent('surgery deleted')
+            expect('its appointment stays, without a surgery', crud.get_appointment(db, booked[3]).surgery_id, None)
+    print('rollups ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Check the number of SQL statements each endpoint issues against a budget.
+
+Drives the API in-process and reads the `X-SQL-Statements` response header.
+Exits non-zero when an endpoint goes over its budget, so a change that adds a
+query to a hot path is caught before it ships.
+
+Usage: python scripts/check_round_trips.py
+Uses a throwaway SQLite database unless DATABASE_URL is set (which must point
+at an empty database: the script creates rows).
+"""
+import os
+import sys
+import tempfile
+
+_tmpdir = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_tmpdir, 'round_trips.db'))
+os.environ.setdefault('HASH_WORKERS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from fastapi.testclient import TestClient
+
+import api
+import crud
+import database
+import models
+import sqlstats
+
+# (method, route) -> statements allowed on (SQLite, PostgreSQL); PostgreSQL bookings also take advisory locks,
+# and bookings update the daily rollups (a patient city lookup and one upsert); writes to synced entities append
+# to the change feed (one insert, after an advisory lock on PostgreSQL); deleting a patient deletes their
+# appointments first, and writing a patient's address_id first looks up the city their appointments are counted under;
+# every write commits one upsert of the response cache versions, and every cached GET reads them
+BUDGETS = {
+    ('POST', '/addresses'): (3, 4),
+    ('POST', '/patients'): (4, 5),
+    ('GET', '/patients'): (2, 2),
+    ('GET', '/patients/{id}'): (2, 2),
+    ('GET', '/patient/search/{term}'): (1, 1),
+    ('PUT', '/patient/{id}'): (5, 6),
+    ('PATCH', '/patient/{id}'): (4, 5),
+    ('DELETE', '/patient/{id}'): (4, 5),
+    ('POST', '/dentists'): (3, 4),
+    ('GET', '/dentists'): (2, 2),
+    ('POST', '/surgeries'): (3, 4),
+    ('POST', '/appointments'): (5, 7),
+    ('GET', '/appointments'): (1, 1),
+    ('GET', '/appointments?include=patient,dentist,surgery'): (4, 4),
+    ('GET', '/patients?ids='): (2, 2),
+    ('GET', '/surgeries?ids='): (2, 2),
+    ('GET', '/patients/{id}/appointments'): (1, 1),
+    ('GET', '/dentists/{id}/availability'): (3, 3),
+    ('GET', '/stats/{dimension}'): (2, 2),
+    ('GET', '/changes'): (2, 2),
+}
+
+
+def _staff_headers(client):
+    client.post('/auth/register', params={'username': 'budget', 'email': 'budget@example.com', 'password': 'budget'})
+    db = database.get_session()
+    try:
+        user = db.query(models.User).filter_by(username='budget').one()
+        role = db.query(models.Role).filter_by(name='staff').first() or crud.create_role(db, name='staff')
+        crud.update_user(db, user.id, roles=[role])
+    finally:
+        db.close()
+    token = client.post('/auth/token', data={'username': 'budget', 'password': 'budget'}).json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def main():
+    backend = 0 if database.engine.dialect.name == 'sqlite' else 1
+    failures = []
+    with TestClient(api.app) as client:
+        auth = _staff_headers(client)
+
+        def call(method, route, path, warm=False, **kwargs):
+            if warm:
+                # first call fills per-process caches (principal cache, search index)
+                client.request(method, path, **kwargs)
+            r = client.request(method, path, **kwargs)
+            if r.status_code >= 400:
+                failures.append(f'{method} {route}: HTTP {r.status_code} {r.text}')
+                return r
+            used = int(r.headers[sqlstats.STATEMENT_COUNT_HEADER])
+            budget = BUDGETS[(method, route)][backend]
+            status = 'ok' if used <= budget else 'OVER'
+            print(f'{status:<4} {method:<6} {route:<48} {used:>2} / {budget}')
+            if used > budget:
+                failures.append(f'{method} {route}: {used} statements, budget {budget}')
+            return r
+
+        address = call('POST', '/addresses', '/addresses', json={'street': '1 Main St', 'city': 'Leeds'}).json()
+        patient = call('POST', '/patients', '/patients', json={
+            'first_name': 'Ada', 'last_name': 'Budget', 'email': 'ada@example.com', 'address_id': address['id']}).json()
+        pid = patient['id']
+        call('GET', '/patients', '/patients')
+        call('GET', '/patients/{id}', f'/patients/{pid}')
+        call('GET', '/patient/search/{term}', '/patient/search/budget', warm=True)
+        call('PUT', '/patient/{id}', f'/patient/{pid}', warm=True, headers=auth, json={
+            'first_name': 'Ada', 'last_name': 'Budget', 'address_id': address['id']})
+        call('PATCH', '/patient/{id}', f'/patient/{pid}', headers=auth, json={'phone': '0113 496 0000'})
+        dentist = call('POST', '/dentists', '/dentists', json={'first_name': 'Dee', 'last_name': 'Budget'}).json()
+        call('GET', '/dentists', '/dentists', params={'fields': 'last_name', 'include': 'address'})
+        surgery = call('POST', '/surgeries', '/surgeries', json={'title': 'Room 1'}).json()
+        call('POST', '/appointments', '/appointments', json={
+            'patient_id': pid, 'dentist_id': dentist['id'], 'surgery_id': surgery['id'], 'scheduled_at': '2030-01-07T10:00:00'})
+        call('GET', '/appointments', '/appointments', params={
+            'dentist_id': dentist['id'], 'from': '2030-01-07T00:00:00', 'to': '2030-01-08T00:00:00'})
+        call('GET', '/appointments?include=patient,dentist,surgery', '/appointments', params={
+            'dentist_id': dentist['id'], 'include': 'patient,dentist,surgery'})
+        call('GET', '/patients?ids=', '/patients', params={'ids': f'{pid},{pid + 1}'})
+        call('GET', '/surgeries?ids=', '/surgeries', params={'ids': str(surgery['id'])})
+        call('GET', '/patients/{id}/appointments', f'/patients/{pid}/appointments')
+        call('GET', '/dentists/{id}/availability', f'/dentists/{dentist["id"]}/availability', params={
+            'from': '2030-01-07T00:00:00', 'to': '2030-01-08T00:00:00'})
+        call('GET', '/stats/{dimension}', '/stats/dentists', params={'from': '2030-01-07', 'period': 'week'})
+        call('GET', '/changes', '/changes', headers=auth, params={'since': 0, 'entities': 'patients'})
+        spare = client.post('/patients', json={'first_name': 'Bo', 'last_name': 'Budget'}).json()
+        call('DELETE', '/patient/{id}', f'/patient/{spare["id"]}')
+
+    for failure in failures:
+        print('FAIL', failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
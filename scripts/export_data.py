@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Stream a dataset export straight from the database to a file or stdout.
+
+Usage: python scripts/export_data.py <addresses|patients|dentists|appointments>
+           [--format csv|ndjson] [--gzip] [--updated-since 2024-01-01T00:00:00] [--output FILE]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from database import get_session
+import exports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export clinic data as CSV or NDJSON')
+    parser.add_argument('dataset', choices=sorted(exports.DATASETS))
+    parser.add_argument('--format', choices=sorted(exports.FORMATS), default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--updated-since', type=datetime.fromisoformat)
+    parser.add_argument('--output', help='file to write (default: stdout)')
+    args = parser.parse_args()
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    db = get_session()
+    try:
+        chunks = exports.iter_export(db, args.dataset, args.format, args.updated_since)
+        if args.gzip:
+            for data in exports.gzip_chunks(chunks):
+                out.write(data)
+        else:
+            for chunk in chunks:
+                out.write(chunk.encode('utf-8'))
+    finally:
+        db.close()
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""Reproducible load test for the API.
+
+Starts the app with uvicorn against a database (a throwaway SQLite file by
+default, or any DATABASE_URL such as a scratch PostgreSQL database), seeds a
+configurable data volume, then drives a weighted mix of login, patient search,
+list, get, appointment booking and availability requests at fixed concurrency.
+Reports throughput, p50/p95/p99 latency and SQL statements per request (from
+the X-SQL-Statements header) per endpoint, and writes them to a JSON file
+tagged with the current commit so runs can be compared.
+
+Usage:
+  python scripts/loadtest.py --patients 5000 --concurrency 16 --duration 30 --output results.json
+  python scripts/loadtest.py --database-url postgresql+psycopg2://bench@localhost/bench_scratch --db-mode async
+  python scripts/loadtest.py --baseline before.json --output after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE = os.path.join(ROOT, 'code')
+
+DEFAULT_MIX = 'login=1,search=4,list=6,get=6,book=2,availability=1'
+PASSWORD = 'loadtest-password'
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 16  # 09:00-17:00
+FIRST_DAY = datetime(2030, 1, 7, 9, 0)  # a Monday, far enough ahead to never collide with real data
+
+
+# --- seeding ---
+
+def _slot(index: int) -> datetime:
+    day, slot = divmod(index, SLOTS_PER_DAY)
+    # weekdays only: skip Saturday and Sunday
+    week, weekday = divmod(day, 5)
+    return FIRST_DAY + timedelta(days=week * 7 + weekday, minutes=slot * SLOT_MINUTES)
+
+
+def seed(args) -> Dict[str, int]:
+    """Insert the data volume directly (not through the API) so seeding is fast and not measured."""
+    sys.path.insert(0, CODE)
+    from sqlalchemy import func, insert, select
+    import auth
+    import database
+    import models
+    import schema
+    import seed as seed_module
+
+    schema.upgrade(database.engine)
+    seed_module.seed_initial_data()
+    rng = random.Random(args.seed)
+    db = database.get_session()
+    try:
+        if db.scalar(select(func.count()).select_from(models.Patient)) and not args.reseed:
+            print('database already has patients; reusing them (pass --reseed to add more)')
+        else:
+            address_ids = db.execute(insert(models.Address).returning(models.Address.id, sort_by_parameter_order=True), [
+                {'street': f'{i} {rng.choice(["High", "Mill", "Park", "Church"])} Street', 'city': f'City {i % 50}',
+                 'postal_code': f'LS{i % 30} {i % 9}AA', 'country': 'UK'} for i in range(max(1, args.patients // 2))
+            ]).scalars().all()
+            db.execute(insert(models.Patient), [
+                {'first_name': f'First{i}', 'last_name': f'Surname{rng.randrange(args.patients // 4 + 1):05d}',
+                 'email': f'patient{i}@loadtest.example', 'phone': f'0113 {i:07d}',
+                 'address_id': rng.choice(address_ids) if rng.random() < 0.8 else None} for i in range(args.patients)])
+            db.execute(insert(models.Dentist), [
+                {'first_name': f'Dentist{i}', 'last_name': f'Dental{i:03d}', 'email': f'dentist{i}@loadtest.example'}
+                for i in range(args.dentists)])
+            db.execute(insert(models.Surgery), [{'title': f'Surgery {i}'} for i in range(max(1, args.dentists // 2))])
+            patient_ids = db.execute(select(models.Patient.id)).scalars().all()
+            dentist_ids = db.execute(select(models.Dentist.id)).scalars().all()
+            # distinct (dentist, slot) pairs, so the seeded schedule has no conflicts
+            horizon = args.days * SLOTS_PER_DAY
+            taken = set()
+            rows = []
+            while len(rows) < min(args.appointments, len(dentist_ids) * horizon):
+                key = (rng.choice(dentist_ids), rng.randrange(horizon))
+                if key in taken:
+                    continue
+                taken.add(key)
+                rows.append({'patient_id': rng.choice(patient_ids), 'dentist_id': key[0], 'scheduled_at': _slot(key[1])})
+            if rows:
+                db.execute(insert(models.Appointment), rows)
+            hashed = auth.get_password_hash(PASSWORD)
+            db.execute(insert(models.User), [
+                {'username': f'loadtest{i}', 'email': f'loadtest{i}@loadtest.example', 'full_name': f'Load Test {i}',
+                 'hashed_password': hashed} for i in range(args.users)])
+            db.commit()
+        return {
+            'patients': db.scalar(select(func.max(models.Patient.id))) or 0,
+            'dentists': db.scalar(select(func.max(models.Dentist.id))) or 0,
+            'appointments': db.scalar(select(func.count()).select_from(models.Appointment)),
+            'users': db.scalar(select(func.count()).select_from(models.User).where(models.User.username.like('loadtest%'))),
+        }
+    finally:
+        db.close()
+
+
+# --- server ---
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, env) -> Tuple[subprocess.Popen, str]:
+    port = args.port or _free_port()
+    cmd = [sys.executable, '-m', 'uvicorn', 'api:app', '--host', '127.0.0.1', '--port', str(port),
+           '--log-level', 'warning', '--no-access-log', '--workers', str(args.workers)]
+    proc = subprocess.Popen(cmd, cwd=CODE, env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f'server exited with status {proc.returncode}')
+        try:
+            if httpx.get(url + '/patients', params={'limit': 1}, timeout=1).status_code == 200:
+                return proc, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit('server did not become ready within 60s')
+
+
+# --- workload ---
+
+class Workload:
+    def __init__(self, counts: Dict[str, int], args):
+        self.counts = counts
+        self.args = args
+
+    def login(self, rng):
+        user = f'loadtest{rng.randrange(max(1, self.counts["users"]))}'
+        return 'POST /auth/token', dict(method='POST', url='/auth/token', data={'username': user, 'password': PASSWORD})
+
+    def search(self, rng):
+        term = f'surname{rng.randrange(self.args.patients // 4 + 1):05d}'[:rng.choice((4, 9, 12))]
+        return 'GET /patient/search/{term}', dict(method='GET', url=f'/patient/search/{term}')
+
+    def list(self, rng):
+        return 'GET /patients', dict(method='GET', url='/patients', params={'limit': 50})
+
+    def get(self, rng):
+        return 'GET /patients/{id}', dict(method='GET', url=f'/patients/{rng.randint(1, self.counts["patients"])}')
+
+    def book(self, rng):
+        body = {'patient_id': rng.randint(1, self.counts['patients']), 'dentist_id': rng.randint(1, self.counts['dentists']),
+                'scheduled_at': _slot(rng.randrange(self.args.days * SLOTS_PER_DAY)).isoformat()}
+        return 'POST /appointments', dict(method='POST', url='/appointments', json=body)
+
+    def availability(self, rng):
+        start = _slot(rng.randrange(self.args.days) * SLOTS_PER_DAY).replace(hour=0)
+        params = {'from': start.isoformat(), 'to': (start + timedelta(days=1)).isoformat()}
+        return 'GET /dentists/{id}/availability', dict(
+            method='GET', url=f'/dentists/{rng.randint(1, self.counts["dentists"])}/availability', params=params)
+
+
+def parse_mix(spec: str) -> List[tuple]:
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(Workload, name.strip()):
+            raise SystemExit(f'unknown operation {name!r} in --mix')
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+async def drive(url: str, workload: Workload, mix, args) -> Dict[str, List[tuple]]:
+    samples: Dict[str, List[tuple]] = defaultdict(list)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    stop_at = measure_from + args.duration
+
+    async def worker(index: int, client: httpx.AsyncClient):
+        rng = random.Random(args.seed * 1000 + index)
+        while time.perf_counter() < stop_at:
+            endpoint, request = getattr(workload, rng.choices(names, weights)[0])(rng)
+            t0 = time.perf_counter()
+            try:
+                r = await client.request(**request)
+                status, statements = r.status_code, int(r.headers.get('x-sql-statements', -1))
+            except httpx.HTTPError:
+                status, statements = 0, -1
+            t1 = time.perf_counter()
+            if t0 >= measure_from:
+                samples[endpoint].append((t1 - t0, status, statements))
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+        await asyncio.gather(*(worker(i, client) for i in range(args.concurrency)))
+    return samples
+
+
+# --- reporting ---
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples: Dict[str, List[tuple]], duration: float) -> Dict[str, dict]:
+    report = {}
+    everything = []
+    for endpoint, rows in sorted(samples.items()):
+        everything.extend(rows)
+        report[endpoint] = _summary(rows, duration)
+    report['ALL'] = _summary(everything, duration)
+    return report
+
+
+def _summary(rows: List[tuple], duration: float) -> dict:
+    latencies = sorted(r[0] * 1000 for r in rows)
+    statuses = defaultdict(int)
+    for _, status, _ in rows:
+        statuses[str(status)] += 1
+    counted = [r[2] for r in rows if r[2] >= 0]
+    return {
+        'requests': len(rows),
+        'throughput_rps': round(len(rows) / duration, 1),
+        'p50_ms': round(_percentile(latencies, 50), 2),
+        'p95_ms': round(_percentile(latencies, 95), 2),
+        'p99_ms': round(_percentile(latencies, 99), 2),
+        'max_ms': round(latencies[-1], 2) if latencies else 0.0,
+        'sql_per_request': round(sum(counted) / len(counted), 2) if counted else None,
+        'errors': sum(n for s, n in statuses.items() if s == '0' or s.startswith('5')),
+        'status': dict(sorted(statuses.items())),
+    }
+
+
+def print_report(report: Dict[str, dict], baseline: Dict[str, dict] = None) -> None:
+    print(f'{"endpoint":<34} {"req":>7} {"rps":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"sql/req":>8} {"err":>5}')
+    for endpoint, r in report.items():
+        line = (f'{endpoint:<34} {r["requests"]:>7} {r["throughput_rps"]:>8} {r["p50_ms"]:>8} {r["p95_ms"]:>8} '
+                f'{r["p99_ms"]:>8} {r["sql_per_request"] if r["sql_per_request"] is not None else "-":>8} {r["errors"]:>5}')
+        old = (baseline or {}).get(endpoint)
+        if old and old['p95_ms'] and old['throughput_rps']:
+            line += (f'   p95 {100 * (r["p95_ms"] / old["p95_ms"] - 1):+.0f}%'
+                     f' rps {100 * (r["throughput_rps"] / old["throughput_rps"] - 1):+.0f}%')
+        print(line)
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the API and report latency percentiles per endpoint')
+    parser.add_argument('--database-url', help='database to run against (default: a new SQLite file)')
+    parser.add_argument('--db-mode', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--url', help='drive an already running server instead of starting one (seeds via --database-url)')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--dentists', type=int, default=20)
+    parser.add_argument('--appointments', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--days', type=int, default=60, help='working days of schedule to seed and book into')
+    parser.add_argument('--reseed', action='store_true', help='add the data volume even if the database has patients')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'operation weights (default {DEFAULT_MIX})')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds run before measuring')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='loadtest-results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    env = dict(os.environ)
+    if args.database_url:
+        env['DATABASE_URL'] = args.database_url
+    elif not args.url:
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+    env['DB_MODE'] = args.db_mode
+    env['DB_MIGRATE_ON_STARTUP'] = 'false'  # the seeding step below has already migrated
+    os.environ.update(env)
+
+    counts = seed(args)
+    print(f'seeded: {counts}')
+    proc = None
+    url = args.url
+    if not url:
+        proc, url = start_server(args, env)
+    try:
+        samples = asyncio.run(drive(url, Workload(counts, args), mix, args))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    report = summarize(samples, args.duration)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['endpoints']
+    print_report(report, baseline)
+    result = {
+        'commit': _commit(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'database': env['DATABASE_URL'].split(':', 1)[0],
+        'seeded': counts,
+        'endpoints': report,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""Apply or list the versioned schema migrations.
+
+Usage: python scripts/migrate.py [status|upgrade]
+
+Run `upgrade` before deploying when the API starts with DB_MIGRATE_ON_STARTUP=false.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from database import engine
+import migrations
+import schema
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply or list schema migrations')
+    parser.add_argument('command', choices=['status', 'upgrade'], nargs='?', default='status')
+    args = parser.parse_args()
+
+    if args.command == 'upgrade':
+        schema.upgrade(engine)
+    done = migrations.applied(engine)
+    for m in migrations.MIGRATIONS:
+        state = done[m.version].isoformat(sep=' ', timespec='seconds') if m.version in done else 'pending'
+        print(f'{m.version}  {state:<19}  {m.description}')
+
+
+if __name__ == '__main__':
+    main()
@@ -25,8 +25,9 @@ try:
     if not admin:
         admin = crud.create_role(db, name='admin', description='Administrator')
     if not any(r.name == 'admin' for r in user.roles):
-        user.roles.append(admin)
-        db.commit()
+        # goes through crud so the cached principal is invalidated; API workers in
+        # other processes pick the new role up once PRINCIPAL_CACHE_TTL_SECONDS elapses
+        crud.update_user(db, user.id, roles=list(user.roles) + [admin])
         print(f'promoted {username} to admin')
     else:
         print(f'{username} already admin')
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""Drop old change feed records (see code/changefeed.py).
+
+Usage: python scripts/prune_changes.py [--older-than-days 30]
+
+Run it from cron, e.g. daily. Clients whose last seq was pruned get 410 from
+GET /changes and download the lists again.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from database import engine
+import changefeed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune the change feed')
+    parser.add_argument('--older-than-days', type=int, default=changefeed.CHANGE_FEED_RETENTION_DAYS)
+    args = parser.parse_args()
+    print(f'pruned: {changefeed.prune(engine, args.older_than_days):,} records')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""Check or rebuild the daily appointment rollups behind /stats.
+
+Usage: python scripts/rebuild_rollups.py [check|rebuild]
+
+`check` recounts in a transaction that is rolled back and lists the days whose
+counts differ. `rebuild` replaces the counts with the recount; on PostgreSQL,
+bookings wait while it runs.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from database import engine
+import rollups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check or rebuild the appointment rollups')
+    parser.add_argument('command', choices=['check', 'rebuild'], nargs='?', default='check')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        print(f'rebuilt: {rollups.rebuild(engine):,} rows')
+        return
+    differences = rollups.verify(engine)
+    for (dimension, key, day), kept, recounted in differences[:50]:
+        print(f'{day}  {dimension}={key!r:<20} kept {kept}  recounted {recounted}  (appointments, minutes)')
+    if differences:
+        print(f'{len(differences):,} rows differ; run `python scripts/rebuild_rollups.py rebuild`')
+        sys.exit(1)
+    print('rollups match the appointments')
+
+
+if __name__ == '__main__':
+    main()